@@ -0,0 +1,1481 @@
+"""Benchmarks and regression checks for the biondi body client.
+
+Each check builds its own synthetic case in a temporary folder and exits with
+a non zero status if it fails so it can be used in a build script.
+
+Typical usage example:
+    python benchmarks.py query_plans
+    python benchmarks.py write_latency wal
+    python benchmarks.py schema_size
+    python benchmarks.py renumber 1000,10000,100000
+    python benchmarks.py counters
+    python benchmarks.py rebuild_counters path/to/case
+    python benchmarks.py notifications
+    python benchmarks.py paging
+    python benchmarks.py export 2000
+    python benchmarks.py incremental_export
+    python benchmarks.py table_export
+    python benchmarks.py image_store 2000
+    python benchmarks.py thumbnails 300
+    python benchmarks.py tile_pyramid 40000
+    python benchmarks.py minimap 2000,8000,32000
+    python benchmarks.py markers 5000,50000
+    python benchmarks.py marker_overlay 500,2000,8000
+    python benchmarks.py marker_filter 10000
+    python benchmarks.py body_table 100000
+    python benchmarks.py body_list 10000,100000
+    python benchmarks.py startup
+    python benchmarks.py viewer_clicks 2000
+    python benchmarks.py body_cache 200
+    python benchmarks.py renders 50
+"""
+
+import sys
+import re
+import csv
+import sqlite3
+import tracemalloc
+import random
+import tempfile
+from time import perf_counter, sleep
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import subprocess
+import shutil
+import statistics
+import zlib
+import mmap
+import os
+from shutil import rmtree, copy
+from PIL import Image
+from file_management import FileManagement, merge_images, render_images
+from database_manager import DatabaseManager
+from exporter import CaseExport, table_exporters
+from image_store import open_image_store, convert_image_store, render_name, pack_name, pack_generation
+from thumbnail_cache import ThumbnailCache
+from body_cache import BodyCache
+from body_table import open_body_table
+from tile_pyramid import TilePyramid, open_gridfile, read_bands
+from spatial_index import SpatialIndex
+from markings import marker_overlay, make_body_filter, passes_body_filter
+from image_viewer import body_list_rows, BodyList
+from grid_tracker import GridRandomizer
+import migrations
+import config
+
+def make_synthetic_case(num_bodies, folder_path = None, grid_size = (700, 700), schema_version = None):
+    """Creates an initiated case folder filled with random bodies.
+
+    Args:
+        num_bodies (int): The number of bodies inserted into the database.
+        folder_path (str): Folder to initiate. A temporary folder is made if None.
+        grid_size (tuple): The width and height of the generated gridfile.
+        schema_version (int): Schema to build the case on. Older versions are used
+            to check migrations. Defaults to the latest version.
+
+    Returns:
+        folder_path (str): The directory of the case ending with a slash.
+    """
+    if folder_path is None:
+        folder_path = tempfile.mkdtemp(prefix = "biondi_case_") + "/"
+    grid_path = folder_path + "source_grid.jpg"
+    Image.new("RGB", grid_size, "black").save(grid_path)
+    if schema_version is None:
+        FileManagement(folder_path).initiate_folder(grid_path, "BB")
+    else:
+        copy(grid_path, folder_path + "gridfile.jpg")
+        migrations.migrate(DatabaseManager.get_connection(folder_path), schema_version)
+        fm = FileManagement(folder_path)
+        fm.c.executemany('''INSERT INTO grid (GRID_ID, FINISHED) VALUES (?, 0)''',
+                         [(i,) for i in GridRandomizer().get_final_order()])
+        fm.c.execute('''INSERT INTO name (NAME) VALUES ('BB')''')
+        fm.close()
+    version = migrations.get_version(DatabaseManager.get_connection(folder_path))
+
+    rng = random.Random(0)
+    numbers = {}
+    rows = []
+    for i in range(num_bodies):
+        body_name = rng.choice(config.all_bodies)
+        numbers[body_name] = numbers.get(body_name, 0) + 1
+        time_added = 1600000000 + i
+        flags = [rng.random() < .1, rng.random() < .1, rng.random() < .1, rng.random() < .05]
+        if version >= 2:
+            flags = [FileManagement.pack_flags(*flags)]
+        rows.append([time_added, "BB", body_name, numbers[body_name],
+                     rng.randrange(grid_size[0]), rng.randrange(grid_size[1]),
+                     rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvw")]
+                    + flags
+                    + ["", "{0}_{1}.png".format(body_name, time_added),
+                       "{0}_{1}_ANNOTATION.png".format(body_name, time_added),
+                       None, None, None, None])
+    fm = FileManagement(folder_path)
+    if version >= 2:
+        fm.c.executemany('''INSERT INTO bodies (TIME, ANNOTATOR_NAME, TYPE_ID, BODY_NUMBER, X_POSITION, Y_POSITION,
+                                                 GRID_ID, FLAGS, NOTES, BODY_FILE_NAME, ANNOTATION_FILE_NAME,
+                                                 ANGLE, LOG, DPRONG1, LPRONG2)
+                            VALUES (?, ?, (SELECT TYPE_ID FROM body_types WHERE BODY_NAME = ?),
+                                    ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+    else:
+        fm.c.executemany('''INSERT INTO bodies VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+    fm.c.executemany('''INSERT INTO ignored (X, Y) VALUES (?, ?)''',
+                     [(rng.randrange(grid_size[0]), rng.randrange(grid_size[1])) for i in range(num_bodies // 100)])
+    fm.close()
+    return folder_path
+
+class PlanRecordingCursor():
+    """Wraps a sqlite3 cursor to record the query plan of everything executed.
+
+    Attributes:
+        cursor (sqlite3.Cursor): The wrapped cursor.
+        plans (list): Shared list where (label, query, plan lines, every_row) are appended.
+        label (str): Name of the FileManagement function being checked.
+        every_row (bool): True if the call is meant to return every row of the table it reads.
+    """
+    def __init__(self, cursor, plans, label, every_row = False):
+        self.cursor = cursor
+        self.plans = plans
+        self.label = label
+        self.every_row = every_row
+
+    def _explain(self, query, params):
+        explained = self.cursor.connection.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()
+        self.plans.append((self.label, " ".join(query.split()), [row[-1] for row in explained], self.every_row))
+
+    def execute(self, query, params = ()):
+        if query.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "INSERT", "WITH")):
+            self._explain(query, params)
+        return self.cursor.execute(query, params)
+
+    def executemany(self, query, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        if seq_of_params:
+            self._explain(query, seq_of_params[0])
+        return self.cursor.executemany(query, seq_of_params)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+def _full_scans(conn, query, plan, every_row = False):
+    """Returns the plan lines which scan a whole table.
+
+    Tables the query names with AS show up in the plan under their alias. A
+    scan in index order (SCAN ... USING INDEX) is only allowed when every_row
+    is True, any scan of a filtered query fails. The counter tables are left
+    out, they hold at most one row per body type and flags combination or per
+    grid square.
+    """
+    tables = {row[0] for row in conn.execute('''SELECT name FROM sqlite_master WHERE type = 'table' ''')}
+    tables -= {"body_counts", "grid_counts"}
+    aliases = {alias: table for table, alias in re.findall(r"(?:FROM|JOIN)\s+(\w+)\s+AS\s+(\w+)", query, re.IGNORECASE)}
+    scans = []
+    for line in plan:
+        words = line.split()
+        if len(words) < 2 or words[0] != "SCAN" or aliases.get(words[1], words[1]) not in tables:
+            continue
+        if not (every_row and "INDEX" in words):
+            scans.append(line)
+    return scans
+
+def check_query_plans(num_bodies = 100000):
+    """Runs every FileManagement query on a synthetic case and checks for table scans.
+
+    Functions which are meant to read every row (get_grid, get_annotator_name,
+    query_all_ignored and export_case) are not checked. A scan in index order
+    (SCAN ... USING INDEX) is only allowed for the calls listed as returning
+    every row, query_images without a filter.
+
+    Args:
+        num_bodies (int): The number of bodies in the synthetic case.
+
+    Returns:
+        failures (list): Tuple of (function, query, plan lines) for each query
+            that fell back to a full table scan.
+    """
+    folder_path = make_synthetic_case(num_bodies)
+    plans = []
+
+    def checked(label, every_row = False):
+        fm = FileManagement(folder_path)
+        fm.c = PlanRecordingCursor(fm.c, plans, label, every_row)
+        return fm
+
+    try:
+        few = [config.all_bodies[0]]
+        checked("count_bodies").count_bodies(config.all_bodies, False, False, False, False)
+        checked("count_bodies").count_bodies(few, True, False, False, True)
+        checked("query_images", every_row = True).query_images(config.all_bodies, False, False, False, False)
+        checked("query_images").query_images(few, True, False, True, False)
+        checked("query_images_page").query_images_page(config.all_bodies, False, False, False, False,
+                                                       (1600000000 + num_bodies // 2, num_bodies // 2))
+        checked("query_images_page").query_images_page(few, True, False, False, False,
+                                                       (1600000000 + num_bodies // 2, num_bodies // 2))
+        checked("query_markers_page").query_markers_page((1600000000 + num_bodies // 2, num_bodies // 2))
+        checked("get_image_time").get_image_time(1600000000 + num_bodies // 2)
+        checked("get_body").get_body(num_bodies // 3)
+        checked("get_image").get_image(few[0], 3)
+        checked("finish_grid").finish_grid("A", True)
+        checked("add_ignored").add_ignored((1, 2))
+        checked("delete_ignored").delete_ignored((1, 2))
+        body_info = checked("get_image_time").get_image_time(1600000000 + 7)
+        checked("edit_info").edit_info((body_info["body_name"], True, False, False, False, "edited",
+                                        None, None, None, None, body_info["body_id"]))
+        fm = checked("renumber_img")
+        fm.renumber_img(few[0], 1)
+        fm.close()
+        checked("delete_img").delete_img(few[0], 2)
+        body_info["time"] = 1600000000 + num_bodies
+        checked("save_image").save_image(body_info, Image.new("RGB", (4, 4)), Image.new("RGBA", (4, 4)))
+
+        conn = DatabaseManager.get_connection(folder_path)
+        failures = []
+        for label, query, plan, every_row in plans:
+            if _full_scans(conn, query, plan, every_row):
+                failures.append((label, query, plan))
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+    return failures
+
+def run_query_plan_check():
+    failures = check_query_plans()
+    for label, query, plan in failures:
+        print("{0}: {1}\n    {2}".format(label, query, "\n    ".join(plan)))
+    print("{0} queries fell back to a table scan".format(len(failures)))
+    return 1 if failures else 0
+
+def measure_write_latency(profile, num_writes = 200, num_bodies = 1000):
+    """Times single row writes the way the client makes them on a synthetic case.
+
+    Each write is an add_ignored call, which commits on its own like every
+    FileManagement write.
+
+    Args:
+        profile (str): A key of config.durability_profiles.
+        num_writes (int): The number of writes timed.
+        num_bodies (int): The number of bodies in the synthetic case.
+
+    Returns:
+        latencies (list): The time of every write in milliseconds sorted from fastest.
+    """
+    folder_path = make_synthetic_case(num_bodies)
+    try:
+        DatabaseManager.set_durability_profile(folder_path, profile)
+        latencies = []
+        for i in range(num_writes):
+            start = perf_counter()
+            FileManagement(folder_path).add_ignored((i, i))
+            latencies.append((perf_counter() - start) * 1000)
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+    return sorted(latencies)
+
+def run_write_latency(profile = "wal"):
+    """Prints the write latency of the default profile next to another profile."""
+    for name in ("default", profile):
+        latencies = measure_write_latency(name)
+        print("{0:>8}: mean {1:.2f} ms  p95 {2:.2f} ms  max {3:.2f} ms".format(
+            name, sum(latencies) / len(latencies), latencies[int(len(latencies) * .95)], latencies[-1]))
+    return 0
+
+def _mean_ms(func, repeat = 20):
+    """Returns the mean run time of func in milliseconds after one warm up run."""
+    func()
+    start = perf_counter()
+    for i in range(repeat):
+        func()
+    return (perf_counter() - start) * 1000 / repeat
+
+def run_schema_size(num_bodies = 100000):
+    """Prints the size and filtered query times of a case before and after its migration.
+
+    The v1 queries are timed with plain sql as FileManagement only speaks the
+    latest schema.
+    """
+    folder_path = make_synthetic_case(int(num_bodies), schema_version = 1)
+    try:
+        DatabaseManager.get_connection(folder_path).execute("VACUUM")
+        DatabaseManager.close_case(folder_path)
+        size = os.path.getsize(folder_path + "body_database.db")
+
+        conn = sqlite3.connect(folder_path + "body_database.db")
+        query_time = _mean_ms(lambda: conn.execute('''SELECT TIME, BODY_NAME, BODY_NUMBER, X_POSITION, Y_POSITION
+                                    FROM bodies WHERE BODY_NAME IN (?, ?, ?) AND GR IN (1) AND MAF IN (0, 1)
+                                    AND MP IN (0, 1) AND UNSURE IN (0, 1) ORDER BY TIME DESC''',
+                                    config.all_bodies[:3]).fetchall())
+        count_time = _mean_ms(lambda: conn.execute('''SELECT COUNT(*) FROM bodies WHERE BODY_NAME IN ({0})
+                                    AND GR IN (0, 1) AND MAF IN (1) AND MP IN (0, 1)
+                                    AND UNSURE IN (0, 1)'''.format(",".join("?" * len(config.all_bodies))),
+                                    config.all_bodies).fetchone())
+        conn.close()
+        print("schema v1: {0} bytes, query_images {1:.2f} ms, count_bodies {2:.2f} ms".format(
+            size, query_time, count_time))
+
+        # opening the case runs the migration
+        DatabaseManager.get_connection(folder_path)
+        DatabaseManager.close_case(folder_path)
+        size = os.path.getsize(folder_path + "body_database.db")
+        query_time = _mean_ms(lambda: FileManagement(folder_path).query_images(
+                                    config.all_bodies[:3], True, False, False, False))
+        count_time = _mean_ms(lambda: FileManagement(folder_path).count_bodies(
+                                    config.all_bodies, False, True, False, False))
+        print("schema v{0}: {1} bytes, query_images {2:.2f} ms, count_bodies {3:.2f} ms".format(
+            migrations.latest_version, size, query_time, count_time))
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+    return 0
+
+def _legacy_renumber(fm, body_name, body_number):
+    """The old renumber_img, one UPDATE per row. Kept to compare against."""
+    fm.c.execute('''SELECT BODY_ID FROM bodies
+                    WHERE TYPE_ID = (SELECT TYPE_ID FROM body_types WHERE BODY_NAME = ?)
+                    ORDER BY TIME, BODY_ID''', (body_name,))
+    ids = fm.c.fetchall()
+    for i in range(body_number, len(ids) + 1):
+        fm.c.execute('''UPDATE bodies SET BODY_NUMBER = ? WHERE BODY_ID = ?''', (i, ids[i-1][0]))
+
+def measure_renumber(num_bodies):
+    """Times renumbering after a body is relabelled the way ImageViewer.edit_info does it.
+
+    The median body of one type is moved to another type and both types are
+    renumbered from 1. The result is checked to be numbered 1 to n in time order.
+
+    Args:
+        num_bodies (int): The number of bodies in the synthetic case.
+
+    Returns:
+        times (tuple): The legacy per row and the set based renumber in milliseconds.
+    """
+    folder_path = make_synthetic_case(num_bodies)
+    old_name, new_name = config.all_bodies[:2]
+    relabel_query = '''UPDATE bodies SET TYPE_ID = (SELECT TYPE_ID FROM body_types WHERE BODY_NAME = ?)
+                        WHERE BODY_ID = ?'''
+    try:
+        times = []
+        for renumber in (_legacy_renumber, FileManagement.renumber_img):
+            ids = [row[0] for row in FileManagement(folder_path).query_images([old_name], False, False, False, False)]
+            fm = FileManagement(folder_path)
+            fm.c.execute(relabel_query, (new_name, ids[len(ids) // 2]))
+            fm.close()
+            fm = FileManagement(folder_path)
+            start = perf_counter()
+            renumber(fm, old_name, 1)
+            renumber(fm, new_name, 1)
+            fm.close()
+            times.append((perf_counter() - start) * 1000)
+
+        for body_name in (old_name, new_name):
+            numbers = [row[3] for row in FileManagement(folder_path).query_images([body_name], False, False, False, False)]
+            if numbers != list(range(len(numbers), 0, -1)):
+                raise AssertionError("{0} is not numbered 1 to {1}".format(body_name, len(numbers)))
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+    return tuple(times)
+
+def run_renumber(sizes = "1000,10000,100000"):
+    """Prints the renumber time of one body type at several case sizes."""
+    for num_bodies in [int(size) for size in sizes.split(",")]:
+        legacy, set_based = measure_renumber(num_bodies)
+        print("{0:>8} bodies: per row {1:.2f} ms  set based {2:.2f} ms".format(num_bodies, legacy, set_based))
+    return 0
+
+def check_counters(num_bodies = 10000):
+    """Edits a synthetic case through FileManagement and checks the trigger counters.
+
+    Bodies are saved, relabelled, flagged and deleted, then the counters are
+    rebuilt from scratch and every difference is returned. Also prints how long
+    count_bodies takes next to a COUNT(*) on the bodies table.
+
+    Args:
+        num_bodies (int): The number of bodies in the synthetic case.
+
+    Returns:
+        mismatches (list): See FileManagement.rebuild_counters.
+    """
+    folder_path = make_synthetic_case(num_bodies)
+    try:
+        first, second = config.all_bodies[:2]
+        for i in range(20):
+            body_info = FileManagement(folder_path).get_body(i + 1)
+            body_info["time"] = 1700000000 + i
+            body_info["grid_id"] = "AB"[i % 2]
+            FileManagement(folder_path).save_image(body_info, Image.new("RGB", (4, 4)), Image.new("RGBA", (4, 4)))
+            edited = FileManagement(folder_path).get_body(i + 100)
+            FileManagement(folder_path).edit_info(((first, second)[i % 2], i % 3 == 0, i % 5 == 0, False, True,
+                                                   "edited", None, None, None, None, edited["body_id"]))
+        for i in range(10):
+            FileManagement(folder_path).delete_img(first, 1)
+            FileManagement(folder_path).renumber_img(second, 1)
+
+        counted = _mean_ms(lambda: FileManagement(folder_path).count_bodies(
+                            config.all_bodies, True, False, False, False))
+        conn = DatabaseManager.get_connection(folder_path)
+        scanned = _mean_ms(lambda: conn.execute('''SELECT COUNT(*) FROM bodies WHERE FLAGS & ?''',
+                                                (config.flag_bits["GR"],)).fetchone())
+        print("count_bodies {0:.3f} ms, COUNT(*) {1:.3f} ms".format(counted, scanned))
+        mismatches = FileManagement(folder_path).rebuild_counters()
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+    return mismatches
+
+def _print_mismatches(mismatches):
+    for table, key, stored, actual in mismatches:
+        print("{0} {1}: counted {2}, actually {3}".format(table, key, stored, actual))
+    print("{0} counters were wrong".format(len(mismatches)))
+    return 1 if mismatches else 0
+
+def run_counter_check(num_bodies = 10000):
+    return _print_mismatches(check_counters(int(num_bodies)))
+
+def run_rebuild_counters(folder_path):
+    """Rebuilds the counters of an existing case folder."""
+    folder_path = os.path.join(folder_path, "")
+    try:
+        return _print_mismatches(FileManagement(folder_path).rebuild_counters())
+    finally:
+        DatabaseManager.close_case(folder_path)
+
+def check_notifications():
+    """Checks that only data changes notify listeners and that closing tells them once.
+
+    Returns:
+        events (list): The events received, expected to be three "changed"
+            for the bodies, one "grid" for a finished square and one "closed".
+    """
+    folder_path = make_synthetic_case(100)
+    events = []
+    try:
+        DatabaseManager.subscribe(folder_path, events.append)
+        body_info = FileManagement(folder_path).get_body(1)
+        FileManagement(folder_path).count_bodies(config.all_bodies, False, False, False, False)
+        FileManagement(folder_path).query_images(config.all_bodies, False, False, False, False)
+        body_info["time"] = 1700000000
+        FileManagement(folder_path).save_image(body_info, Image.new("RGB", (4, 4)), Image.new("RGBA", (4, 4)))
+        FileManagement(folder_path).edit_info((body_info["body_name"], True, False, False, False, "edited",
+                                               None, None, None, None, body_info["body_id"]))
+        FileManagement(folder_path).delete_img(body_info["body_name"], 1)
+        FileManagement(folder_path).finish_grid(body_info["grid_id"], True)
+    finally:
+        DatabaseManager.close_case(folder_path)
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+    return events
+
+def run_notification_check():
+    events = check_notifications()
+    print("events: {0}".format(", ".join(events)))
+    return 0 if events == ["changed"] * 3 + ["grid", "closed"] else 1
+
+def run_paging(num_bodies = 100000):
+    """Prints how long the first page and every page take next to one query_images call.
+
+    Every filter is checked to page through exactly the rows query_images returns.
+    """
+    folder_path = make_synthetic_case(int(num_bodies))
+    filters = {"all bodies": (config.all_bodies, False, False, False, False),
+               "one type": (config.all_bodies[:1], False, False, False, False),
+               "one type, GR": (config.all_bodies[:1], True, False, False, False),
+               "GR and MAF": (config.all_bodies, True, True, False, False)}
+    status = 0
+    try:
+        for label, params in filters.items():
+            first_page = _mean_ms(lambda: FileManagement(folder_path).query_images_page(*params), 5)
+            every_page = _mean_ms(lambda: [page for page in FileManagement(folder_path).iter_image_pages(*params)], 5)
+            whole = _mean_ms(lambda: FileManagement(folder_path).query_images(*params), 5)
+            rows = [row for page, token in FileManagement(folder_path).iter_image_pages(*params) for row in page]
+            if rows != FileManagement(folder_path).query_images(*params):
+                print("{0}: pages do not match query_images".format(label))
+                status = 1
+            print("{0:>14}: {1:>6} rows, first page {2:.2f} ms, every page {3:.2f} ms, query_images {4:.2f} ms".format(
+                label, len(rows), first_page, every_page, whole))
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+    return status
+
+def add_synthetic_images(folder_path, size = (400, 300), renders = True):
+    """Saves a body and an annotation image for every body of a synthetic case.
+
+    Their renders are saved too unless renders is False, which makes a case as
+    it was before renders were kept.
+    """
+    rng = random.Random(0)
+    images = open_image_store(folder_path)
+    fm = FileManagement(folder_path)
+    fm.c.execute('''SELECT BODY_FILE_NAME, ANNOTATION_FILE_NAME FROM bodies''')
+    for body_file_name, annotation_file_name in fm.c.fetchall():
+        body_img = Image.effect_noise(size, rng.randrange(20, 80)).convert("RGB")
+        annotation_img = Image.new("RGBA", size)
+        annotation_img.paste((255, 0, 0, 255), (rng.randrange(size[0] // 2), rng.randrange(size[1] // 2), 
+                                                size[0] // 2, size[1] // 2))
+        images.save(body_file_name, body_img)
+        images.save(annotation_file_name, annotation_img)
+        if renders:
+            images.save(render_name(body_file_name), render_images(body_img, annotation_img))
+    fm.close()
+
+def run_export(num_bodies = 2000, workers = None):
+    """Times a serial export_case next to a CaseExport and checks an export resumes.
+
+    The CaseExport also writes every table format, which must not hold up start.
+    The parallel export is cancelled part way and then run again, which should
+    only make the missing images.
+    """
+    folder_path = make_synthetic_case(int(num_bodies))
+    export_path = tempfile.mkdtemp(prefix = "biondi_export_") + "/"
+    workers = None if workers is None else int(workers)
+    try:
+        add_synthetic_images(folder_path)
+
+        start = perf_counter()
+        FileManagement(folder_path).export_case(export_path + "serial_", "case")
+        serial = perf_counter() - start
+
+        start = perf_counter()
+        case_export = CaseExport(folder_path, export_path, "case", workers, formats = tuple(table_exporters))
+        case_export.start()
+        started = perf_counter() - start
+        errors = case_export.wait()
+        parallel = perf_counter() - start
+        print("serial {0:.2f} s, parallel {1:.2f} s, {2} errors, start returned after {3:.1f} ms".format(
+            serial, parallel, len(errors), started * 1000))
+
+        for name in os.listdir(export_path):
+            if name.endswith(".png") and not name.startswith("serial_"):
+                os.remove(export_path + name)
+        case_export = CaseExport(folder_path, export_path, "case", workers)
+        case_export.start()
+        while case_export.progress()[0] < len(case_export.jobs) // 2:
+            sleep(.05)
+        case_export.cancel()
+        case_export.wait()
+        done = case_export.progress()[0] - case_export.steps_done
+
+        case_export = CaseExport(folder_path, export_path, "case", workers)
+        case_export.start()
+        case_export.wait()
+        exported = [name for name in os.listdir(export_path) if not name.startswith("serial_")]
+        print("cancelled at {0} of {1}, resume skipped {2}, {3} images, {4} partial files".format(
+            done, len(case_export.jobs), case_export.skipped, sum(name.endswith(".png") for name in exported),
+            sum(name.endswith(".part") for name in exported)))
+        if case_export.skipped < done or case_export.progress() != (len(case_export.steps) + len(case_export.jobs),) * 2:
+            return 1
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+        rmtree(export_path, ignore_errors = True)
+    return 0
+
+def run_incremental_export(num_bodies = 500, store = "loose"):
+    """Exports a case, changes a few bodies and checks the next export only redoes those.
+
+    One annotation is redrawn, one body is relabelled, which renumbers two body
+    types, and one body is deleted. Afterwards the export folder must hold exactly
+    the images of the current bodies. store picks the image store of the case.
+    """
+    folder_path = make_synthetic_case(int(num_bodies))
+    export_path = tempfile.mkdtemp(prefix = "biondi_export_") + "/"
+    try:
+        add_synthetic_images(folder_path)
+        convert_image_store(folder_path, store)
+        start = perf_counter()
+        FileManagement(folder_path).export_case(export_path, "case")
+        full = perf_counter() - start
+
+        first, second = config.all_bodies[:2]
+        FileManagement(folder_path).save_annotation(FileManagement(folder_path).get_body(3), 
+                                                    Image.new("RGBA", (400, 300), (0, 0, 255, 255)))
+        relabelled = FileManagement(folder_path).query_images([first], False, False, False, False)[-1]
+        body_info = FileManagement(folder_path).get_body(relabelled[0])
+        FileManagement(folder_path).edit_info((second, False, False, False, False, body_info["notes"],
+                                               None, None, None, None, body_info["body_id"]))
+        fm = FileManagement(folder_path)
+        fm.renumber_img(first, 1)
+        fm.renumber_img(second, 1)
+        fm.close()
+        deleted = FileManagement(folder_path).get_body(10)
+        FileManagement(folder_path).delete_img(deleted["body_name"], deleted["body_number"])
+
+        start = perf_counter()
+        case_export = CaseExport(folder_path, export_path, "case", 0)
+        case_export.start()
+        case_export.wait()
+        incremental = perf_counter() - start
+
+        expected = {os.path.basename(job[3]) for job in case_export.jobs}
+        exported = {name for name in os.listdir(export_path) if name.endswith(".png")}
+        print("full {0:.2f} s, incremental {1:.2f} s: {2} merged, {3} renamed, {4} removed".format(
+            full, incremental, len(case_export.pending), len(case_export.renames), len(case_export.removals)))
+        print("{0} missing, {1} left over".format(len(expected - exported), len(exported - expected)))
+        if expected != exported:
+            return 1
+
+        # an image that can not be renamed is reported and merged again under its new name
+        relabelled = FileManagement(folder_path).get_body(relabelled[0])
+        FileManagement(folder_path).edit_info((first, False, False, False, False, relabelled["notes"],
+                                               None, None, None, None, relabelled["body_id"]))
+        fm = FileManagement(folder_path)
+        fm.renumber_img(first, 1)
+        fm.renumber_img(second, 1)
+        fm.close()
+        case_export = CaseExport(folder_path, export_path, "case", 0)
+        blocked = case_export.renames[0][0]
+        os.makedirs(blocked + ".rename/locked")
+        case_export.start()
+        errors = case_export.wait()
+        rmtree(blocked + ".rename")
+        expected = {os.path.basename(job[3]) for job in case_export.jobs}
+        exported = {name for name in os.listdir(export_path) if name.endswith(".png")}
+        print("blocked rename: {0} errors, {1} missing, {2} left over".format(
+            len(errors), len(expected - exported), len(exported - expected - {os.path.basename(blocked)})))
+        if len(errors) != 1 or expected - exported or exported - expected - {os.path.basename(blocked)}:
+            return 1
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+        rmtree(export_path, ignore_errors = True)
+    return 0
+
+def run_table_export(num_bodies = 100000):
+    """Times every table exporter and checks what they wrote against the case.
+
+    Peak memory is measured with tracemalloc, it should not grow with the case.
+    """
+    folder_path = make_synthetic_case(int(num_bodies))
+    export_path = tempfile.mkdtemp(prefix = "biondi_export_") + "/"
+    status = 0
+    try:
+        for table_format, table_exporter in table_exporters.items():
+            start = perf_counter()
+            table_exporter().export(folder_path, export_path, "case")
+            seconds = perf_counter() - start
+            # timed apart as tracemalloc slows the export down several times
+            tracemalloc.start()
+            table_exporter().export(folder_path, export_path, "case")
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("{0:>8}: {1:.2f} s, peak {2:.1f} MB".format(table_format, seconds, peak / 1000000))
+
+        with open(export_path + "case-bodies.csv", newline = "") as csv_file:
+            csv_rows = sum(1 for row in csv.reader(csv_file)) - 1
+        with open(export_path + "case-bodies.jsonl") as jsonl_file:
+            jsonl_rows = sum(1 for line in jsonl_file)
+        snapshot = sqlite3.connect(export_path + "case-snapshot.db")
+        snapshot_rows = snapshot.execute('''SELECT COUNT(*) FROM bodies''').fetchone()[0]
+        integrity = snapshot.execute('''PRAGMA integrity_check''').fetchone()[0]
+        snapshot.close()
+        print("rows: csv {0}, jsonl {1}, snapshot {2}, snapshot integrity {3}".format(
+            csv_rows, jsonl_rows, snapshot_rows, integrity))
+        if not csv_rows == jsonl_rows == snapshot_rows == int(num_bodies) or integrity != "ok":
+            status = 1
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+        rmtree(export_path, ignore_errors = True)
+    return status
+
+def _image_read_ms(folder_path, names):
+    """Returns the mean time in milliseconds to open and decode the named images of a case."""
+    fm = FileManagement(folder_path)
+    def read_all():
+        for name in names:
+            fm.open_image(name).load()
+    return _mean_ms(read_all, 3) / len(names)
+
+def run_image_store(num_bodies = 2000):
+    """Converts a case from loose files to a pack, compacts the pack and converts it back.
+
+    Prints the number of files in the case folder and the mean time to read an
+    image for both stores, and checks every image comes back byte for byte.
+    Also checks that a pack left by an interrupted compaction is removed when
+    the case is opened again and the committed pack still reads, and that the
+    conversions send "images" without piling up listeners on the case.
+    """
+    folder_path = make_synthetic_case(int(num_bodies))
+    status = 0
+    try:
+        add_synthetic_images(folder_path, (200, 150))
+        fm = FileManagement(folder_path)
+        fm.c.execute('''SELECT BODY_FILE_NAME, ANNOTATION_FILE_NAME FROM bodies''')
+        names = [name for row in fm.c.fetchall() for name in row]
+        fm.close()
+        loose = {name: open_image_store(folder_path).read(name) for name in names}
+        sample = random.Random(0).sample(names, min(len(names), 500))
+        events = []
+        DatabaseManager.subscribe(folder_path, events.append)
+        listeners = len(DatabaseManager._listeners[DatabaseManager.case_key(folder_path)])
+
+        for backend in ("loose", "packed", "packed", "loose"):
+            start = perf_counter()
+            convert_image_store(folder_path, backend)
+            seconds = perf_counter() - start
+            images = open_image_store(folder_path)
+            changed = sum(1 for name in names if images.read(name) != loose[name])
+            print("{0:>6}: converted in {1:.2f} s, {2} files in the case, {3:.3f} ms per read, {4} images changed".format(
+                backend, seconds, len(os.listdir(folder_path)), _image_read_ms(folder_path, sample), changed))
+            if changed or images.backend != backend:
+                status = 1
+
+            if backend == "packed":
+                # a compaction interrupted before its index was committed leaves only its new pack behind
+                stale_path = folder_path + pack_name(pack_generation(os.path.basename(images.pack_path)) + 1)
+                with open(stale_path, "wb") as stale_file:
+                    stale_file.write(images.read(names[0])[::-1])
+                DatabaseManager.close_case(folder_path)
+                images = open_image_store(folder_path)
+                changed = sum(1 for name in sample if images.read(name) != loose[name])
+                print("        interrupted compaction: stale pack removed {0}, {1} images changed".format(
+                    not os.path.exists(stale_path), changed))
+                if changed or os.path.exists(stale_path):
+                    status = 1
+                DatabaseManager.subscribe(folder_path, events.append)
+                listeners = len(DatabaseManager._listeners[DatabaseManager.case_key(folder_path)])
+
+        added = len(DatabaseManager._listeners[DatabaseManager.case_key(folder_path)]) - listeners
+        print("conversions announced: {0}, listeners added since the last open: {1}".format(events.count("images"), added))
+        # converting the loose case to loose again moves nothing and announces nothing
+        if events.count("images") != 3 or added:
+            status = 1
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+    return status
+
+def run_thumbnails(num_bodies = 300):
+    """Times making and reading thumbnails next to decoding the full images.
+
+    Also checks that a redrawn annotation gets a new thumbnail, that a new body
+    saved under the id of a deleted one does not show its thumbnail, that a broken
+    render does not stop the worker and that a small budget drops the least
+    recently used thumbnails first.
+    """
+    folder_path = make_synthetic_case(int(num_bodies))
+    status = 0
+    try:
+        add_synthetic_images(folder_path, (800, 600))
+        fm = FileManagement(folder_path)
+        fm.c.execute('''SELECT BODY_ID, BODY_FILE_NAME, ANNOTATION_FILE_NAME FROM bodies ORDER BY BODY_ID''')
+        bodies = fm.c.fetchall()
+        fm.close()
+        body_ids = [body[0] for body in bodies]
+
+        def decode_all():
+            fm = FileManagement(folder_path)
+            for body_id, body_file_name, annotation_file_name in bodies:
+                body_img = fm.open_image(body_file_name)
+                annotation_img = fm.open_image(annotation_file_name)
+                body_img.paste(annotation_img, (0, 0), annotation_img)
+
+        thumbnails = ThumbnailCache(folder_path)
+        start = perf_counter()
+        thumbnails.request(body_ids)
+        thumbnails.wait()
+        made = perf_counter() - start
+        full_ms = _mean_ms(decode_all, 1) / len(bodies)
+        cached_ms = _mean_ms(lambda: [thumbnails.get(body_id).load() for body_id in body_ids], 3) / len(bodies)
+        print("made {0} thumbnails in {1:.2f} s, {2:.1f} KB held".format(
+            len(thumbnails.ready()), made, thumbnails.total_bytes() / 1000))
+        print("per body: full images {0:.2f} ms, cached thumbnail {1:.3f} ms".format(full_ms, cached_ms))
+
+        old = thumbnails.get(body_ids[0]).tobytes()
+        FileManagement(folder_path).save_annotation(FileManagement(folder_path).get_body(body_ids[0]), 
+                                                    Image.new("RGBA", (800, 600), (0, 0, 255, 255)))
+        thumbnails.invalidate(body_ids[0])
+        thumbnails.request(body_ids[:1])
+        thumbnails.wait()
+        redrawn = thumbnails.get(body_ids[0]) is not None and thumbnails.get(body_ids[0]).tobytes() != old
+
+        # a body deleted and a new one saved under its id, which the thumbnails are not told about
+        reused = bodies[3]
+        old = thumbnails.get(reused[0]).tobytes()
+        images = open_image_store(folder_path)
+        images.save("reused.png", Image.new("RGB", (800, 600), (255, 0, 0)))
+        images.save("reused_annotation.png", Image.new("RGBA", (800, 600)))
+        conn = DatabaseManager.get_connection(folder_path)
+        with conn:
+            conn.execute('''UPDATE bodies SET BODY_FILE_NAME = ?, ANNOTATION_FILE_NAME = ? WHERE BODY_ID = ?''',
+                         ("reused.png", "reused_annotation.png", reused[0]))
+        stale_hidden = thumbnails.get(reused[0]) is None
+        thumbnails.request([reused[0]])
+        thumbnails.wait()
+        remade = thumbnails.get(reused[0]) is not None and thumbnails.get(reused[0]).tobytes() != old
+        print("reused body id: old thumbnail hidden {0}, new one made {1}".format(stale_hidden, remade))
+        if not (stale_hidden and remade):
+            status = 1
+
+        # a render PIL refuses to open must not stop the thumbnails after it
+        thumbnails.ready()
+        broken, after = bodies[1], bodies[2]
+        open_image_store(folder_path).write(render_name(broken[1]), _bomb_png())
+        thumbnails.invalidate(broken[0])
+        thumbnails.invalidate(after[0])
+        thumbnails.request([broken[0], after[0]])
+        thumbnails.wait()
+        announced = thumbnails.ready()
+        print("thumbnail after a broken render: {0}, both announced: {1}, {2} errors recorded".format(
+            thumbnails.get(after[0]) is not None, announced == [broken[0], after[0]], len(thumbnails.errors)))
+        if thumbnails.get(after[0]) is None or announced != [broken[0], after[0]] or len(thumbnails.errors) != 1:
+            status = 1
+        thumbnails.close()
+
+        # reopened with room for about a tenth of the thumbnails
+        thumbnails = ThumbnailCache(folder_path, budget = thumbnails.total_bytes() // 10)
+        thumbnails.get(body_ids[0])
+        thumbnails.request(body_ids[-1:])
+        thumbnails.invalidate(body_ids[-1])
+        thumbnails.request(body_ids[-1:])
+        thumbnails.wait()
+        kept = [body_id for body_id in body_ids if thumbnails.conn.execute(
+            '''SELECT 1 FROM thumbnails WHERE BODY_ID = ?''', (body_id,)).fetchone()]
+        within_budget = thumbnails.total_bytes() <= thumbnails.budget
+        print("redrawn annotation made a new thumbnail: {0}, {1} kept within the budget: {2}, "
+              "recently used kept: {3}".format(redrawn, len(kept), within_budget,
+                                               body_ids[0] in kept and body_ids[-1] in kept))
+        if not (redrawn and within_budget and body_ids[0] in kept and body_ids[-1] in kept):
+            status = 1
+        thumbnails.close()
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+    return status
+
+def make_large_gridfile(path, size, band_height = 512):
+    """Writes a size by size jpeg gridfile without holding it in memory.
+
+    The pixels are written a band at a time into a temporary file, which the
+    jpeg encoder reads through a memory map.
+    """
+    gradient = Image.linear_gradient("L").resize((size, band_height))
+    with tempfile.TemporaryFile(dir = os.path.dirname(path)) as raw_file:
+        for y in range(0, size, band_height):
+            rows = min(band_height, size - y)
+            band = Image.merge("RGB", (gradient, Image.new("L", gradient.size, y * 255 // size), gradient))
+            raw_file.write(band.crop((0, 0, size, rows)).convert("RGBX").tobytes())
+        raw_file.flush()
+        pixels = mmap.mmap(raw_file.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            Image.frombuffer("RGBX", (size, size), pixels, "raw", "RGBX", 0, 1).save(path, format = "JPEG", quality = 90)
+        finally:
+            pixels.close()
+
+def _build_pyramid(folder_path):
+    TilePyramid.build(folder_path)
+
+def _open_viewport(folder_path, viewport = (1600, 900)):
+    """Opens a pyramid and decodes the tiles of a viewport in the middle of level 0."""
+    pyramid = TilePyramid(folder_path)
+    x0, y0 = pyramid.width // 2, pyramid.height // 2
+    for col, row in pyramid.tiles_in(0, x0, y0, x0 + viewport[0], y0 + viewport[1]):
+        pyramid.tile(0, col, row).load()
+    pyramid.close()
+
+def _open_whole(folder_path):
+    """Decodes the whole gridfile, which is what opening a case took before the pyramid."""
+    open_gridfile(folder_path + "gridfile.jpg").load()
+
+def _timed_in_child(func, *args):
+    """Runs func in this process and returns its run time in seconds and the peak memory in MB."""
+    import resource
+    start = perf_counter()
+    func(*args)
+    seconds = perf_counter() - start
+    return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000
+
+def _timed(func, *args):
+    """Runs func in a fresh process so its peak memory is not mixed with anything else."""
+    with ProcessPoolExecutor(1, multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_timed_in_child, func, *args).result()
+
+def run_tile_pyramid(size = 40000):
+    """Builds the tile pyramid of a size by size gridfile and times opening a viewport of it.
+
+    The gridfile is a jpeg like the one every case keeps. Decoding the whole
+    gridfile the way cases used to open is only measured when it fits in about
+    a gigabyte. Also checks the bands the pyramid is cut from match a whole
+    decode. Peak memory is read with the resource module so this benchmark
+    needs Linux or macOS.
+    """
+    size = int(size)
+    folder_path = tempfile.mkdtemp(prefix = "biondi_tiles_") + "/"
+    status = 0
+    try:
+        make_large_gridfile(folder_path + "small.jpg", 1500)
+        whole = open_gridfile(folder_path + "small.jpg").convert("RGB")
+        same = all(band.tobytes() == whole.crop((0, i * 512, whole.width, i * 512 + band.height)).tobytes()
+                   for i, band in enumerate(read_bands(folder_path + "small.jpg", 512)))
+        print("bands of a jpeg match a whole decode: {0}".format(same))
+        if not same:
+            status = 1
+
+        # written in a child too, the peak memory of a process carries over to the children it starts
+        seconds, peak = _timed(make_large_gridfile, folder_path + "gridfile.jpg", size)
+        print("wrote a {0}x{0} jpeg gridfile of {1:.1f} MB in {2:.1f} s".format(
+            size, os.path.getsize(folder_path + "gridfile.jpg") / 1e6, seconds))
+
+        seconds, peak = _timed(_build_pyramid, folder_path)
+        pyramid = TilePyramid(folder_path)
+        tiles = pyramid.conn.execute('''SELECT COUNT(*) FROM tiles''').fetchone()[0]
+        levels = pyramid.levels
+        pyramid.close()
+        print("build: {0:.1f} s, peak {1:.0f} MB, {2} tiles on {3} levels, {4:.1f} MB".format(
+            seconds, peak, tiles, levels, os.path.getsize(folder_path + "gridtiles.db") / 1e6))
+
+        seconds, peak = _timed(_open_viewport, folder_path)
+        print("open a 1600x900 viewport: {0:.3f} s, peak {1:.0f} MB".format(seconds, peak))
+
+        whole_mb = size * size * 3 / 1e6
+        if whole_mb <= 1000:
+            seconds, peak = _timed(_open_whole, folder_path)
+            print("decode the whole gridfile: {0:.3f} s, peak {1:.0f} MB".format(seconds, peak))
+        else:
+            print("decode the whole gridfile: skipped, it needs {0:.0f} MB before Tk copies it".format(whole_mb))
+    finally:
+        rmtree(folder_path, ignore_errors = True)
+    return status
+
+def run_minimap(sizes = "2000,8000,32000"):
+    """Times making the minimap overview from the pyramids of gridfiles of several sizes.
+
+    The time should stay the same however large the gridfile is.
+    """
+    for size in [int(size) for size in sizes.split(",")]:
+        folder_path = tempfile.mkdtemp(prefix = "biondi_tiles_") + "/"
+        try:
+            _timed(make_large_gridfile, folder_path + "gridfile.jpg", size)
+            _timed(_build_pyramid, folder_path)
+            pyramid = TilePyramid(folder_path)
+            overview_ms = _mean_ms(lambda: pyramid.overview(config.minimap_size))
+            print("{0}x{0}: overview {1:.2f} ms, {2}".format(size, overview_ms, pyramid.overview(config.minimap_size).size))
+            pyramid.close()
+        finally:
+            rmtree(folder_path, ignore_errors = True)
+    return 0
+
+def run_markers(sizes = "5000,50000", extent = 40000, viewport = (1600, 900)):
+    """Times the marker index next to scanning every marker, on gridfiles of random markers.
+
+    Compares what the MarkerLayer does on every scroll, finding the markers in
+    view, and on every click, finding the marker under the mouse. Fails if the
+    index and the scan do not find the same markers.
+    """
+    status = 0
+    extent = int(extent)
+    margin = config.marker_cell_size
+    for size in [int(size) for size in sizes.split(",")]:
+        points = {("m", i): (random.uniform(0, extent), random.uniform(0, extent)) for i in range(size)}
+        start = perf_counter()
+        index = SpatialIndex(config.marker_cell_size)
+        for key, (x, y) in points.items():
+            index.insert(key, x, y)
+        build_ms = (perf_counter() - start) * 1000
+
+        views = [(random.uniform(0, extent - viewport[0]), random.uniform(0, extent - viewport[1])) for i in range(20)]
+        regions = [(x - margin, y - margin, x + viewport[0] + margin, y + viewport[1] + margin) for x, y in views]
+        def scan(x0, y0, x1, y1):
+            return [key for key, (x, y) in points.items() if x0 <= x <= x1 and y0 <= y <= y1]
+        for region in regions:
+            if set(index.query(*region)) != set(scan(*region)):
+                print("{0}: the index and the scan found different markers in view".format(size))
+                status = 1
+        query_ms = _mean_ms(lambda: [index.query(*region) for region in regions]) / len(regions)
+        scan_ms = _mean_ms(lambda: [scan(*region) for region in regions], repeat = 3) / len(regions)
+        drawn = statistics.mean(len(index.query(*region)) for region in regions)
+
+        clicks = [points[("m", random.randrange(size))] for i in range(20)]
+        radius = config.marker_hit_radius
+        def scan_nearest(cx, cy):
+            return min(((x - cx) ** 2 + (y - cy) ** 2, key) for key, (x, y) in points.items())[1]
+        for x, y in clicks:
+            if index.nearest(x, y, radius)[0][1] != scan_nearest(x, y):
+                print("{0}: the index and the scan found different markers under a click".format(size))
+                status = 1
+        click_ms = _mean_ms(lambda: [index.nearest(x, y, radius) for x, y in clicks]) / len(clicks)
+        scan_click_ms = _mean_ms(lambda: [scan_nearest(x, y) for x, y in clicks], repeat = 3) / len(clicks)
+
+        print("{0} markers: index built in {1:.0f} ms, {2:.0f} drawn per view instead of {0}".format(size, build_ms, drawn))
+        print("    in view: {0:.3f} ms, scan {1:.2f} ms".format(query_ms, scan_ms))
+        print("    click: {0:.3f} ms, scan {1:.2f} ms".format(click_ms, scan_click_ms))
+    return status
+
+def run_marker_overlay(counts = "500,2000,8000", viewport = (1600, 900)):
+    """Times drawing a view of markers into the single overlay image MarkerLayer uses when they are dense.
+
+    The time should grow slowly with the number of markers, where the canvas
+    would otherwise hold a text item for each of them.
+    """
+    margin = config.marker_cell_size
+    region = (-margin, -margin, viewport[0] + margin, viewport[1] + margin)
+    for count in [int(count) for count in counts.split(",")]:
+        markers = [(random.uniform(*region[0::2]), random.uniform(*region[1::2]),
+                    config.body_index[random.choice(config.all_bodies)], 18, "white") for i in range(count)]
+        overlay_ms = _mean_ms(lambda: marker_overlay(markers, region), repeat = 5)
+        print("{0} markers in view: overlay {1:.1f} ms, one canvas item instead of {0}".format(count, overlay_ms))
+    return 0
+
+def run_marker_filter(num_bodies = 10000):
+    """Times toggling a marker filter in memory the way MarkerLayer.show_only does next to querying it.
+
+    Every body of a synthetic case is read once with iter_markers_pages and
+    each filter is checked against all of them, the most a toggle can touch.
+    Fails if a filter keeps different bodies than query_images.
+    """
+    status = 0
+    folder_path = make_synthetic_case(int(num_bodies))
+    try:
+        bodies = {}
+        for page, token in FileManagement(folder_path).iter_markers_pages():
+            for body_id, time_added, body_name, flags, x, y in page:
+                bodies[body_id] = (body_name, flags)
+        filters = [(config.all_bodies, False, False, False, False),
+                   (config.all_bodies[:1], False, False, False, False),
+                   (config.all_bodies[1:], True, False, False, False),
+                   (config.all_bodies, False, True, True, False)]
+        for params in filters:
+            body_filter = make_body_filter(*params)
+            kept = set(body_id for body_id, body in bodies.items() if passes_body_filter(body_filter, *body))
+            queried = set(row[0] for row in FileManagement(folder_path).query_images(*params))
+            if kept != queried:
+                print("{0}: kept {1} bodies, the query returns {2}".format(params[1:], len(kept), len(queried)))
+                status = 1
+            def toggle():
+                body_filter = make_body_filter(*params)
+                return [body_id for body_id, body in bodies.items() if passes_body_filter(body_filter, *body)]
+            toggle_ms = _mean_ms(toggle)
+            query_ms = _mean_ms(lambda: FileManagement(folder_path).query_images(*params), repeat = 5)
+            print("{0} types {1}: toggle {2:.2f} ms, query {3:.2f} ms, {4} kept".format(
+                len(params[0]), params[1:], toggle_ms, query_ms, len(kept)))
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+    return status
+
+def run_body_table(num_bodies = 100000):
+    """Times the filters of the in memory body table next to the same queries and compares them.
+
+    Also prints the memory the table holds next to a dict per body from
+    convert_tuple, and checks the table written through by saves, edits,
+    deletes and renumbering still matches the database.
+    """
+    status = 0
+    folder_path = make_synthetic_case(int(num_bodies))
+    try:
+        start = perf_counter()
+        table = open_body_table(folder_path)
+        loaded = perf_counter() - start
+        tracemalloc.start()
+        fm = FileManagement(folder_path)
+        fm.c.execute('''SELECT {0} FROM bodies AS b JOIN body_types AS t ON t.TYPE_ID = b.TYPE_ID'''.format(
+            fm.body_columns))
+        dicts = [fm.convert_tuple(row) for row in fm.c.fetchall()]
+        dict_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del dicts
+        print("{0} bodies: loaded in {1:.0f} ms, {2:.1f} MB of columns, {3:.1f} MB as dicts".format(
+            len(table), loaded * 1000, table.nbytes() / 1000000, dict_bytes / 1000000))
+
+        filters = [(config.all_bodies, False, False, False, False),
+                   (config.all_bodies[:1], False, False, False, False),
+                   (config.all_bodies[1:], True, False, False, False),
+                   (config.all_bodies, False, True, True, False)]
+        def compare(label):
+            matches = True
+            for params in filters:
+                if (table.query_images(*params) != FileManagement(folder_path).query_images(*params)
+                        or table.count(*params) != FileManagement(folder_path).count_bodies(*params)):
+                    print("{0} {1}: the table does not match the database".format(label, params[1:]))
+                    matches = False
+            markers = [row for page, token in table.iter_markers_pages() for row in page]
+            if markers != [row for page, token in FileManagement(folder_path).iter_markers_pages() for row in page]:
+                print("{0}: the markers do not match the database".format(label))
+                matches = False
+            return matches
+
+        for params in filters:
+            count_ms = _mean_ms(lambda: table.count(*params))
+            sql_count_ms = _mean_ms(lambda: FileManagement(folder_path).count_bodies(*params))
+            page_ms = _mean_ms(lambda: table.query_images_page(*params))
+            sql_page_ms = _mean_ms(lambda: FileManagement(folder_path).query_images_page(*params))
+            query_ms = _mean_ms(lambda: table.query_images(*params), repeat = 5)
+            sql_query_ms = _mean_ms(lambda: FileManagement(folder_path).query_images(*params), repeat = 5)
+            print("{0} types {1}: count {2:.2f} / {3:.2f} ms, first page {4:.2f} / {5:.2f} ms, "
+                  "every body {6:.1f} / {7:.1f} ms (table / query)".format(
+                len(params[0]), params[1:], count_ms, sql_count_ms, page_ms, sql_page_ms, query_ms, sql_query_ms))
+        if not compare("loaded"):
+            status = 1
+
+        first, second = config.all_bodies[:2]
+        for i in range(20):
+            body_info = FileManagement(folder_path).get_body(i + 1)
+            body_info["time"] = 1700000000 + i
+            FileManagement(folder_path).save_image(body_info, Image.new("RGB", (4, 4)), Image.new("RGBA", (4, 4)))
+            edited = FileManagement(folder_path).get_body(i + 100)
+            FileManagement(folder_path).edit_info(((first, second)[i % 2], i % 3 == 0, i % 5 == 0, False, True,
+                                                   "edited", None, None, None, None, edited["body_id"]))
+        for i in range(10):
+            FileManagement(folder_path).delete_img(first, 1)
+            FileManagement(folder_path).renumber_img(second, 1)
+        if not compare("written through"):
+            status = 1
+        print("written through: {0}".format("matches the database" if status == 0 else "differs"))
+
+        # bodies on a later page that change while the markers are being streamed
+        pages = table.iter_markers_pages()
+        page, token = next(pages)
+        oldest = [row[0] for rows, after in table.iter_markers_pages() for row in rows][-2:]
+        edited = FileManagement(folder_path).get_body(oldest[1])
+        relabel = second if edited["body_name"] != second else first
+        FileManagement(folder_path).edit_info((relabel, False, False, False, False, edited["notes"],
+                                               None, None, None, None, edited["body_id"]))
+        fm = FileManagement(folder_path)
+        fm.renumber_img(edited["body_name"], 1)
+        fm.renumber_img(relabel, 1)
+        fm.close()
+        deleted = FileManagement(folder_path).get_body(oldest[0])
+        FileManagement(folder_path).delete_img(deleted["body_name"], deleted["body_number"])
+        streamed = {row[0]: row for page, token in pages for row in page}
+        current = deleted["body_id"] not in streamed and streamed[edited["body_id"]][2] == relabel
+        print("markers streamed while bodies change: {0}".format("current" if current else "stale"))
+        if not current:
+            status = 1
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+    return status
+
+def run_body_list(sizes = "10000,100000", viewport_height = 700):
+    """Times making the rows of the ImageViewer body list, in order and grouped by type.
+
+    Only the rows in view are drawn, so the rows are the only part of the list
+    that grows with the case, next to the number of slots a view needs.
+    """
+    for size in [int(size) for size in sizes.split(",")]:
+        numbers = {}
+        bodies = []
+        for body_id in range(size):
+            name = random.choice(config.all_bodies)
+            numbers[name] = numbers.get(name, 0) + 1
+            bodies.append((body_id, name, numbers[name]))
+        listed_ms = _mean_ms(lambda: body_list_rows(bodies, False), repeat = 5)
+        grouped_ms = _mean_ms(lambda: body_list_rows(bodies, True), repeat = 5)
+        print("{0} bodies: rows {1:.1f} ms, grouped {2:.1f} ms, {3} slots drawn instead of {0} buttons".format(
+            size, listed_ms, grouped_ms, viewport_height // BodyList.row_height + 1))
+    return 0
+
+def _bomb_png(size = 100000):
+    """Returns an empty png that claims to be size pixels square.
+
+    Opening it raises PIL.Image.DecompressionBombError, an error that is not
+    an OSError.
+    """
+    def chunk(kind, data):
+        return len(data).to_bytes(4, "big") + kind + data + zlib.crc32(kind + data).to_bytes(4, "big")
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", size.to_bytes(4, "big") * 2 + bytes((8, 2, 0, 0, 0)))
+            + chunk(b"IDAT", b"") + chunk(b"IEND", b""))
+
+def run_body_cache(num_bodies = 200, steps = 50, think_ms = 100, size = (1200, 900)):
+    """Times stepping through the bodies of a case the way a review in the ImageViewer does.
+
+    Each step opens the next body in the list and waits think_ms, the time the
+    annotator looks at it, while the body after it is read ahead. Opening reads
+    the row and decodes both images, without the cache every time. Also checks
+    the read ahead goes on after a deleted body and a render PIL refuses to open.
+    """
+    folder_path = make_synthetic_case(int(num_bodies))
+    status = 0
+    try:
+        add_synthetic_images(folder_path, size)
+        body_ids = [row[0] for row in FileManagement(folder_path).query_images(config.all_bodies, False, False, False, False)]
+        body_ids = body_ids[:int(steps)]
+
+        def uncached(body_id):
+            body_info = FileManagement(folder_path).get_body(body_id)
+            for file_name in (body_info["body_file_name"], body_info["annotation_file_name"]):
+                FileManagement(folder_path).open_image(file_name).load()
+
+        uncached_ms = []
+        for body_id in body_ids:
+            start = perf_counter()
+            uncached(body_id)
+            uncached_ms.append((perf_counter() - start) * 1000)
+            sleep(float(think_ms) / 1000)
+
+        bodies = BodyCache(folder_path)
+        step_ms = []
+        for i, body_id in enumerate(body_ids):
+            start = perf_counter()
+            bodies.get(body_id)
+            step_ms.append((perf_counter() - start) * 1000)
+            bodies.prefetch(body_ids[i + 1:i + 2] + body_ids[max(i - 1, 0):i])
+            sleep(float(think_ms) / 1000)
+        back_ms = _mean_ms(lambda: bodies.get(body_ids[-2]))
+        print("{0} steps through {1}x{2} bodies, {3} ms each:".format(len(body_ids), size[0], size[1], think_ms))
+        print("    uncached: median {0:.1f} ms".format(statistics.median(uncached_ms)))
+        print("    cached: median {0:.2f} ms, first {1:.1f} ms, back to the last body {2:.3f} ms, {3:.0f} MB held".format(
+            statistics.median(step_ms), step_ms[0], back_ms, bodies.total_bytes() / 1024 / 1024))
+
+        bodies.invalidate()
+        broken = FileManagement(folder_path).get_body(body_ids[0])
+        open_image_store(folder_path).write(render_name(broken["body_file_name"]), _bomb_png())
+        bodies.prefetch([int(num_bodies) + 1, broken["body_id"], body_ids[1]])
+        bodies.wait()
+        print("    read ahead after a deleted body and a broken render: {0}, {1} errors recorded".format(
+            bodies.contains(body_ids[1]), len(bodies.errors)))
+        if not bodies.contains(body_ids[1]) or len(bodies.errors) != 1:
+            status = 1
+        bodies.close()
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+    return status
+
+def run_renders(num_bodies = 50, size = (800, 600)):
+    """Times reading and exporting bodies from their renders next to compositing their two images.
+
+    The case is made without renders, like one saved before they were kept, so
+    the first open_render of every body makes its render. Also checks a render
+    matches its images, keeps the alpha of a body image that has one, follows a
+    redrawn annotation and is removed with its body.
+    """
+    folder_path = make_synthetic_case(int(num_bodies))
+    export_path = tempfile.mkdtemp(prefix = "biondi_export_") + "/"
+    status = 0
+    try:
+        add_synthetic_images(folder_path, size, renders = False)
+        bodies = [FileManagement(folder_path).get_body(row[0]) for row in FileManagement(folder_path).query_images(config.all_bodies, False, False, False, False)]
+        images = open_image_store(folder_path)
+
+        def composite_all():
+            for body_info in bodies:
+                render_images(images.open(body_info["body_file_name"]), images.open(body_info["annotation_file_name"]))
+
+        def render_all():
+            for body_info in bodies:
+                FileManagement(folder_path).open_render(body_info["body_file_name"], body_info["annotation_file_name"]).load()
+
+        composite_ms = _mean_ms(composite_all, 1) / len(bodies)
+        start = perf_counter()
+        render_all()
+        made_ms = (perf_counter() - start) * 1000 / len(bodies)
+        render_ms = _mean_ms(render_all, 1) / len(bodies)
+        print("per body: both images composited {0:.1f} ms, render made {1:.1f} ms, render read {2:.1f} ms".format(
+            composite_ms, made_ms, render_ms))
+
+        jobs = FileManagement(folder_path).export_jobs(export_path, "case")
+        start = perf_counter()
+        for job in jobs:
+            merge_images(*job[1:4])
+        merged_ms = (perf_counter() - start) * 1000 / len(jobs)
+        start = perf_counter()
+        for job in jobs:
+            merge_images(*job[1:])
+        copied_ms = (perf_counter() - start) * 1000 / len(jobs)
+        print("per exported image: composited {0:.1f} ms, render copied {1:.2f} ms".format(merged_ms, copied_ms))
+
+        body_info = bodies[0]
+        file_names = (body_info["body_file_name"], body_info["annotation_file_name"])
+        expected = render_images(images.open(file_names[0]), images.open(file_names[1]))
+        matches = FileManagement(folder_path).open_render(*file_names).tobytes() == expected.tobytes()
+        new_name = [job[3] for job in jobs if job[0] == body_info["body_id"]][0]
+        exported = Image.open(new_name).tobytes() == expected.tobytes()
+        FileManagement(folder_path).save_annotation(body_info, Image.new("RGBA", size, (0, 0, 255, 255)))
+        redrawn = FileManagement(folder_path).open_render(*file_names).getpixel((0, 0)) == (0, 0, 255)
+        print("render matches the images: {0}, exported image matches: {1}, follows a redrawn annotation: {2}".format(
+            matches, exported, redrawn))
+        if not (matches and exported and redrawn and images.exists(render_name(file_names[0]))):
+            status = 1
+
+        # the merged image of the first versions pasted the annotation onto the body in its own mode
+        body_img = Image.new("RGBA", size, (10, 20, 30, 128))
+        annotation_img = Image.new("RGBA", size)
+        annotation_img.paste((255, 0, 0, 255), (0, 0, 10, 10))
+        merged = body_img.copy()
+        merged.paste(annotation_img, (0, 0), annotation_img)
+        render = render_images(body_img, annotation_img)
+        alpha_kept = render.mode == merged.mode and render.tobytes() == merged.tobytes()
+
+        FileManagement(folder_path).delete_img(body_info["body_name"], body_info["body_number"])
+        removed = not images.exists(render_name(file_names[0])) and images.exists(file_names[0])
+        print("render of an RGBA body matches the merged image: {0}, render removed with its body: {1}".format(
+            alpha_kept, removed))
+        if not (alpha_kept and removed):
+            status = 1
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+        rmtree(export_path, ignore_errors = True)
+    return status
+
+# modules the client must not load before they are first used
+lazy_modules = ("pyautogui", "screenshot", "image_viewer", "exporter", "thumbnail_cache", "body_cache",
+                "body_table", "numpy", "tkinter.colorchooser", "PIL.ImageFont", "concurrent.futures.process")
+
+first_window_script = '''
+import sys
+from time import perf_counter
+start = perf_counter()
+import tkinter as tk
+import biondi_body_client
+root = tk.Tk()
+biondi_body_client.root = root
+biondi_body_client.Application(root, path = sys.argv[1])
+root.update()
+print(perf_counter() - start)
+'''
+
+def _import_times():
+    """Imports the client in a fresh interpreter and returns the cumulative microseconds of every module."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import biondi_body_client"],
+                            stderr = subprocess.PIPE, universal_newlines = True, cwd = os.path.dirname(os.path.abspath(__file__)))
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line and "cumulative" not in line:
+            own, cumulative, name = line[len("import time:"):].split("|")
+            times[name.strip()] = int(cumulative)
+    if result.returncode != 0:
+        print(result.stderr.splitlines()[-1])
+    return times
+
+def run_startup(import_budget_ms = 150, window_budget_ms = 1500, repeat = 5):
+    """Checks the client starts within a time budget without loading what it does not need.
+
+    The import time is the median of several fresh interpreters. The time to the
+    first window opens a synthetic case the way the program does and runs under
+    xvfb-run when there is no display. It is skipped when there is neither.
+    Fails if either budget is exceeded or one of lazy_modules was imported.
+    """
+    status = 0
+    runs = [_import_times() for i in range(int(repeat))]
+    import_ms = statistics.median(run.get("biondi_body_client", 0) for run in runs) / 1000
+    slowest = sorted(runs[-1].items(), key = lambda item: item[1], reverse = True)[1:6]
+    loaded = [name for name in lazy_modules if name in runs[-1]]
+    print("import: {0:.1f} ms, budget {1} ms".format(import_ms, import_budget_ms))
+    print("slowest: " + ", ".join("{0} {1:.1f} ms".format(name, us / 1000) for name, us in slowest))
+    print("loaded before first use: {0}".format(", ".join(loaded) or "none"))
+    if "biondi_body_client" not in runs[-1] or import_ms > float(import_budget_ms) or loaded:
+        status = 1
+
+    command = [sys.executable, "-c", first_window_script]
+    if not os.environ.get("DISPLAY"):
+        if shutil.which("xvfb-run") is None:
+            print("first window: skipped, there is no display and xvfb-run is not installed")
+            return status
+        command = ["xvfb-run", "-a"] + command
+    folder_path = make_synthetic_case(1000)
+    try:
+        result = subprocess.run(command + [folder_path.rstrip("/")], stdout = subprocess.PIPE,
+                                universal_newlines = True, cwd = os.path.dirname(os.path.abspath(__file__)))
+        if result.returncode != 0:
+            print("first window: failed to open")
+            return 1
+        window_ms = float(result.stdout.split()[-1]) * 1000
+        print("first window: {0:.0f} ms, budget {1} ms".format(window_ms, window_budget_ms))
+        if window_ms > float(window_budget_ms):
+            status = 1
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+    return status
+
+viewer_clicks_script = '''
+import sys
+import statistics
+from time import perf_counter
+import tkinter as tk
+import biondi_body_client
+from image_viewer import ImageViewer, open_image_viewer
+root = tk.Tk()
+biondi_body_client.root = root
+app = biondi_body_client.Application(root, path = sys.argv[1])
+root.update()
+body_ids = [int(body_id) for body_id in sys.argv[2].split(",")]
+
+def click(open_viewer, body_id):
+    start = perf_counter()
+    open_viewer(app.folder_path, app.marker_canvas).open_file(body_id)
+    root.update()
+    return perf_counter() - start
+
+def count_widgets(widget):
+    return 1 + sum(count_widgets(child) for child in widget.winfo_children())
+
+reused = [click(open_image_viewer, body_id) for body_id in body_ids[:1]]
+widgets = count_widgets(root)
+reused += [click(open_image_viewer, body_id) for body_id in body_ids[1:]]
+# the information panel is updated in place, so later clicks make no widgets
+made = count_widgets(root) - widgets
+windows = [click(ImageViewer, body_id) for body_id in body_ids]
+print(made, reused[0], statistics.median(reused[1:]), statistics.median(windows))
+'''
+
+def run_viewer_clicks(num_bodies = 2000, clicks = 20):
+    """Times opening bodies from their markers with the shared ImageViewer next to a new window per click.
+
+    Each click is timed until Tk has drawn the body, and the clicks on the
+    shared viewer must not make any widgets. Runs under xvfb-run when there is
+    no display and is skipped when there is neither.
+    """
+    command = [sys.executable, "-c", viewer_clicks_script]
+    if not os.environ.get("DISPLAY"):
+        if shutil.which("xvfb-run") is None:
+            print("viewer clicks: skipped, there is no display and xvfb-run is not installed")
+            return 0
+        command = ["xvfb-run", "-a"] + command
+    folder_path = make_synthetic_case(int(num_bodies))
+    try:
+        add_synthetic_images(folder_path)
+        rows = FileManagement(folder_path).query_images(config.all_bodies, False, False, False, False)
+        body_ids = [str(row[0]) for row in random.sample(rows, int(clicks))]
+        result = subprocess.run(command + [folder_path.rstrip("/"), ",".join(body_ids)], stdout = subprocess.PIPE,
+                                universal_newlines = True, cwd = os.path.dirname(os.path.abspath(__file__)))
+        if result.returncode != 0:
+            print("viewer clicks: failed to open")
+            return 1
+        made = int(result.stdout.split()[-4])
+        first, reused, windows = [float(value) * 1000 for value in result.stdout.split()[-3:]]
+        print("first click: {0:.0f} ms, later clicks: {1:.0f} ms, a new window per click: {2:.0f} ms".format(
+            first, reused, windows))
+        print("widgets made by the later clicks: {0}".format(made))
+        if made != 0:
+            return 1
+    finally:
+        DatabaseManager.close_case(folder_path)
+        rmtree(folder_path, ignore_errors = True)
+    return 0
+
+commands = {"query_plans": run_query_plan_check,
+            "write_latency": run_write_latency,
+            "schema_size": run_schema_size,
+            "renumber": run_renumber,
+            "counters": run_counter_check,
+            "rebuild_counters": run_rebuild_counters,
+            "notifications": run_notification_check,
+            "paging": run_paging,
+            "export": run_export,
+            "incremental_export": run_incremental_export,
+            "table_export": run_table_export,
+            "image_store": run_image_store,
+            "thumbnails": run_thumbnails,
+            "tile_pyramid": run_tile_pyramid,
+            "minimap": run_minimap,
+            "markers": run_markers,
+            "marker_overlay": run_marker_overlay,
+            "marker_filter": run_marker_filter,
+            "body_table": run_body_table,
+            "body_list": run_body_list,
+            "body_cache": run_body_cache,
+            "renders": run_renders,
+            "startup": run_startup,
+            "viewer_clicks": run_viewer_clicks}
+
+def main(args):
+    if not args or args[0] not in commands:
+        print("usage: python benchmarks.py [{0}]".format("|".join(commands)))
+        return 2
+    return commands[args[0]](*args[1:])
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,11 +1,13 @@
 import tkinter as tk
-from tkinter import filedialog
-from PIL import Image, ImageTk
+from tkinter import filedialog, ttk, messagebox
+from PIL import ImageTk
 from math import floor
+import os
 import sys
-from image_viewer import ImageViewer
 from file_management import FileManagement
-from markings import GridMark, Marker, GridIgnored
+from database_manager import DatabaseManager
+from markings import MarkerLayer, Marker
+from tile_pyramid import open_tile_pyramid, TileRenderer
 import config
 
 class Application(tk.Frame):
@@ -24,6 +26,7 @@ class Application(tk.Frame):
             mousex and mouse y vars.
         body_count (tk.IntVar): Number of biondi bodies saved.
         body_count_label (tk.Label): Displays the number of biondi bodies saved.
+        count_after (str): The after_idle id of a pending body count update, None if there is none.
         canvas (tk.Canvas): Used to hold and display the image.
         marker_canvas (tk.Canvas): A copy of canvas; used to store and display the clickable grid markings.
         grid_canvas (tk.Canvas): A copy of canvas; used to store and display the 7x7 grid overlay.
@@ -32,7 +35,10 @@ class Application(tk.Frame):
         path (str: The inputed used folder path directory).
         folder_path (str): Path with a slash added. This is so we can access different components in the folder easier
             (don't have to re add slash every time).
-        image (PIL Image): The image object to which the gridfile image is assigned to.
+        pyramid (TilePyramid): The gridfile image cut into tiles, built on the first open of the case.
+        renderer (TileRenderer): Shows the tiles of the part of the image in view.
+        minimap (Minimap): The overview of the whole image next to canvas.
+        marker_layer (MarkerLayer): The body and ignored markers, only the ones in view are drawn.
         width (int): The width of the image.
         height (int): The height of the image.
         container (tkinter rectangle): Used to enclose the image; allows scrolling on the canvas.
@@ -76,7 +82,8 @@ class Application(tk.Frame):
             close_button.grid(row = 3, column = 0, sticky = 's')
         self.body_count_label = tk.Label(self.master, text = "{0} Bodies Annotated".format(self.body_count.get()))
         self.body_count_label.grid(row = 3, column = 0 , sticky = "se")
-        self.update_count()
+        self.count_after = None
+        DatabaseManager.subscribe(self.folder_path, self.on_case_event)
         
         # Create canvas and put image on it
         self.canvas = tk.Canvas(self.master, highlightthickness=0)
@@ -93,7 +100,10 @@ class Application(tk.Frame):
         hbar = tk.Scrollbar(self.master, orient='horizontal', command = self.canvas.xview)
         vbar.grid(row=1, column=1, sticky='ns')
         hbar.grid(row=2, column=0, sticky='we')
-        self.canvas.configure(xscrollcommand = hbar.set, yscrollcommand = vbar.set, xscrollincrement = '2', yscrollincrement = '2')
+        # the tiles in view are updated whenever the canvas scrolls
+        self.canvas.configure(xscrollcommand = lambda *args: self.on_scroll(hbar, *args), 
+                              yscrollcommand = lambda *args: self.on_scroll(vbar, *args), 
+                              xscrollincrement = '2', yscrollincrement = '2')
         self.canvas.update()
 
         
@@ -108,8 +118,11 @@ class Application(tk.Frame):
         self.canvas.bind('<Motion>', self.update_coords)
 
 
-        self.image = Image.open(self.folder_path + "gridfile.jpg")  # open image
-        self.width, self.height = self.image.size
+        self.pyramid = open_tile_pyramid(self.folder_path)
+        self.width, self.height = self.pyramid.width, self.pyramid.height
+        self.renderer = None
+        self.minimap = None
+        self.marker_layer = None
 
         self.container = self.canvas.create_rectangle(0, 0, self.width, self.height, width=0)
 
@@ -131,6 +144,11 @@ class Application(tk.Frame):
         grid_window = GridWindow(self.master, self.canvas, self.folder_path, self.width, self.height)
         grid_window.grid(row = 4, column = 0)
         
+        #minimap
+        self.minimap = Minimap(self.master, self.canvas, self.folder_path, self.pyramid)
+        self.minimap.grid(row = 1, column = 2, sticky = 'n')
+        self.minimap.show_viewport()
+        
     def create_grid(self):
         """Creates the grid overlay.
         
@@ -171,33 +189,44 @@ class Application(tk.Frame):
     def initiate_markers(self):
         """Initializes marker info in FileManagment.
     
-        Creates a marker for every body on the application's startup. Iterates
-        through the bodies in the database to do so. Also creates a marker for
-        every ignored marker
+        Creates the MarkerLayer of the case, which reads every body and ignored
+        marker into its index, newest first one page at a time, and draws the
+        ones in view.
         """
-        data = FileManagement(self.folder_path).query_images(config.all_bodies, False, False, False, False)
-        for i in data:
-            body_info = {}
-            x = 0
-            for choice in ("time", "body_name", "body_number", "x", "y"):
-                body_info[choice] = i[x]
-                x += 1
-            GridMark(self.marker_canvas, self.folder_path, body_info)
-        
-        # generates ignored markers
-        ignored = FileManagement(self.folder_path).query_all_ignored()
-        for coord in ignored:
-            GridIgnored(self.marker_canvas, self.folder_path, coord[0], coord[1])
+        self.marker_layer = MarkerLayer(self.marker_canvas, self.folder_path)
             
     def open_new_folder(self):
         """Opens a new folder with its respective image and Markings."""
         path = filedialog.askdirectory()
+        if path == "":
+            return
+        DatabaseManager.close_case(self.folder_path)
         i = Application(root, path=path)
 
+    def on_case_event(self, event):
+        """Listener for DatabaseManager notifications on the case.
+
+        Several changes in a row, such as a save and the renumbering after it, 
+        are coalesced into one count update once Tk is idle. Closing the case 
+        cancels an update and a tile render that have not run yet.
+
+        Args:
+            event (str): "changed", "grid", "images" or "closed".
+        """
+        if event == "closed":
+            if self.count_after is not None:
+                self.master.after_cancel(self.count_after)
+                self.count_after = None
+            if self.renderer is not None:
+                self.renderer.cancel()
+        elif event == "changed" and self.count_after is None:
+            self.count_after = self.master.after_idle(self.update_count)
+
     def update_count(self):
+        """Refreshes the number of bodies annotated."""
+        self.count_after = None
         self.body_count.set(FileManagement(self.folder_path).count_bodies(config.all_bodies, False, False, False, False))
         self.body_count_label.configure(text = "{0} Bodies Annotated".format(self.body_count.get()))
-        self.master.after(2000, self.update_count)
         
     def update_coords(self, event):
         """ Event method that updates mouse position on the image
@@ -246,19 +275,26 @@ class Application(tk.Frame):
         if event.num == 4 or event.delta == 120:
             self.canvas.xview('scroll', -20, 'units')
 
+    def on_scroll(self, scrollbar, first, last):
+        """Moves a scrollbar along with the canvas and shows the tiles and markers scrolled into view."""
+        scrollbar.set(first, last)
+        if self.renderer is not None:
+            self.renderer.schedule()
+        if self.marker_layer is not None:
+            self.marker_layer.schedule()
+        if self.minimap is not None:
+            self.minimap.show_viewport()
+
     def show_image(self):
         """Displays the image on canvas
 
         Configures a scroll region on canvas (allows it to be scrollable) and sets the dimensions to
-        self.container (has the witdh and height of the image). ImageTk.PhotoImage allows pngs and jpgs to be
-        displayed. 
+        self.container (has the witdh and height of the image). Only the tiles of the image in view
+        are turned into Tk images, see TileRenderer, so an image of any size opens at once.
         """
         self.canvas.configure(scrollregion=self.canvas.bbox(self.container))  # set scroll region
-        image = self.image
-        imagetk = ImageTk.PhotoImage(image)
-        imageid = self.canvas.create_image(0,0,anchor= 'nw', image=imagetk) #glues the image to the topleft of the place where the image is stored.
-        self.canvas.lower(imageid)  # set image into background
-        self.canvas.imagetk = imagetk  # keep an extra reference to prevent garbage-collection
+        self.renderer = TileRenderer(self.canvas, self.pyramid)
+        self.renderer.render()
 
 class GridWindow(tk.Frame):
     """The grid square tool located at the bottom of Application
@@ -417,6 +453,90 @@ class GridWindow(tk.Frame):
         self.finished.destroy()
         self.make_check_button()
 
+class Minimap(tk.Canvas):
+    """An overview of the whole gridfile next to the main canvas.
+    
+    The overview is made from a small level of the tile pyramid, so it takes the
+    same time to draw for a gridfile of any size. The 7x7 grid is drawn over it
+    with the finished grid squares shaded and a rectangle around the part of the
+    gridfile in view. Clicking or dragging on the overview centers the main 
+    canvas on that spot.
+    
+    Attributes:
+        main_canvas (tk.Canvas): The current instance of Application's canvas.
+        folder_path (str): The path directory of the current opened folder.
+        rows (int): Seven rows of grid squares.
+        columns (int): Seven columns of grid squares.
+        finished_after (str): The after_idle id of a pending redraw of the finished
+            squares, None if there is none.
+        
+    Typical usage example:
+        minimap = Minimap(root, canvas, folder_path, pyramid)
+    """
+    def __init__(self, master, main_canvas, folder_path, pyramid):
+        overview = pyramid.overview(config.minimap_size)
+        tk.Canvas.__init__(self, master, width = overview.width, height = overview.height, highlightthickness = 0)
+        self.main_canvas = main_canvas
+        self.folder_path = folder_path
+        self.rows = 7
+        self.columns = 7
+        self.finished_after = None
+        
+        imagetk = ImageTk.PhotoImage(overview)
+        self.create_image(0, 0, anchor = 'nw', image = imagetk)
+        self.imagetk = imagetk  # keep an extra reference to prevent garbage-collection
+        
+        box_width = overview.width / self.columns
+        box_height = overview.height / self.rows
+        for i in range(1, self.columns):
+            self.create_line(box_width * i, 0, box_width * i, overview.height, fill = "cyan")
+        for i in range(1, self.rows):
+            self.create_line(0, box_height * i, overview.width, box_height * i, fill = "cyan")
+        self.create_rectangle(0, 0, 0, 0, outline = "red", width = 2, tag = "viewport")
+        self.draw_finished()
+        
+        self.bind('<Button-1>', self.jump)
+        self.bind('<B1-Motion>', self.jump)
+        DatabaseManager.subscribe(self.folder_path, self.on_case_event)
+        
+    def draw_finished(self):
+        """Shades the grid squares marked as finished."""
+        self.finished_after = None
+        self.delete("finished")
+        box_width = int(self["width"]) / self.columns
+        box_height = int(self["height"]) / self.rows
+        key = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvw"
+        for grid_id, finished in FileManagement(self.folder_path).get_grid():
+            if finished:
+                row, column = divmod(key.find(grid_id), self.columns)
+                self.create_rectangle(column * box_width, row * box_height, (column + 1) * box_width, 
+                                      (row + 1) * box_height, fill = "lime green", stipple = "gray25", 
+                                      outline = "", tag = "finished")
+        self.tag_raise("viewport")
+        
+    def show_viewport(self):
+        """Moves the rectangle to the part of the gridfile shown on the main canvas."""
+        x0, x1 = self.main_canvas.xview()
+        y0, y1 = self.main_canvas.yview()
+        width, height = int(self["width"]), int(self["height"])
+        self.coords("viewport", x0 * width, y0 * height, x1 * width, y1 * height)
+        
+    def jump(self, event):
+        """Centers the main canvas on the spot of the overview that was clicked."""
+        x0, x1 = self.main_canvas.xview()
+        y0, y1 = self.main_canvas.yview()
+        self.main_canvas.xview_moveto(event.x / int(self["width"]) - (x1 - x0) / 2)
+        self.main_canvas.yview_moveto(event.y / int(self["height"]) - (y1 - y0) / 2)
+        
+    def on_case_event(self, event):
+        """Redraws the finished squares once Tk is idle after a grid square changed."""
+        if event == "closed":
+            if self.finished_after is not None:
+                self.after_cancel(self.finished_after)
+                self.finished_after = None
+        elif event == "grid" and self.finished_after is None:
+            self.finished_after = self.after_idle(self.draw_finished)
+
 class OptionBar(tk.Frame):
     """The toolbar located at the top of Application
     
@@ -434,6 +554,7 @@ class OptionBar(tk.Frame):
         case_name (tk.StringVar): Case name user would input if they export images.
         grid_var (tk.BooleanVar): Stores whether grid lines should be hidden or not.
         letter_var (tk.BooleanVar): Stores whether grid letters should be hidden or not.
+        profile_var (tk.StringVar): The name of the database durability profile of the case.
         file_b (tk.MenuButton): The object to which the File dropdown button is assigned to.
         file_menu (tk.Menu): The object to which the File dropdown options are assigned to.
         view_b (tk.MenuButton): The object to which the View dropdown button is assigned to.
@@ -480,6 +601,15 @@ class OptionBar(tk.Frame):
         
         edit_menu.add_command(label = "Add Ignored Marker", command = self.add_ignored)
         
+        profile_menu = tk.Menu(edit_menu, tearoff = False)
+        self.profile_var = tk.StringVar(value = DatabaseManager.get_durability_profile(
+                                            DatabaseManager.get_connection(self.folder_path)))
+        for profile in config.durability_profiles:
+            profile_menu.add_radiobutton(label = profile, variable = self.profile_var, value = profile,
+                                         command = self.set_durability_profile)
+        edit_menu.add_cascade(label = "Database Profile", menu = profile_menu)
+        edit_menu.add_command(label = "Rebuild Counters", command = self.rebuild_counters)
+        
         # view menu
         view_b = tk.Menubutton(self, text = "View", relief = "raised")
         view_menu = tk.Menu(view_b, tearoff = False)
@@ -519,6 +649,9 @@ class OptionBar(tk.Frame):
             Opens a new instance of Application using a folder from file explorer.
         """
         path = filedialog.askdirectory()
+        if path == "":
+            return
+        DatabaseManager.close_case(self.folder_path)
         i = Application(root, path=path)
         
     def export_images(self):
@@ -558,51 +691,113 @@ class OptionBar(tk.Frame):
         folder_button = tk.Button(export, text = "Browse", command = select_folder)
         folder_button.grid(row = 2, column = 1, padx = 10, pady = 10, sticky = "w")
         
+        formats_frame = tk.Frame(export)
+        formats_frame.grid(row = 3, column = 0, columnspan = 2, padx = 10, sticky = "w")
+        format_vars = {}
+        step_labels = {"csv": "CSV", "jsonl": "JSON Lines", "snapshot": "Database Snapshot"}
+        for table_format, label in step_labels.items():
+            format_vars[table_format] = tk.BooleanVar(value = table_format == "csv")
+            format_check = tk.Checkbutton(formats_frame, text = label, variable = format_vars[table_format],
+                                          onvalue = True, offvalue = False)
+            format_check.pack(side = "left")
+        
+        progress_bar = ttk.Progressbar(export, orient = "horizontal", mode = "determinate")
+        progress_label = tk.Label(export, text = "")
+        case_export = None
+        progress_after = None
+        
+        def show_progress():
+            """Updates the progress bar until the export is finished, then closes the window."""
+            nonlocal progress_after
+            done, total = case_export.progress()
+            progress_bar.configure(maximum = max(total, 1), value = done)
+            if case_export.steps_done < len(case_export.steps):
+                step = case_export.steps[case_export.steps_done]
+                progress_label.configure(text = "Exporting {0}".format(step_labels.get(step, "Renamed Images")))
+            else:
+                progress_label.configure(text = "{0} / {1} images".format(done - len(case_export.steps),
+                                                                         total - len(case_export.steps)))
+            if case_export.is_finished():
+                export.destroy()
+                if case_export.errors:
+                    # a long list is cut short so the message still fits on the screen
+                    failed = ["{0}: {1}".format(os.path.basename(new_name), error)
+                              for new_name, error in case_export.errors[:10]]
+                    if len(case_export.errors) > 10:
+                        failed.append("and {0} more".format(len(case_export.errors) - 10))
+                    messagebox.showerror("Export", "Unable to export:\n" + "\n".join(failed), parent = root)
+            else:
+                progress_after = export.after(100, show_progress)
+        
         def confirm():
             """Exports images to folder_path.
 
             Takes case name and folder path and exports biondi images to the designated folder.
+            The tables and images are exported in the background while the progress bar 
+            shows how far along the export is. Exporting to a folder that already has some of the 
+            images continues the export.
             """
+            nonlocal case_export
             if self.case_name.get() == "" or self.new_folder_path.get() == "/":
                 return
             else:
-                FileManagement(self.folder_path).export_case(self.new_folder_path.get(), self.case_name.get())
-                export.destroy()
+                formats = tuple(table_format for table_format, var in format_vars.items() if var.get())
+                # the exporter and its process pool are loaded on first use to keep the program quick to start
+                from exporter import CaseExport
+                case_export = CaseExport(self.folder_path, self.new_folder_path.get(), self.case_name.get(),
+                                         formats = formats)
+                case_export.start()
+                ok_button.configure(text = "Cancel", command = cancel)
+                progress_bar.grid(row = 4, column = 0, padx = 10, pady = 10, sticky = "nsew")
+                progress_label.grid(row = 5, column = 0, padx = 10, sticky = "w")
+                show_progress()
+                
+        def cancel():
+            """Stops the export. Images that were finished are kept."""
+            if case_export is not None:
+                case_export.cancel()
+            if progress_after is not None:
+                export.after_cancel(progress_after)
+            export.destroy()
         
         ok_button = tk.Button(export, text = "Okay", command = confirm)
-        ok_button.grid(row = 3, column = 1, padx = 10, pady = 10, sticky = "e")
+        ok_button.grid(row = 4, column = 1, padx = 10, pady = 10, sticky = "e")
+        export.protocol("WM_DELETE_WINDOW", cancel)
         
     def add_ignored(self):
-        def create_ignored_marker(event):
-            """Event method that adds an ignored marker.
-
-            x and y are the coords of where the mouse clicked. Then converted to canvas coordinates
-            which is used to add a marker.
-            """
-            x = event.x
-            y = event.y
-            canvas_x = self.marker_canvas.canvasx(x)
-            canvas_y = self.marker_canvas.canvasy(y)
-            coords = (canvas_x, canvas_y)
-            
-            GridIgnored(self.marker_canvas,self.folder_path, canvas_x, canvas_y)
-            FileManagement(self.folder_path).add_ignored(coords)
-            
+        """Adds an ignored marker where the user clicks next."""
+        layer = self.marker_canvas.marker_layer
+        
         def reset(event):
+            layer.place_ignored = False
             self.marker_canvas.configure(cursor = "")
-            self.marker_canvas.unbind("<Button-1>")
             self.marker_canvas.unbind("<ButtonRelease-1>")
         
         self.marker_canvas.configure(cursor = "cross")
-        self.marker_canvas.bind('<Button-1>', create_ignored_marker)
+        layer.place_ignored = True
         self.marker_canvas.bind('<ButtonRelease-1>', reset)
     
+    def set_durability_profile(self):
+        """Saves the selected database profile for the current case."""
+        DatabaseManager.set_durability_profile(self.folder_path, self.profile_var.get())
+    
+    def rebuild_counters(self):
+        """Recomputes the body counters of the current case and shows any that were wrong."""
+        mismatches = FileManagement(self.folder_path).rebuild_counters()
+        lines = ["Counters rebuilt, {0} were wrong.".format(len(mismatches))]
+        for table, key, stored, actual in mismatches[:10]:
+            lines.append("{0} {1}: counted {2}, actually {3}".format(table, key, stored, actual))
+        if len(mismatches) > 10:
+            lines.append("and {0} more".format(len(mismatches) - 10))
+        messagebox.showinfo("Rebuild Counters", "\n".join(lines), parent = root)
+    
     def open_image_viewer(self):
         """Opens the biondi body image viewer.
 
-        Calls the ImageViewer class in image_viewer.py.
+        Brings up the ImageViewer of the case in image_viewer.py, see open_image_viewer.
         """
-        ImageViewer(self.folder_path, self.marker_canvas) #TEST CLASS
+        from image_viewer import open_image_viewer
+        open_image_viewer(self.folder_path, self.marker_canvas)
     
     def original_size(self):
         """Resets the Application window to the original size.
@@ -656,33 +851,15 @@ class OptionBar(tk.Frame):
         Takes seconday_selection and body_selection and shows the markers based on those requirements
         from FileManagement.
         """
-        all_data = FileManagement(self.folder_path).query_images(config.all_bodies, False, False, False, False)
-        for i in all_data:
-            self.grid_canvas.delete("m" + str(i[0]))
-        
         bodies = self._get_body_selection()
         secondary_selection = self._get_secondary_selection()
         
-        data = FileManagement(self.folder_path).query_images(bodies, secondary_selection[0], secondary_selection[1], 
-                               secondary_selection[2], secondary_selection[3])
-        for i in data:
-            body_info = {}
-            x = 0
-            for choice in ("time", "body_name", "body_number", "x", "y"):
-                body_info[choice] = i[x]
-                x += 1
-            GridMark(self.marker_canvas, self.folder_path, body_info)
+        self.marker_canvas.marker_layer.show_only(bodies, secondary_selection[0], secondary_selection[1], 
+                                                  secondary_selection[2], secondary_selection[3])
             
     def show_ignored(self):
-        ignored = FileManagement(self.folder_path).query_all_ignored()
-        if self.ignored_var.get() == False:
-            for coords in ignored:
-                tag = "i{0}{1}".format(coords[0], coords[1])
-                self.marker_canvas.delete(tag)
-        else:
-            for coords in ignored:
-                GridIgnored(self.marker_canvas,self.folder_path, coords[0], coords[1])
-            
+        """Toggles ignored markers on and off."""
+        self.marker_canvas.marker_layer.set_show_ignored(self.ignored_var.get())
 
 class OpeningWindow:
     def __init__(self, master):
@@ -811,4 +988,5 @@ class OpeningWindow:
 if __name__ == "__main__":
     root = tk.Tk()
     app = OpeningWindow(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+    DatabaseManager.close_all()
\ No newline at end of file
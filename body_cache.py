@@ -0,0 +1,197 @@
+"""Decoded images and rows of the bodies the image viewer shows.
+
+Opening a body in the image viewer reads its row and decodes its render, the
+body image with its annotation pasted on top. The cache keeps the last bodies opened in memory, up to
+config.body_cache_bytes of decoded pixels, so flipping back to one of them
+costs nothing. A background thread loads the bodies next to the one shown in
+the body list ahead of time, so walking through a case one body at a time
+finds the next body already decoded.
+
+Every body is dropped when the case changes, since an edit or a delete can
+renumber other bodies. invalidate drops one body whose images were saved
+again, which does not notify the case. A body that fails to load in the
+background is recorded in errors and skipped, the read ahead goes on with the
+next one.
+
+Typical usage example:
+    bodies = open_body_cache(folder_path)
+    body_info, render_img = bodies.get(body_id)
+    bodies.prefetch(neighbor_ids)
+"""
+
+import queue
+import threading
+from collections import OrderedDict
+from database_manager import DatabaseManager
+from file_management import FileManagement
+import config
+
+class BodyCache():
+    """The decoded bodies of one case, least recently used dropped first.
+
+    get is called from the Tk thread and loads a body itself when it is not
+    cached yet. Bodies passed to prefetch are loaded by the worker thread, a
+    new prefetch replaces the ones not started yet.
+
+    Attributes:
+        folder_path (str): The directory of the case folder.
+        budget (int): The most bytes of decoded pixels kept.
+        errors (list): Tuple of (body id, exception) for every prefetch that failed.
+    """
+    def __init__(self, folder_path, budget = config.body_cache_bytes):
+        self.folder_path = folder_path
+        self.budget = budget
+        self.errors = []
+        self._entries = OrderedDict()
+        self._total = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def get(self, body_id):
+        """Returns the row and decoded render of a body.
+
+        Returns:
+            body_info (dict): See FileManagement.convert_tuple, a copy the caller may change.
+                None if the body has been deleted.
+            render_img (PIL Image): See FileManagement.open_render, None if it could not be read.
+        """
+        with self._lock:
+            entry = self._entries.get(body_id)
+            if entry is not None:
+                self._entries.move_to_end(body_id)
+        if entry is None:
+            entry = self._load(body_id)
+        body_info, render_img, size = entry
+        if body_info is None:
+            return None, None
+        return dict(body_info), render_img
+
+    def contains(self, body_id):
+        """Returns True if a body is cached."""
+        with self._lock:
+            return body_id in self._entries
+
+    def prefetch(self, body_ids):
+        """Loads bodies in the background, dropping the prefetches not started yet."""
+        self.cancel()
+        for body_id in body_ids:
+            self._requests.put(body_id)
+
+    def cancel(self):
+        """Drops every prefetch that has not been started."""
+        while True:
+            try:
+                self._requests.get_nowait()
+            except queue.Empty:
+                return
+            self._requests.task_done()
+
+    def wait(self):
+        """Blocks until every prefetch has been handled."""
+        self._requests.join()
+
+    def invalidate(self, body_id = None):
+        """Drops a body, or every body if body_id is None, including one being loaded at that moment."""
+        with self._lock:
+            self._generation += 1
+            if body_id is None:
+                self._entries.clear()
+                self._total = 0
+            else:
+                entry = self._entries.pop(body_id, None)
+                if entry is not None:
+                    self._total -= entry[2]
+
+    def _load(self, body_id):
+        """Reads and decodes a body and caches it, on whichever thread calls it."""
+        with self._lock:
+            generation = self._generation
+        fm = FileManagement(self.folder_path)
+        body_info = fm.get_body(body_id)
+        # a deleted body is not cached, the change notification drops the cache anyway
+        if body_info is None:
+            return (None, None, 0)
+        try:
+            render_img = fm.open_render(body_info["body_file_name"], body_info["annotation_file_name"])
+            render_img.load()
+            size = len(render_img.getbands()) * render_img.width * render_img.height
+        except OSError:
+            render_img = None
+            size = 0
+        entry = (body_info, render_img, size)
+
+        with self._lock:
+            # the case changed while the body was being read
+            if self._generation == generation and body_id not in self._entries:
+                self._entries[body_id] = entry
+                self._total += size
+                self._evict()
+        return entry
+
+    def _evict(self):
+        """Drops the least recently used bodies until the cache fits its budget. The caller holds the lock."""
+        while self._total > self.budget and len(self._entries) > 1:
+            body_id, entry = self._entries.popitem(last = False)
+            self._total -= entry[2]
+
+    def _run(self):
+        while True:
+            body_id = self._requests.get()
+            try:
+                if body_id is None:
+                    DatabaseManager.close_thread(self.folder_path)
+                    return
+                # a body deleted since it was queued is skipped by _load
+                if not self.contains(body_id):
+                    self._load(body_id)
+            except Exception as error:
+                # one body that can not be read must not stop the read ahead of the others
+                with self._lock:
+                    self.errors.append((body_id, error))
+            finally:
+                self._requests.task_done()
+
+    def total_bytes(self):
+        """Returns the number of bytes of decoded pixels held."""
+        with self._lock:
+            return self._total
+
+    def close(self):
+        """Stops the worker once it finishes its current body and empties the cache."""
+        self.cancel()
+        self._requests.put(None)
+        self._thread.join()
+        self.invalidate()
+
+_open_caches = {}
+_caches_lock = threading.Lock()
+
+def open_body_cache(folder_path):
+    """Returns the body cache of a case, which is kept until the case is closed.
+
+    Args:
+        folder_path (str): The directory of the case folder ending with a slash.
+    """
+    key = DatabaseManager.case_key(folder_path)
+    with _caches_lock:
+        cache = _open_caches.get(key)
+        if cache is None:
+            cache = BodyCache(folder_path)
+            _open_caches[key] = cache
+            DatabaseManager.subscribe(folder_path, lambda event: _on_case_event(key, event))
+    return cache
+
+def _on_case_event(key, event):
+    if event == "closed":
+        with _caches_lock:
+            cache = _open_caches.pop(key, None)
+        if cache is not None:
+            cache.close()
+    elif event == "changed":
+        with _caches_lock:
+            cache = _open_caches.get(key)
+        if cache is not None:
+            cache.invalidate()
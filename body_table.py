@@ -0,0 +1,307 @@
+"""The columns of every body the lists and filters of the client read, in memory.
+
+The gridfile markers, the ImageViewer body list and the marker popup all ask
+for the same few columns of the bodies: time, type, number, position, grid
+square and flags. BodyTable holds those columns as numpy arrays, read from the
+database once per case, and answers filters, counts and sorted pages with
+vectorized masks instead of a query each time.
+
+The table is written through rather than read again. FileManagement passes
+every body it saves, edits, deletes or renumbers to the table of the case if
+one is loaded, see file_management.body_tables.
+
+Typical usage example:
+    table = open_body_table(folder_path)
+    number = table.count(config.all_bodies, False, False, False, False)
+    pages = table.iter_image_pages(config.all_bodies, True, False, False, False)
+"""
+
+import threading
+import numpy as np
+from database_manager import DatabaseManager
+from file_management import FileManagement, body_tables
+import config
+
+class BodyTable():
+    """The bodies of one case as one numpy array per column.
+
+    Rows are kept in the order they were added, with spare room at the end of
+    the arrays so adding a body does not copy them. Sorted requests read the
+    rows through an order newest first that is kept until a body is added or
+    deleted. Counts are summed from the number of bodies of every type and
+    flags combination, kept like the body_counts table.
+
+    Attributes:
+        folder_path (str): The directory of the case folder.
+        size (int): The number of bodies.
+        type_names (dict): TYPE_ID to BODY_NAME of every body type of the case.
+        type_ids (dict): BODY_NAME to TYPE_ID.
+        grid_names (list): The grid ids of the grid column, which holds their index.
+    """
+    # column name to numpy type, the positions and numbers fit in 32 bits
+    columns = {"body_id": np.int64,
+               "time": np.int64,
+               "type_id": np.int32,
+               "number": np.int32,
+               "x": np.int32,
+               "y": np.int32,
+               "grid": np.int32,
+               "flags": np.uint8}
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self._lock = threading.Lock()
+        self._order = None
+        conn = DatabaseManager.get_connection(folder_path)
+        self.type_names = dict(conn.execute('''SELECT TYPE_ID, BODY_NAME FROM body_types'''))
+        self.type_ids = {name: type_id for type_id, name in self.type_names.items()}
+        rows = conn.execute('''SELECT BODY_ID, TIME, TYPE_ID, BODY_NUMBER, X_POSITION, Y_POSITION, FLAGS, GRID_ID
+                            FROM bodies''').fetchall()
+
+        self.size = len(rows)
+        # every column but the grid id is read as one block of integers
+        values = np.array([row[:7] for row in rows], dtype = np.int64).reshape(self.size, 7)
+        self._grid_codes = {}
+        grid = np.fromiter((self._grid_codes.setdefault(row[7], len(self._grid_codes)) for row in rows),
+                           dtype = np.int32, count = self.size)
+        self.grid_names = list(self._grid_codes)
+        self._data = {}
+        for name, dtype in self.columns.items():
+            self._data[name] = np.zeros(max(self.size * 2, 1024), dtype = dtype)
+        for i, name in enumerate(("body_id", "time", "type_id", "number", "x", "y", "flags")):
+            self._data[name][:self.size] = values[:, i]
+        self._data["grid"][:self.size] = grid
+
+        self._counts = np.zeros((max(self.type_names, default = 0) + 1, sum(config.flag_bits.values()) + 1),
+                                dtype = np.int64)
+        np.add.at(self._counts, (self._column("type_id"), self._column("flags")), 1)
+
+    def __len__(self):
+        return self.size
+
+    def _column(self, name):
+        return self._data[name][:self.size]
+
+    def _grid_code(self, grid_id):
+        code = self._grid_codes.get(grid_id)
+        if code is None:
+            code = len(self.grid_names)
+            self.grid_names.append(grid_id)
+            self._grid_codes[grid_id] = code
+        return code
+
+    def _type_id(self, body_name):
+        """Returns the TYPE_ID of a body name, reading body_types again for a type added since loading."""
+        if body_name not in self.type_ids:
+            conn = DatabaseManager.get_connection(self.folder_path)
+            self.type_names = dict(conn.execute('''SELECT TYPE_ID, BODY_NAME FROM body_types'''))
+            self.type_ids = {name: type_id for type_id, name in self.type_names.items()}
+            if max(self.type_names) >= len(self._counts):
+                counts = np.zeros((max(self.type_names) + 1, self._counts.shape[1]), dtype = np.int64)
+                counts[:len(self._counts)] = self._counts
+                self._counts = counts
+        return self.type_ids[body_name]
+
+    def _row(self, body_id):
+        """Returns the index of a body, None if it is not in the table. The caller holds the lock."""
+        found = np.flatnonzero(self._column("body_id") == body_id)
+        if len(found) == 0:
+            return None
+        return found[0]
+
+    def nbytes(self):
+        """Returns the bytes held by the columns, spare room included."""
+        return sum(column.nbytes for column in self._data.values())
+
+    def insert(self, body_info):
+        """Adds a body saved by FileManagement.save_image.
+
+        Args:
+            body_info (dict): The body with its new body_id, see FileManagement.convert_tuple.
+        """
+        with self._lock:
+            if self.size == len(self._data["body_id"]):
+                # doubling the room keeps adding a body constant time on average
+                for name, column in self._data.items():
+                    grown = np.zeros(len(column) * 2, dtype = column.dtype)
+                    grown[:self.size] = column[:self.size]
+                    self._data[name] = grown
+            values = {"body_id": body_info["body_id"],
+                      "time": body_info["time"],
+                      "type_id": self._type_id(body_info["body_name"]),
+                      "number": body_info["body_number"],
+                      "x": body_info["x"],
+                      "y": body_info["y"],
+                      "grid": self._grid_code(body_info["grid_id"]),
+                      "flags": FileManagement.pack_flags(body_info["GR"], body_info["MAF"],
+                                                         body_info["MP"], body_info["unsure"])}
+            for name, value in values.items():
+                self._data[name][self.size] = value
+            self.size += 1
+            self._counts[values["type_id"], values["flags"]] += 1
+            self._order = None
+
+    def edit(self, body_id, body_name, flags):
+        """Changes the type and flags of a body edited by FileManagement.edit_info."""
+        with self._lock:
+            row = self._row(body_id)
+            if row is None:
+                return
+            type_id = self._type_id(body_name)
+            self._counts[self._data["type_id"][row], self._data["flags"][row]] -= 1
+            self._counts[type_id, flags] += 1
+            self._data["type_id"][row] = type_id
+            self._data["flags"][row] = flags
+
+    def delete(self, body_name, body_number):
+        """Removes the body FileManagement.delete_img deleted."""
+        with self._lock:
+            kept = ~((self._column("type_id") == self._type_id(body_name))
+                     & (self._column("number") == body_number))
+            size = int(np.count_nonzero(kept))
+            np.subtract.at(self._counts, (self._column("type_id")[~kept], self._column("flags")[~kept]), 1)
+            for name, column in self._data.items():
+                column[:size] = column[:self.size][kept]
+            self.size = size
+            self._order = None
+
+    def renumber(self, body_name, body_number):
+        """Numbers the bodies of a type by time the way FileManagement.renumber_img does.
+
+        Returns:
+            changed (int): The number of bodies whose number was changed.
+        """
+        with self._lock:
+            rows = np.flatnonzero(self._column("type_id") == self._type_id(body_name))
+            rows = rows[np.lexsort((self._column("body_id")[rows], self._column("time")[rows]))]
+            new_numbers = np.arange(1, len(rows) + 1, dtype = np.int32)
+            numbers = self._data["number"]
+            changed = (new_numbers >= body_number) & (numbers[rows] != new_numbers)
+            numbers[rows[changed]] = new_numbers[changed]
+            return int(np.count_nonzero(changed))
+
+    def _mask(self, body_param, GR_param, MAF_param, MP_param, unsure_param):
+        """Returns which bodies pass a filter, see FileManagement.filter_clause. The caller holds the lock."""
+        required = FileManagement.pack_flags(GR_param, MAF_param, MP_param, unsure_param)
+        type_ids = [self.type_ids[name] for name in body_param if name in self.type_ids]
+        mask = np.isin(self._column("type_id"), type_ids)
+        if required:
+            mask &= (self._column("flags") & required) == required
+        return mask
+
+    def _newest_first(self):
+        """Returns the row indexes by TIME and BODY_ID descending. The caller holds the lock."""
+        if self._order is None:
+            self._order = np.lexsort((self._column("body_id"), self._column("time")))[::-1]
+        return self._order
+
+    def count(self, body_param, GR_param, MAF_param, MP_param, unsure_param):
+        """Returns the number of bodies matching a filter, see FileManagement.count_bodies."""
+        required = FileManagement.pack_flags(GR_param, MAF_param, MP_param, unsure_param)
+        flag_values = [flags for flags in range(self._counts.shape[1]) if flags & required == required]
+        with self._lock:
+            type_ids = [self.type_ids[name] for name in body_param if name in self.type_ids]
+            return int(self._counts[np.ix_(type_ids, flag_values)].sum())
+
+    def _rows(self, rows):
+        """Returns rows in the format of FileManagement.query_images. The caller holds the lock."""
+        names = [self.type_names[type_id] for type_id in self._column("type_id")[rows].tolist()]
+        return list(zip(self._column("body_id")[rows].tolist(), self._column("time")[rows].tolist(), names,
+                        self._column("number")[rows].tolist(), self._column("x")[rows].tolist(),
+                        self._column("y")[rows].tolist()))
+
+    def query_images(self, body_param, GR_param, MAF_param, MP_param, unsure_param):
+        """Returns every body matching a filter newest first, the same rows as FileManagement.query_images."""
+        with self._lock:
+            mask = self._mask(body_param, GR_param, MAF_param, MP_param, unsure_param)
+            order = self._newest_first()
+            return self._rows(order[mask[order]])
+
+    def query_images_page(self, body_param, GR_param, MAF_param, MP_param, unsure_param,
+                          after = None, page_size = config.page_size):
+        """Returns one page of query_images, see FileManagement.query_images_page.
+
+        Returns:
+            page (list): Rows in the same format and order as query_images.
+            token (tuple): (time, body id) of the last row to resume from, None if
+                this was the last page.
+        """
+        with self._lock:
+            mask = self._mask(body_param, GR_param, MAF_param, MP_param, unsure_param)
+            if after is not None:
+                times = self._column("time")
+                mask &= (times < after[0]) | ((times == after[0]) & (self._column("body_id") < after[1]))
+            order = self._newest_first()
+            page = self._rows(order[mask[order]][:page_size])
+        token = None
+        if len(page) == page_size:
+            token = (page[-1][1], page[-1][0])
+        return page, token
+
+    def iter_image_pages(self, body_param, GR_param, MAF_param, MP_param, unsure_param,
+                         after = None, page_size = config.page_size):
+        """Yields the pages of query_images_page one at a time, see FileManagement.iter_image_pages."""
+        while True:
+            page, after = self.query_images_page(body_param, GR_param, MAF_param, MP_param, unsure_param,
+                                                 after, page_size)
+            yield page, after
+            if after is None:
+                return
+
+    def query_markers_page(self, after = None, page_size = config.page_size):
+        """Returns one page of what the gridfile markers need, see FileManagement.query_markers_page.
+
+        The page is read from the columns as they are when it is asked for, so a
+        body deleted or edited between two pages is never handed out stale.
+
+        Returns:
+            page (list): (body id, time, body name, flags, x, y) of every body.
+            token (tuple): (time, body id) of the last row to resume from, None if
+                this was the last page.
+        """
+        with self._lock:
+            order = self._newest_first()
+            if after is not None:
+                times = self._column("time")[order]
+                body_ids = self._column("body_id")[order]
+                order = order[(times < after[0]) | ((times == after[0]) & (body_ids < after[1]))]
+            rows = order[:page_size]
+            names = [self.type_names[type_id] for type_id in self._column("type_id")[rows].tolist()]
+            page = list(zip(self._column("body_id")[rows].tolist(), self._column("time")[rows].tolist(), names,
+                            self._column("flags")[rows].tolist(), self._column("x")[rows].tolist(),
+                            self._column("y")[rows].tolist()))
+        token = None
+        if len(page) == page_size:
+            token = (page[-1][1], page[-1][0])
+        return page, token
+
+    def iter_markers_pages(self, page_size = config.page_size):
+        """Yields the pages of query_markers_page one at a time, see FileManagement.iter_markers_pages."""
+        after = None
+        while True:
+            page, after = self.query_markers_page(after, page_size)
+            yield page, after
+            if after is None:
+                return
+
+_tables_lock = threading.Lock()
+
+def open_body_table(folder_path):
+    """Returns the body table of a case, which is read once and kept until the case is closed.
+
+    Args:
+        folder_path (str): The directory of the case folder ending with a slash.
+    """
+    key = DatabaseManager.case_key(folder_path)
+    with _tables_lock:
+        table = body_tables.get(key)
+        if table is None:
+            table = BodyTable(folder_path)
+            body_tables[key] = table
+            DatabaseManager.subscribe(folder_path, lambda event: _on_case_event(key, event))
+    return table
+
+def _on_case_event(key, event):
+    if event == "closed":
+        with _tables_lock:
+            body_tables.pop(key, None)
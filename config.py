@@ -15,4 +15,62 @@ all_bodies = list(body_index.keys())
 
 angler_types = ("green spear", "crescent_spear")
 
-kbell_types = ("ring_kettlebell")
\ No newline at end of file
+kbell_types = ("ring_kettlebell")
+
+# bit of each secondary annotation in the packed FLAGS column of the database
+flag_bits = {"GR": 1,
+             "MAF": 2,
+             "MP": 4,
+             "unsure": 8}
+
+# sqlite settings applied to the case databases. "wal" makes every save much cheaper,
+# but WAL needs working file locks so only use it for local drives or reliable shares.
+# A case can pick its own profile from Edit > Database Profile.
+durability_profiles = {"default": {"journal_mode": "DELETE",
+                                   "synchronous": "FULL",
+                                   "cache_size": -2000,
+                                   "mmap_size": 0},
+                       "wal": {"journal_mode": "WAL",
+                               "synchronous": "NORMAL",
+                               "cache_size": -20000,
+                               "mmap_size": 268435456}}
+
+durability_profile = "default"
+
+# number of bodies read per query when markers and image viewer buttons are
+# streamed onto the screen
+page_size = 500
+
+# number of rows held in memory at once when the tables of a case are exported
+export_batch_size = 1000
+
+# where new cases keep their images, "loose" for a png file per image or
+# "packed" for a single pack file. Existing cases keep their store
+# until they are converted with image_store.py
+image_store = "loose"
+
+# largest width and height of the body previews in the image viewer and the
+# most bytes of previews kept per case before the least recently used are dropped
+thumbnail_size = (64, 48)
+thumbnail_cache_bytes = 16 * 1024 * 1024
+
+# width and height in pixels of the tiles the gridfile is cut into
+tile_size = 512
+
+# width and height in pixels of the overview of the gridfile next to the main canvas
+minimap_size = 200
+
+# width and height in pixels of the buckets markers are indexed in, how far in
+# pixels from a marker a click still selects it and how close in pixels a new
+# body can be placed to a saved one before Marker warns about it
+marker_cell_size = 256
+marker_hit_radius = 12
+marker_warning_distance = 20
+
+# above this many markers in view they are drawn into one image instead of a
+# canvas item each, see MarkerLayer
+marker_raster_threshold = 500
+
+# the most bytes of decoded body and annotation images the image viewer keeps
+# in memory, see BodyCache
+body_cache_bytes = 256 * 1024 * 1024
@@ -0,0 +1,239 @@
+import os
+import sqlite3
+import threading
+import config
+import migrations
+class DatabaseManager():
+    """Keeps one sqlite3 connection open per case folder.
+
+    FileManagement borrows its connection from here instead of opening a new
+    one for every query. Connections are keyed by the case folder and the thread
+    using them, so a worker thread never shares a handle with the Tk thread. The
+    handles stay open for the whole session until the case is closed.
+
+    It also tells listeners when the bodies of a case change, so widgets such
+    as the body count only refresh after a save, edit or delete instead of
+    polling the database.
+
+    Attributes:
+        connections_opened (int): The number of sqlite3 connections opened since
+            the program started. Used to check how much connection churn there is.
+
+    Typical usage example:
+        conn = DatabaseManager.get_connection(folder_path)
+        DatabaseManager.subscribe(folder_path, on_case_event)
+        DatabaseManager.close_case(folder_path)
+    """
+    _connections = {}
+    _listeners = {}
+    _lock = threading.RLock()
+    connections_opened = 0
+
+    @classmethod
+    def case_key(cls, folder_path):
+        """Returns the key a case is known by, the same for every spelling of its folder.
+
+        The folder path is normalized so that "C:/case/" and "C:/case" match.
+        Connections and listeners are kept under it, and modules that keep
+        something per case, such as the image store or the body cache, use it
+        as the key of their dict so it is dropped along with the case.
+
+        Args:
+            folder_path (str): The directory of the case folder.
+
+        Returns:
+            key (str): The absolute, case normalized path of the folder.
+        """
+        return os.path.normcase(os.path.abspath(folder_path))
+
+    @classmethod
+    def get_connection(cls, folder_path):
+        """Returns the open connection of a case for the current thread.
+
+        Opens and sets up a new connection if this thread has not used the case
+        yet or if the case has been closed since.
+
+        Args:
+            folder_path (str): The directory of the case folder ending with a slash.
+
+        Returns:
+            conn (sqlite3.Connection): The connection to the case's body_database.db
+        """
+        key = (cls.case_key(folder_path), threading.get_ident())
+        with cls._lock:
+            conn = cls._connections.get(key)
+            if conn is None:
+                # check_same_thread is off so close_case can close handles opened
+                # by worker threads. Each handle is still only used by its own thread.
+                conn = sqlite3.connect(folder_path + 'body_database.db', check_same_thread = False)
+                cls.connections_opened += 1
+                try:
+                    cls._setup_connection(conn)
+                except sqlite3.Error:
+                    conn.close()
+                    raise
+                cls._connections[key] = conn
+            return conn
+
+    @classmethod
+    def _setup_connection(cls, conn):
+        """Runs the one time setup for a newly opened connection."""
+        c = conn.cursor()
+        create_settings_query = '''CREATE TABLE IF NOT EXISTS settings (KEY TEXT PRIMARY KEY,
+                                                                    VALUE TEXT)'''
+        c.execute(create_settings_query)
+        conn.commit()
+        c.close()
+
+        # older cases are upgraded to the current schema when they are opened
+        if migrations.is_initiated(conn):
+            migrations.migrate(conn)
+        
+        # journal_mode can not be changed inside a transaction so this goes last
+        cls.apply_durability_profile(conn, cls.get_durability_profile(conn))
+
+    @staticmethod
+    def get_setting(conn, key, default = None):
+        """Returns a value saved in the settings table of a case.
+
+        Args:
+            conn (sqlite3.Connection): Connection to the case database.
+            key (str): Name of the setting.
+            default: Returned when the case has no value for the setting.
+        """
+        row = conn.execute('''SELECT VALUE FROM settings WHERE KEY = ?''', (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    @classmethod
+    def set_setting(cls, folder_path, key, value):
+        """Saves a setting for a case. A value of None removes the setting."""
+        conn = cls.get_connection(folder_path)
+        if value is None:
+            conn.execute('''DELETE FROM settings WHERE KEY = ?''', (key,))
+        else:
+            conn.execute('''INSERT OR REPLACE INTO settings (KEY, VALUE) VALUES (?, ?)''', (key, value))
+        conn.commit()
+
+    @classmethod
+    def get_durability_profile(cls, conn):
+        """Returns the name of the durability profile used by a case.
+
+        Cases without their own profile use config.durability_profile.
+        """
+        name = cls.get_setting(conn, "durability_profile")
+        if name not in config.durability_profiles:
+            return config.durability_profile
+        return name
+
+    @staticmethod
+    def apply_durability_profile(conn, name):
+        """Sets the journal mode, sync and cache pragmas of a connection.
+
+        Args:
+            conn (sqlite3.Connection): Connection to apply the profile on.
+            name (str): A key of config.durability_profiles.
+        """
+        profile = config.durability_profiles[name]
+        for pragma in ("journal_mode", "synchronous", "cache_size", "mmap_size"):
+            conn.execute("PRAGMA {0} = {1}".format(pragma, profile[pragma]))
+
+    @classmethod
+    def set_durability_profile(cls, folder_path, name):
+        """Changes the durability profile of a case.
+
+        The profile is saved in the case so it is used every time the case is opened.
+        Connections other threads have open pick it up when they are reopened.
+
+        Args:
+            folder_path (str): The directory of the case folder.
+            name (str): A key of config.durability_profiles or None to go back to
+                the global config.durability_profile.
+        """
+        cls.set_setting(folder_path, "durability_profile", name)
+        conn = cls.get_connection(folder_path)
+        cls.apply_durability_profile(conn, cls.get_durability_profile(conn))
+
+    @classmethod
+    def subscribe(cls, folder_path, callback):
+        """Registers a function to be told about changes to a case.
+
+        The callback is called with "changed" after every committed change to the
+        bodies of the case, with "grid" after a grid square is marked finished or
+        not, with "images" after its images are moved to another store and with
+        "closed" once when the case is closed, after which it is dropped. Listeners ignore the events they do not need. It runs on the thread that made the change, so Tk
+        listeners should only schedule their work with after_idle.
+
+        Args:
+            folder_path (str): The directory of the case folder.
+            callback (function): Takes the event name as its only argument.
+        """
+        with cls._lock:
+            cls._listeners.setdefault(cls.case_key(folder_path), []).append(callback)
+
+    @classmethod
+    def unsubscribe(cls, folder_path, callback):
+        """Removes a function registered with subscribe."""
+        with cls._lock:
+            listeners = cls._listeners.get(cls.case_key(folder_path), [])
+            if callback in listeners:
+                listeners.remove(callback)
+
+    @classmethod
+    def notify(cls, folder_path, event = "changed"):
+        """Calls every listener of a case with an event."""
+        with cls._lock:
+            listeners = list(cls._listeners.get(cls.case_key(folder_path), []))
+        for callback in listeners:
+            callback(event)
+
+    @classmethod
+    def close_thread(cls, folder_path):
+        """Closes the connection the current thread has open on a case.
+
+        Worker threads should call this before they finish so their handle is not
+        left open until the case is closed.
+        """
+        key = (cls.case_key(folder_path), threading.get_ident())
+        with cls._lock:
+            conn = cls._connections.pop(key, None)
+        if conn is not None:
+            conn.commit()
+            conn.close()
+
+    @classmethod
+    def close_case(cls, folder_path):
+        """Commits and closes every connection open on a case.
+
+        Listeners of the case are sent "closed" and dropped.
+
+        Args:
+            folder_path (str): The directory of the case folder being closed.
+        """
+        case = cls.case_key(folder_path)
+        with cls._lock:
+            keys = [key for key in cls._connections if key[0] == case]
+            conns = [cls._connections.pop(key) for key in keys]
+            listeners = cls._listeners.pop(case, [])
+        for callback in listeners:
+            callback("closed")
+        for conn in conns:
+            conn.commit()
+            # folds the write ahead log back into the database file
+            if conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.close()
+
+    @classmethod
+    def close_all(cls):
+        """Closes every open connection. Used when the program exits."""
+        with cls._lock:
+            cases = {key[0] for key in cls._connections} | set(cls._listeners)
+        for case in cases:
+            cls.close_case(case)
+
+    @classmethod
+    def get_connections_opened(cls):
+        """Returns how many connections have been opened this session."""
+        return cls.connections_opened
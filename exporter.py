@@ -0,0 +1,484 @@
+"""Exports a case on several processes while the program stays responsive.
+
+Decoding the two pngs of a body, pasting them together and encoding the result
+is done by a process pool, one body per task. The tables, the renames and the
+removals of the export folder are done by a thread that then hands the images
+to the pool. The Tk thread only starts the export and polls its progress.
+
+A manifest kept in the export folder records which source images every
+exported image was made from, so exporting into the same folder again only
+merges the bodies that are new or changed, renames the images of relabelled
+or renumbered bodies and deletes the images of deleted bodies.
+
+The tables of the case are written by the exporters in table_exporters, which
+stream the rows so a case of any size is exported in bounded memory.
+
+This module can also be run as a script:
+    python exporter.py <case folder> <export folder> <case name> [csv,jsonl,snapshot]
+
+Typical usage example:
+    export = CaseExport(folder_path, new_folder_path, case_name, formats = ("csv", "jsonl"))
+    export.start()
+    done, total = export.progress()
+"""
+
+import os
+import sys
+import csv
+import sqlite3
+import json
+import filecmp
+import threading
+from concurrent.futures import ProcessPoolExecutor, Future
+from file_management import FileManagement, merge_images
+from image_store import source_file
+from database_manager import DatabaseManager
+
+def replace_if_changed(part_path, path):
+    """Moves a newly written file over path unless path already has the same contents.
+
+    Leaving unchanged files alone keeps their modification time, so tools that
+    sync the export folder do not copy them again.
+    """
+    if os.path.exists(path) and filecmp.cmp(part_path, path, shallow = False):
+        os.remove(part_path)
+    else:
+        os.replace(part_path, path)
+
+class TableExporter():
+    """Exports the tables of a case in one file format.
+
+    Subclasses write every table in FileManagement.export_queries into its own
+    file named "<case name>-<table><extension>". Files are written under a
+    temporary name and only replace the previous export when they changed.
+
+    Attributes:
+        extension (str): The file extension of the format.
+    
+    Typical usage example:
+        CsvExporter().export(folder_path, new_folder_path, case_name)
+    """
+    extension = ""
+
+    def export(self, folder_path, new_folder_path, case_name):
+        """Writes every exported table of a case.
+
+        Args:
+            folder_path (str): Directory of the case being exported.
+            new_folder_path (str): Directory the case is exported to.
+            case_name (str): Name the exported files start with.
+        """
+        for table in FileManagement.export_queries:
+            path = "{0}{1}-{2}{3}".format(new_folder_path, case_name, table, self.extension)
+            header, batches = FileManagement(folder_path).stream_table(table)
+            with open(path + ".part", "w", newline = "") as table_file:
+                self.write(table_file, header, batches)
+            replace_if_changed(path + ".part", path)
+
+    def write(self, table_file, header, batches):
+        """Writes the rows of a table into an open file.
+
+        Args:
+            table_file (file): The file opened for writing text.
+            header (list): The names of the columns.
+            batches (generator): Lists of row tuples, see FileManagement.stream_table.
+        """
+        raise NotImplementedError
+
+class CsvExporter(TableExporter):
+    """Writes tables as csv files with a header row, the format of the original export."""
+    extension = ".csv"
+
+    def write(self, table_file, header, batches):
+        csv_writer = csv.writer(table_file)
+        csv_writer.writerow(header)
+        for rows in batches:
+            csv_writer.writerows(rows)
+
+class JsonLinesExporter(TableExporter):
+    """Writes tables as JSON Lines, one object keyed by column name per row."""
+    extension = ".jsonl"
+
+    def write(self, table_file, header, batches):
+        for rows in batches:
+            for row in rows:
+                table_file.write(json.dumps(dict(zip(header, row))) + "\n")
+
+class SnapshotExporter(TableExporter):
+    """Copies the whole case database with the sqlite online backup API.
+
+    The copy is consistent even while the program is writing to the case, unlike
+    copying body_database.db which can catch a write half way or miss what is
+    still in the write ahead log.
+    """
+    extension = ".db"
+
+    def export(self, folder_path, new_folder_path, case_name):
+        path = "{0}{1}-snapshot{2}".format(new_folder_path, case_name, self.extension)
+        if os.path.exists(path + ".part"):
+            os.remove(path + ".part")
+        snapshot = sqlite3.connect(path + ".part")
+        try:
+            DatabaseManager.get_connection(folder_path).backup(snapshot)
+        finally:
+            snapshot.close()
+        os.replace(path + ".part", path)
+
+table_exporters = {"csv": CsvExporter,
+                   "jsonl": JsonLinesExporter,
+                   "snapshot": SnapshotExporter}
+
+def file_stamp(path):
+    """Returns the modification time in nanoseconds and size of a file, None if it is missing."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+def source_stamp(source):
+    """Returns a value that changes whenever the image at a source is saved again.
+
+    An image in a pack gets a new offset every time it is saved as the pack is
+    only appended to, so its offset and length are its stamp.
+    """
+    if isinstance(source, str):
+        return file_stamp(source)
+    return list(source[1:])
+
+class ExportManifest():
+    """The record of what an export folder holds for one case.
+
+    Saved as "<case name>-manifest.json" next to the exported images. Every body
+    has an entry with the name of its exported image and the stamps of the body
+    and annotation images it was merged from.
+
+    Attributes:
+        path (str): Path of the manifest file.
+        case (str): The case folder the export belongs to.
+        bodies (dict): str body id to a dict with "output", "body" and "annotation".
+    """
+    version = 1
+
+    def __init__(self, new_folder_path, case_name, case):
+        self.path = "{0}{1}-manifest.json".format(new_folder_path, case_name)
+        self.case = case
+        self.bodies = {}
+        try:
+            with open(self.path, "r") as manifest_file:
+                saved = json.load(manifest_file)
+        except (OSError, ValueError):
+            return
+        # a manifest written by another case or version is ignored
+        if saved.get("version") == self.version and saved.get("case") == self.case:
+            self.bodies = saved.get("bodies", {})
+
+    def save(self):
+        """Writes the manifest under a temporary name and moves it into place."""
+        part_path = self.path + ".part"
+        with open(part_path, "w") as manifest_file:
+            json.dump({"version": self.version, "case": self.case, "bodies": self.bodies}, manifest_file)
+        os.replace(part_path, self.path)
+
+    def is_current(self, body_id, img, annotation, new_name):
+        """Returns True if the exported image of a body was made from its current source images.
+
+        Images that were exported without being recorded, for example by an export
+        that crashed before saving the manifest, count as current when they are
+        newer than both source images.
+        """
+        entry = self.bodies.get(str(body_id))
+        if entry is not None:
+            return (entry["body"] == source_stamp(img) and entry["annotation"] == source_stamp(annotation)
+                    and os.path.exists(entry["output"]))
+        output_stamp = file_stamp(new_name)
+        body_stamp = file_stamp(source_file(img))
+        annotation_stamp = file_stamp(source_file(annotation))
+        if output_stamp is None or body_stamp is None or annotation_stamp is None:
+            return False
+        return output_stamp[0] >= max(body_stamp[0], annotation_stamp[0])
+
+    def record(self, body_id, img, annotation, new_name):
+        self.bodies[str(body_id)] = {"output": new_name, "body": source_stamp(img),
+                                     "annotation": source_stamp(annotation)}
+
+class CaseExport():
+    """A single export of a case into a folder.
+
+    Exporting into a folder that already holds an export of the case only does
+    the work that changed, see ExportManifest. An export that crashed or was
+    cancelled resumes the same way. merge_images moves every image into place
+    only once it is complete, so a half written image is never kept.
+
+    Attributes:
+        folder_path (str): Directory of the case being exported.
+        new_folder_path (str): Directory the case is exported to.
+        case_name (str): Name the exported files start with.
+        workers (int): Number of processes. None uses one per cpu and 0 makes
+            the images on the calling thread.
+        formats (tuple): Keys of table_exporters the tables are exported in.
+        jobs (list): Body id and the arguments of merge_images for every body.
+            See FileManagement.export_jobs.
+        manifest (ExportManifest): What the export folder held before this export.
+        pending (list): The jobs whose image has to be merged.
+        renames (list): Tuple of (old path, new path) of images that only need a new name.
+        removals (list): Paths of images that belong to bodies no longer in the case.
+        skipped (int): Number of images that were already exported, renamed ones included.
+        steps (list): The names of the steps done before the images, one per
+            table format and "files" for the renames and removals.
+        steps_done (int): Number of steps finished.
+        futures (list): One future per image being made.
+        errors (list): Tuple of (exported image path or step, exception) for every
+            image or step that failed.
+        cancelled (bool): True once cancel has been called.
+    """
+    def __init__(self, folder_path, new_folder_path, case_name, workers = None, formats = ("csv",)):
+        self.folder_path = folder_path
+        self.new_folder_path = new_folder_path
+        self.case_name = case_name
+        self.workers = workers
+        self.formats = formats
+        fm = FileManagement(self.folder_path)
+        self.jobs = fm.export_jobs(self.new_folder_path, self.case_name)
+        fm.close()
+        self.manifest = ExportManifest(self.new_folder_path, self.case_name, os.path.abspath(self.folder_path))
+        self.steps = list(self.formats) + ["files"]
+        self.steps_done = 0
+        self.futures = []
+        self.errors = []
+        self.cancelled = False
+        self._executor = None
+        self._thread = None
+        # set once every image has been handed out, so is_finished does not see a partial futures list
+        self._submitted = False
+        self._lock = threading.Lock()
+        # counts the futures whose callback has run, which is after wait sees them done
+        self._handled = 0
+        self._handled_changed = threading.Condition(self._lock)
+        self._plan()
+
+    def _plan(self):
+        """Sorts the jobs into the images to merge, to rename, to delete and to keep."""
+        self.pending = []
+        self.renames = []
+        outputs = {str(job[0]): job[3] for job in self.jobs}
+        for job in self.jobs:
+            body_id, img, annotation, new_name, render = job
+            entry = self.manifest.bodies.get(str(body_id))
+            # the render is made from the body and annotation, so their stamps cover it
+            if not self.manifest.is_current(body_id, img, annotation, new_name):
+                self.pending.append(job)
+            elif entry is not None and entry["output"] != new_name:
+                self.renames.append((entry["output"], new_name))
+
+        # images of deleted bodies and the old names of remade bodies, unless the
+        # name now belongs to another body and will be overwritten
+        taken = set(outputs.values()) | {old_name for old_name, new_name in self.renames}
+        self.removals = [entry["output"] for body_id, entry in self.manifest.bodies.items()
+                         if entry["output"] != outputs.get(body_id) and entry["output"] not in taken]
+        self.skipped = len(self.jobs) - len(self.pending)
+
+    def start(self):
+        """Starts the export on a background thread and returns right away.
+
+        The thread exports the tables, renames and deletes images and then
+        merges the missing images, see progress and cancel.
+        """
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            for table_format in self.formats:
+                if self.cancelled:
+                    return
+                self._run_step(table_format, table_exporters[table_format]().export,
+                               self.folder_path, self.new_folder_path, self.case_name)
+                self.steps_done += 1
+            if self.cancelled:
+                return
+            self._run_step("files", self._move_files)
+            self.steps_done += 1
+            self._run_step("images", self._submit)
+        finally:
+            DatabaseManager.close_thread(self.folder_path)
+            with self._lock:
+                self._submitted = True
+                finished = self.is_finished()
+                if finished and not self.cancelled:
+                    self._save_manifest()
+                self._handled_changed.notify_all()
+
+    def _run_step(self, step, function, *args):
+        """Runs one step of the export, a failure is recorded in errors and the export goes on."""
+        try:
+            function(*args)
+        except Exception as error:
+            self._add_error(step, error)
+
+    def _add_error(self, name, error):
+        with self._lock:
+            self.errors.append((name, error))
+
+    def _save_manifest(self):
+        """Saves the manifest, recording a failure in errors. The caller holds the lock."""
+        try:
+            self.manifest.save()
+        except OSError as error:
+            self.errors.append((self.manifest.path, error))
+
+    def _move_files(self):
+        """Deletes the images of deleted bodies, renames the relabelled ones and saves the manifest.
+
+        A file that can not be removed or renamed, for example because another
+        program has it open, is recorded in errors. A body whose image could not
+        be renamed is merged again under its new name instead.
+        """
+        for old_name in self.removals:
+            try:
+                if os.path.exists(old_name):
+                    os.remove(old_name)
+            except OSError as error:
+                self._add_error(old_name, error)
+        # renames go through a temporary name as renumbering can move a body onto
+        # the old name of another body that is renamed too
+        failed = set()
+        for old_name, new_name in self.renames:
+            try:
+                if os.path.exists(old_name):
+                    os.replace(old_name, old_name + ".rename")
+            except OSError as error:
+                self._add_error(old_name, error)
+                failed.add(new_name)
+        for old_name, new_name in self.renames:
+            try:
+                if new_name not in failed and os.path.exists(old_name + ".rename"):
+                    os.replace(old_name + ".rename", new_name)
+            except OSError as error:
+                self._add_error(old_name, error)
+                failed.add(new_name)
+        if failed:
+            redo = [job for job in self.jobs if job[3] in failed and job not in self.pending]
+            self.pending.extend(redo)
+            self.skipped -= len(redo)
+
+        pending = set(self.pending)
+        with self._lock:
+            self.manifest.bodies = {}
+            for job in self.jobs:
+                if job not in pending:
+                    self.manifest.record(*job[:4])
+            self._save_manifest()
+
+    def _submit(self):
+        """Hands every pending image to the process pool, or makes them here when workers is 0."""
+        if not self.pending:
+            return
+
+        if self.workers == 0:
+            for job in self.pending:
+                if self.cancelled:
+                    return
+                future = Future()
+                try:
+                    future.set_result(merge_images(*job[1:]))
+                except Exception as error:
+                    future.set_exception(error)
+                with self._lock:
+                    self.futures.append(future)
+                self._job_done(future, job)
+            return
+
+        self._executor = ProcessPoolExecutor(self.workers)
+        for job in self.pending:
+            with self._lock:
+                if self.cancelled:
+                    break
+                future = self._executor.submit(merge_images, *job[1:])
+                self.futures.append(future)
+            # the future is in futures before its callback can run
+            future.add_done_callback(lambda future, job = job: self._job_done(future, job))
+        # lets the workers exit on their own once the last image is made
+        self._executor.shutdown(wait = False)
+
+    def _job_done(self, future, job):
+        with self._lock:
+            try:
+                if future.cancelled():
+                    pass
+                elif future.exception() is not None:
+                    self.errors.append((job[3], future.exception()))
+                else:
+                    self.manifest.record(*job[:4])
+                if self.is_finished():
+                    self._save_manifest()
+            finally:
+                self._handled += 1
+                self._handled_changed.notify_all()
+
+    def progress(self):
+        """Returns how many steps and images are done out of the whole export.
+
+        Returns:
+            done (int): Steps finished and images exported, including the ones that were skipped.
+            total (int): Steps and images in the export.
+        """
+        with self._lock:
+            futures = list(self.futures)
+        done = self.steps_done + self.skipped + sum(1 for future in futures if future.done() and not future.cancelled())
+        return done, len(self.steps) + len(self.jobs)
+
+    def is_finished(self):
+        """Returns True once every step has run and every image has been made, failed or been cancelled."""
+        return self._submitted and all(future.done() for future in list(self.futures))
+
+    def cancel(self):
+        """Stops the export after the images being made right now.
+
+        The images that were finished stay in the export folder, running the
+        export again continues from there.
+        """
+        with self._lock:
+            self.cancelled = True
+            futures = list(self.futures)
+        for future in futures:
+            future.cancel()
+        with self._lock:
+            self._save_manifest()
+
+    def wait(self):
+        """Blocks until the export is finished.
+
+        Returns:
+            errors (list): See errors.
+        """
+        if self._thread is not None:
+            self._thread.join()
+        for future in self.futures:
+            if not future.cancelled():
+                future.exception()
+        # the manifest is saved by the last callback, another export must not start before it
+        with self._lock:
+            self._handled_changed.wait_for(lambda: self._handled == len(self.futures))
+        return self.errors
+
+def main(args):
+    if len(args) not in (3, 4):
+        print("usage: python exporter.py <case folder> <export folder> <case name> [{0}]".format(
+            ",".join(table_exporters)))
+        return 2
+    folder_path, new_folder_path = [os.path.join(path, "") for path in args[:2]]
+    formats = tuple(args[3].split(",")) if len(args) == 4 else ("csv",)
+    try:
+        case_export = CaseExport(folder_path, new_folder_path, args[2], formats = formats)
+        case_export.start()
+        errors = case_export.wait()
+    finally:
+        DatabaseManager.close_case(folder_path)
+    for new_name, error in errors:
+        print("Unable to export {0}: {1}".format(new_name, error))
+    print("exported {0} images, {1} were already up to date".format(len(case_export.jobs), case_export.skipped))
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,8 +1,17 @@
 import sqlite3
-import csv
+import os
+import threading
 from shutil import copy
-from PIL import Image
 from grid_tracker import GridRandomizer
+from database_manager import DatabaseManager
+from image_store import open_image_store, open_source, read_source, render_name
+from tile_pyramid import TilePyramid
+import migrations
+import config
+
+# case key to the BodyTable of every case body_table.open_body_table has read
+body_tables = {}
+
 class FileManagement():
     """A collection of functions used in sqlite3 data manipulation.
 
@@ -13,7 +22,7 @@ class FileManagement():
     Attributes:
         folder_path (str): the directory to the selected folder where all images
             are saved
-        conn: A connection to the sqlite3 database 
+        conn: A connection to the sqlite3 database borrowed from DatabaseManager
         c: the cursor the the previously mentioned sqlite3 database
         
     Typical usage example:
@@ -24,23 +33,29 @@ class FileManagement():
     def __init__(self, folder_path):
         self.folder_path = folder_path
         try:
-            self.conn = sqlite3.connect(self.folder_path + 'body_database.db')
+            # the connection is borrowed and stays open until the case is closed
+            self.conn = DatabaseManager.get_connection(self.folder_path)
             self.c = self.conn.cursor()
-            
-            # here for backwards compatability
-            create_ignored_query = '''CREATE TABLE IF NOT EXISTS ignored (X INTEGER NOT NULL,
-                                                                    Y INTEGER NOT NULL)'''
-            self.c.execute(create_ignored_query)
 
         except sqlite3.Error as error:
             print("Error while connecting to sqlite", error)
-            self.conn.close()
-            self.c.close()
 
     def close(self):
+        """Commits the changes made and releases the cursor.
+        
+        The connection itself is kept open by DatabaseManager for the next
+        FileManagement of the same case.
+        """
         self.conn.commit()
         self.c.close()
-        self.conn.close()
+    
+    def body_table(self):
+        """Returns the BodyTable of the case if one has been read, None otherwise.
+        
+        Writes are passed to it here instead of through body_table so that saving
+        a body does not load numpy when nothing reads the table.
+        """
+        return body_tables.get(DatabaseManager.case_key(self.folder_path))
     
     def get_grid(self):
         """Returns a tuple of grid ids
@@ -71,12 +86,16 @@ class FileManagement():
         
         self.c.execute(finish_grid_query, (state, grid_id))
         self.close()
+        # only the grid listeners care, the bodies did not change
+        DatabaseManager.notify(self.folder_path, "grid")
         
     def count_bodies(self, body_param, GR_param, MAF_param, MP_param, unsure_param):
         """Returns a count of how many bodies are in the database.
         
         Using a series of strings and bools that can be dictated through an image searcher,
         count bodies returns the amount of bodies that exist under those specific parameters.
+        The count is summed from the body_counts table kept by triggers, which has at most
+        one row per body type and flags combination, instead of counting the bodies.
         
         Args:
             body_param (list): a list of parameters including a list of all 
@@ -90,27 +109,43 @@ class FileManagement():
         Returns: 
             number (int): The number of bodies counted
         """
-        counted_bodies = body_param.copy()
-        body_param_ph = "?,"*(len(counted_bodies)-1)+"?"
-        
-        GR_param_ph = self.secondary_name_grouping(GR_param, counted_bodies)
-        MAF_param_ph = self.secondary_name_grouping(MAF_param, counted_bodies)
-        MP_param_ph = self.secondary_name_grouping(MP_param, counted_bodies)
-        unsure_param_ph = self.secondary_name_grouping(unsure_param, counted_bodies)
+        filter_clause, counted_bodies = self.filter_clause(body_param, GR_param, MAF_param, MP_param, unsure_param)
         
-        count_query = '''SELECT COUNT(*)
-                        FROM bodies 
-                        WHERE BODY_NAME IN ({0}) 
-                        AND GR IN ({1}) 
-                        AND MAF IN ({2}) 
-                        AND MP IN ({3})
-                        AND UNSURE IN ({4})'''.format(body_param_ph, GR_param_ph, MAF_param_ph, MP_param_ph, unsure_param_ph)
+        count_query = '''SELECT COALESCE(SUM(COUNT), 0)
+                        FROM body_counts 
+                        WHERE {0}'''.format(filter_clause)
         
         self.c.execute(count_query, counted_bodies)
         c_result = self.c.fetchone()
         number = c_result[0]
         return number
     
+    def count_grid_squares(self):
+        """Returns the number of bodies found in every grid square.
+        
+        Returns:
+            counts (dict): grid id (str) to the number of bodies in that square. 
+                Squares without bodies may be missing or 0.
+        """
+        self.c.execute('''SELECT GRID_ID, COUNT FROM grid_counts''')
+        return dict(self.c.fetchall())
+    
+    def rebuild_counters(self):
+        """Recomputes the body counters from scratch.
+        
+        The counters are kept by triggers so this should never find anything, 
+        it is there to verify them and to repair a case edited outside the program.
+        
+        Returns:
+            mismatches (list): (table, key, stored count, actual count) for every 
+                counter that was wrong. See migrations.rebuild_counters.
+        """
+        mismatches = migrations.rebuild_counters(self.c)
+        self.close()
+        if mismatches:
+            DatabaseManager.notify(self.folder_path)
+        return mismatches
+    
     def initiate_folder(self, img_path, name):
         """Preps a folder for biondi body analysis.
         
@@ -123,36 +158,11 @@ class FileManagement():
         """
 
         copy(img_path, self.folder_path + "gridfile.jpg")
-        create_table_query = '''CREATE TABLE IF NOT EXISTS bodies (TIME INTEGER NOT NULL,
-                                                            ANNOTATOR_NAME TEXT,
-                                                            BODY_NAME TEXT NOT NULL, 
-                                                            BODY_NUMBER INTEGER NOT NULL,
-                                                            X_POSITION INTEGER NOT NULL,
-                                                            Y_POSITION INTEGER NOT NULL,
-                                                            GRID_ID TEXT NOT NULL,
-                                                            GR INTEGER,
-                                                            MAF INTEGER,
-                                                            MP INTEGER,
-                                                            UNSURE INTEGER,
-                                                            NOTES TEXT,
-                                                            BODY_FILE_NAME TEXT,
-                                                            ANNOTATION_FILE_NAME TEXT,
-                                                            ANGLE REAL,
-                                                            LOG REAL,
-                                                            DPRONG1 REAL,
-                                                            LPRONG2 REAL)'''
-        self.c.execute(create_table_query)
-        
-        create_grid_query = '''CREATE TABLE IF NOT EXISTS grid (GRID_ID TEXT NOT NULL,
-                                                                    FINISHED INTEGER)'''
-        self.c.execute(create_grid_query)
-        
-        create_ignored_query = '''CREATE TABLE IF NOT EXISTS ignored (X INTEGER NOT NULL,
-                                                                    Y INTEGER NOT NULL)'''
-        self.c.execute(create_ignored_query)
-        
-        create_name_query = '''CREATE TABLE IF NOT EXISTS name (NAME TEXT NOT NULL)'''
-        self.c.execute(create_name_query)
+        # cut once here so opening the case never decodes the whole gridfile
+        TilePyramid.build(self.folder_path)
+        # the tables are made by the same migrations that upgrade older cases
+        migrations.migrate(self.conn)
+        DatabaseManager.set_setting(self.folder_path, "image_store", config.image_store)
         
         randomized = GridRandomizer().get_final_order()
         random_list = []
@@ -188,63 +198,109 @@ class FileManagement():
         
         Args:
             body_info (dict): a collection of information created from the marker popup.
-                Dictionary values are a mixture of strings and ints, with booleans converted
-                to binary when entered into the database.
+                Dictionary values are a mixture of strings and ints, with booleans packed
+                into the flags column when entered into the database. The new body id and
+                file names are added to the dict.
             body_img (PIL img): image of just the biondi body
             annotation_img (pil img): image of just the annotation.
         """
             
-        data_values = tuple(body_info.values())
-        print(body_info.values())
         insert_query = '''INSERT INTO bodies (TIME, 
                                             ANNOTATOR_NAME, 
-                                            BODY_NAME, 
+                                            TYPE_ID, 
                                             BODY_NUMBER, 
                                             X_POSITION, 
                                             Y_POSITION, 
                                             GRID_ID, 
-                                            GR, 
-                                            MAF, 
-                                            MP, 
-                                            UNSURE, 
+                                            FLAGS, 
                                             NOTES, 
-                                            BODY_FILE_NAME, 
-                                            ANNOTATION_FILE_NAME,
                                             ANGLE,
                                             LOG,
                                             DPRONG1,
                                             LPRONG2) 
-                                            values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
-        
+                                            values (?, ?, 
+                                                    (SELECT TYPE_ID FROM body_types WHERE BODY_NAME = ?), 
+                                                    ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+        data_values = (body_info["time"], body_info["annotator_name"], body_info["body_name"],
+                       body_info["body_number"], body_info["x"], body_info["y"], body_info["grid_id"],
+                       self.pack_flags(body_info["GR"], body_info["MAF"], body_info["MP"], body_info["unsure"]),
+                       body_info["notes"], body_info["angle"], body_info["log"],
+                       body_info["dprong1"], body_info["lprong2"])
         self.c.execute(insert_query, data_values)
+        body_info["body_id"] = self.c.lastrowid
+        
+        # the id is part of the file names so two bodies saved in the same second do not collide
+        file_name = "{0}_{1}_{2}".format(body_info["body_name"], body_info["time"], body_info["body_id"])
+        body_info["body_file_name"] = file_name + ".png"
+        body_info["annotation_file_name"] = file_name + "_ANNOTATION.png"
+        file_name_query = '''UPDATE bodies
+                            SET BODY_FILE_NAME = ?,
+                            ANNOTATION_FILE_NAME = ?
+                            WHERE BODY_ID = ?'''
+        self.c.execute(file_name_query, (body_info["body_file_name"], body_info["annotation_file_name"], body_info["body_id"]))
+        
+        images = open_image_store(self.folder_path)
+        images.save(body_info["body_file_name"], body_img)
+        images.save(body_info["annotation_file_name"], annotation_img)
+        images.save(render_name(body_info["body_file_name"]), render_images(body_img, annotation_img))
         
-        body_info["body_number"] = self.count_bodies([body_info["body_name"]], False, False, False, False) + 1
-        body_img.save(self.folder_path + body_info["body_file_name"])
-        annotation_img.save(self.folder_path + body_info["annotation_file_name"])
+        self.close()
+        table = self.body_table()
+        if table is not None:
+            table.insert(body_info)
+        DatabaseManager.notify(self.folder_path)
+    
+    # every column of a body in the order convert_tuple reads them
+    body_columns = '''b.BODY_ID, b.TIME, b.ANNOTATOR_NAME, t.BODY_NAME, b.BODY_NUMBER,
+                    b.X_POSITION, b.Y_POSITION, b.GRID_ID, b.FLAGS, b.NOTES, 
+                    b.BODY_FILE_NAME, b.ANNOTATION_FILE_NAME, b.ANGLE, b.LOG, b.DPRONG1, b.LPRONG2'''
+    
+    def get_body(self, body_id):
+        """Pulls an image from the database using its body id.
         
+        Args:
+            body_id (int): The unique id given to the body when it was saved.
+            
+        Returns:
+            row (dict): a dict of all the values included in the database. See convert_tuple.
+                None if there is no body with that id, for example because it was deleted.
+        """
+        select_id_query = '''SELECT {0}
+                FROM bodies AS b
+                JOIN body_types AS t ON t.TYPE_ID = b.TYPE_ID
+                WHERE b.BODY_ID = ?'''.format(self.body_columns)
+
+        self.c.execute(select_id_query, (body_id,))
+        row = self.c.fetchone()
         self.close()
+        if row is None:
+            return None
+        
+        return self.convert_tuple(row)
     
     def get_image_time(self, time):
         """Pulls an image from the database using time as a parameter.
         
+        Bodies saved in the same second share a time, in which case the first
+        one saved is returned. Use get_body to get a specific body.
+        
         Args:
             time (int): Unix time of selected image.
             
         Returns:
-            row (dict): a dict of all the values included in the database in 
-                the order of (time (int), annotator name (str), body name (str), 
-                body number (int), x position (int),y position (int), grid id (str),
-                green ring (int), multiautoflorescence (int), multiprong (int), 
-                unsure (int), notes (str), body file name (str), and
-                annotation file name (str). Values may be enclosed in another tuple.
+            row (dict): a dict of all the values included in the database. See convert_tuple.
         """
-        select_time_query = '''SELECT *
-                FROM bodies 
-                WHERE TIME = ?'''
+        select_time_query = '''SELECT {0}
+                FROM bodies AS b
+                JOIN body_types AS t ON t.TYPE_ID = b.TYPE_ID
+                WHERE b.TIME = ?
+                ORDER BY b.BODY_ID'''.format(self.body_columns)
 
         self.c.execute(select_time_query, (time,))
         row = self.c.fetchone()
         self.close()
+        if row is None:
+            return None
         
         return self.convert_tuple(row)
         
@@ -259,76 +315,88 @@ class FileManagement():
             body_number (int): Number of specific body.
             
         Returns:
-            row (dict): a dict of all the values included in the database in 
-                the order of (time (int), annotator name (str), body name (str), 
-                body number (int), x position (int),y position (int), grid id (str),
-                green ring (int), multiautoflorescence (int), multiprong (int), 
-                unsure (int), notes (str), body file name (str), and
-                annotation file name (str). Values may be enclosed in another tuple.
+            row (dict): a dict of all the values included in the database. See convert_tuple.
         """
             
-        select_query = '''SELECT *
-                        FROM bodies 
-                        WHERE BODY_NAME = ? AND BODY_NUMBER = ?'''
+        select_query = '''SELECT {0}
+                        FROM bodies AS b
+                        JOIN body_types AS t ON t.TYPE_ID = b.TYPE_ID
+                        WHERE t.BODY_NAME = ? AND b.BODY_NUMBER = ?'''.format(self.body_columns)
         
         self.c.execute(select_query, (body_name, body_number))
         row = self.c.fetchone()
         self.close()
+        if row is None:
+            return None
         
         return self.convert_tuple(row)
     
     def convert_tuple(self, group):
         """Converts the database fetch from a tuple to a dictionary.
         
-        Since the database saves booleans as integers, we must convert it for use
-        later. In doing so, we converted the tuple into a dictionary for easier data
-        access.
+        Since the database packs the secondary annotations into one flags integer,
+        we must unpack it for use later. In doing so, we converted the tuple into a 
+        dictionary for easier data access.
         
         Args:
-            Group (tuple): Tuple of data fetched from database
+            Group (tuple): Tuple of data fetched from database with the body_columns.
+            
+        Returns:
+            data (dict): body id (int), time (int), annotator name (str), body name (str), 
+                body number (int), x position (int),y position (int), grid id (str),
+                green ring (bool), multiautoflorescence (bool), multiprong (bool), 
+                unsure (bool), notes (str), body file name (str), annotation file name (str),
+                angle (float), log (float), dprong1 (float), and lprong2 (float).
         """
         data = {}
         i = 0
-        for choice in ("time", "annotator_name", "body_name", "body_number", 
-                        "x", "y", "grid_id", "GR", "MAF", "MP", "unsure", 
-                        "notes", "body_file_name", "annotation_file_name", "angle", "log", "dprong1", "lprong2"):
+        for choice in ("body_id", "time", "annotator_name", "body_name", "body_number", 
+                        "x", "y", "grid_id", "flags", "notes", "body_file_name", 
+                        "annotation_file_name", "angle", "log", "dprong1", "lprong2"):
             data[choice] = group[i]
             i += 1
             
-        for choice in ("GR", "MAF", "MP", "unsure"): #can make into function later
-            if data[choice] == 1:
-                data[choice] = True
-            else:
-                data[choice] = False
+        flags = data.pop("flags")
+        for choice, bit in config.flag_bits.items():
+            data[choice] = flags & bit == bit
         return data
     
-    def secondary_name_grouping(self, name, params):
-        """Get appropriate amount of placeholders.
+    @staticmethod
+    def pack_flags(GR, MAF, MP, unsure):
+        """Packs the secondary annotations into the integer saved in the FLAGS column."""
+        flags = 0
+        for value, choice in ((GR, "GR"), (MAF, "MAF"), (MP, "MP"), (unsure, "unsure")):
+            if value:
+                flags |= config.flag_bits[choice]
+        return flags
+    
+    def filter_clause(self, body_param, GR_param, MAF_param, MP_param, unsure_param):
+        """Builds the WHERE clause shared by the filtered queries.
         
-        Function query_image needs to have a set of placeholders for use 
-        to dictate whether it will show all bodies or just bodies with GR,
-        MAF, or MP. This function creates either 1 or 2 placeholders for the 
-        'IN' logic in the query. It also appends the True or False as binary 
-        to scan the database appropriately.
+        A secondary param set to True only keeps bodies with that annotation. Instead
+        of masking FLAGS, every flags value that passes is listed so that the
+        TYPE_ID, FLAGS index can be searched directly.
         
         Args:
-            name (bool): True or false whether the user wants just the secondary 
-                annotation as True.
-            params (list): List of parameters for the query in query image
+            body_param (list): The names of the body types to keep.
+            GR_param (bool): True if sorting by only GR
+            MAF_param (bool): True if sorting by only MAF
+            MP_param (bool): True if sorting by only MP
+            unsure_param (bool): True if sorting by only unsure
             
         Returns:
-            param_ph (list): Appended parameter list with GR, MAF, and MP values
-                listed.
+            clause (str): The condition with placeholders on the bodies table.
+            params (list): The values of the placeholders.
         """
-
-        if name:
-            param_ph = "?"
-            params.append(1)
-        else: 
-            param_ph = "?,?"
-            params.append(0)
-            params.append(1)
-        return param_ph
+        required = self.pack_flags(GR_param, MAF_param, MP_param, unsure_param)
+        all_flags = sum(config.flag_bits.values())
+        flag_values = [flags for flags in range(all_flags + 1) if flags & required == required]
+        
+        body_param_ph = ",".join("?" * len(body_param))
+        flags_ph = ",".join("?" * len(flag_values))
+        clause = '''TYPE_ID IN (SELECT TYPE_ID FROM body_types WHERE BODY_NAME IN ({0}))
+                        AND FLAGS IN ({1})'''.format(body_param_ph, flags_ph)
+        return clause, list(body_param) + flag_values
 
     def query_images(self, body_param, GR_param, MAF_param, MP_param, unsure_param):
         """Takes a set of parameters to pull all images that fall under params.
@@ -338,36 +406,24 @@ class FileManagement():
         to add the appropriate amount of placeholders for use in SQL searching.
         
         Args:
-            body_param (list): a list of parameters including a list of all 
-                requested biondi types which is later appended with integers
-                on GR, MAF, MP, or unsure.
+            body_param (list): a list of all requested biondi types.
             GR_param (bool): True if sorting by only GR
             MAF_param (bool): True if sorting by only MAF
             MP_param (bool): True if sorting by only MP
             unsure_param (bool): True if sorting by only unsure
             
         Returns: 
-            group (tuple): Tuple of time (int), body name (str), body number (int), 
+            group (tuple): Tuple of body id (int), time (int), body name (str), body number (int), 
                 x position (int), and y position (int). Values may be included in another
                 tuple 
         """
+        filter_clause, query_bodies = self.filter_clause(body_param, GR_param, MAF_param, MP_param, unsure_param)
         
-        query_bodies = body_param.copy()
-        body_param_ph = "?,"*(len(query_bodies)-1)+"?"
-        
-        GR_param_ph = self.secondary_name_grouping(GR_param, query_bodies)
-        MAF_param_ph = self.secondary_name_grouping(MAF_param, query_bodies)
-        MP_param_ph = self.secondary_name_grouping(MP_param, query_bodies)
-        unsure_param_ph = self.secondary_name_grouping(unsure_param, query_bodies)
-        
-        group_query = '''SELECT TIME, BODY_NAME, BODY_NUMBER, X_POSITION, Y_POSITION
-                        FROM bodies 
-                        WHERE BODY_NAME IN ({0}) 
-                        AND GR IN ({1}) 
-                        AND MAF IN ({2}) 
-                        AND MP IN ({3})
-                        AND UNSURE IN ({4})
-                        ORDER BY TIME DESC'''.format(body_param_ph, GR_param_ph, MAF_param_ph, MP_param_ph, unsure_param_ph)
+        group_query = '''SELECT b.BODY_ID, b.TIME, t.BODY_NAME, b.BODY_NUMBER, b.X_POSITION, b.Y_POSITION
+                        FROM bodies AS b
+                        JOIN body_types AS t ON t.TYPE_ID = b.TYPE_ID
+                        WHERE b.{0}
+                        ORDER BY b.TIME DESC, b.BODY_ID DESC'''.format(filter_clause)
         
         self.c.execute(group_query, query_bodies)
         group = self.c.fetchall()
@@ -375,6 +431,129 @@ class FileManagement():
         self.close()
         return group
     
+    def query_images_page(self, body_param, GR_param, MAF_param, MP_param, unsure_param, 
+                          after = None, page_size = config.page_size):
+        """Pulls one page of the bodies query_images would return.
+        
+        Pages are read with a keyset on (TIME, BODY_ID) instead of an OFFSET, so
+        every page costs the same no matter how deep into the case it is and
+        bodies added or deleted between pages do not shift the pages.
+        
+        Args:
+            body_param (list): a list of all requested biondi types.
+            GR_param (bool): True if sorting by only GR
+            MAF_param (bool): True if sorting by only MAF
+            MP_param (bool): True if sorting by only MP
+            unsure_param (bool): True if sorting by only unsure
+            after (tuple): The token returned with the previous page. None starts
+                from the newest body.
+            page_size (int): The most rows returned.
+            
+        Returns: 
+            page (list): Rows in the same format and order as query_images.
+            token (tuple): (time, body id) of the last row to resume from, None if
+                this was the last page.
+        """
+        filter_clause, query_bodies = self.filter_clause(body_param, GR_param, MAF_param, MP_param, unsure_param)
+        keyset_clause = ""
+        if after is not None:
+            keyset_clause = "AND (b.TIME, b.BODY_ID) < (?, ?)"
+            query_bodies += list(after)
+        
+        # Walking the time index costs about page_size * total / matched rows per page,
+        # sorting the filtered bodies costs about matched rows. The counters make
+        # both numbers free so the cheaper plan is picked here, sqlite guesses
+        # wrong once the keyset adds a TIME bound.
+        matched = self.count_bodies(body_param, GR_param, MAF_param, MP_param, unsure_param)
+        self.c.execute('''SELECT COALESCE(SUM(COUNT), 0) FROM body_counts''')
+        total = self.c.fetchone()[0]
+        if matched * matched > page_size * total:
+            index_clause = "INDEXED BY bodies_time_index"
+        else:
+            index_clause = "INDEXED BY bodies_filter_index"
+        
+        page_query = '''SELECT b.BODY_ID, b.TIME, t.BODY_NAME, b.BODY_NUMBER, b.X_POSITION, b.Y_POSITION
+                        FROM bodies AS b {2}
+                        JOIN body_types AS t ON t.TYPE_ID = b.TYPE_ID
+                        WHERE b.{0} {1}
+                        ORDER BY b.TIME DESC, b.BODY_ID DESC
+                        LIMIT ?'''.format(filter_clause, keyset_clause, index_clause)
+        
+        self.c.execute(page_query, query_bodies + [page_size])
+        page = self.c.fetchall()
+        self.close()
+        
+        token = None
+        if len(page) == page_size:
+            token = (page[-1][1], page[-1][0])
+        return page, token
+    
+    def iter_image_pages(self, body_param, GR_param, MAF_param, MP_param, unsure_param, 
+                         after = None, page_size = config.page_size):
+        """Yields the bodies query_images would return one page at a time.
+        
+        Each page is its own query, so no read is left open on the database while
+        the caller works through a page.
+        
+        Typical usage example:
+            pages = FileManagement(folder_path).iter_image_pages(config.all_bodies, False, False, False, False)
+            page, token = next(pages)
+                
+        Yields:
+            page (list): See query_images_page.
+            token (tuple): Token to resume after this page, None on the last page.
+        """
+        while True:
+            page, after = FileManagement(self.folder_path).query_images_page(
+                body_param, GR_param, MAF_param, MP_param, unsure_param, after, page_size)
+            yield page, after
+            if after is None:
+                return
+    
+    def query_markers_page(self, after = None, page_size = config.page_size):
+        """Pulls one page of what the gridfile markers need of every body, newest first.
+        
+        Args:
+            after (tuple): The token returned with the previous page. None starts
+                from the newest body.
+            page_size (int): The most rows returned.
+            
+        Returns:
+            page (list): (body id, time, body name, flags, x, y) of every body.
+            token (tuple): (time, body id) of the last row to resume from, None if
+                this was the last page.
+        """
+        keyset_clause = ""
+        query_values = []
+        if after is not None:
+            keyset_clause = "WHERE (b.TIME, b.BODY_ID) < (?, ?)"
+            query_values = list(after)
+        
+        page_query = '''SELECT b.BODY_ID, b.TIME, t.BODY_NAME, b.FLAGS, b.X_POSITION, b.Y_POSITION
+                        FROM bodies AS b INDEXED BY bodies_time_index
+                        JOIN body_types AS t ON t.TYPE_ID = b.TYPE_ID
+                        {0}
+                        ORDER BY b.TIME DESC, b.BODY_ID DESC
+                        LIMIT ?'''.format(keyset_clause)
+        
+        self.c.execute(page_query, query_values + [page_size])
+        page = self.c.fetchall()
+        self.close()
+        
+        token = None
+        if len(page) == page_size:
+            token = (page[-1][1], page[-1][0])
+        return page, token
+    
+    def iter_markers_pages(self, page_size = config.page_size):
+        """Yields the pages of query_markers_page one at a time, see iter_image_pages."""
+        after = None
+        while True:
+            page, after = FileManagement(self.folder_path).query_markers_page(after, page_size)
+            yield page, after
+            if after is None:
+                return
+    
     def add_ignored(self, coords):
         """Adds the information for an ignored marker in the database."""
         add_ignored_query = '''INSERT 
@@ -401,33 +580,42 @@ class FileManagement():
         return ignored
     
     def edit_info(self, edited_info): # rewrite
-        """Edits the info of a biondi body if needed."""
+        """Edits the info of a biondi body if needed.
+        
+        Args:
+            edited_info (tuple): body name (str), GR (bool), MAF (bool), MP (bool), 
+                unsure (bool), notes (str), angle (float), log (float), dprong1 (float),
+                lprong2 (float) and the body id (int) of the body being edited.
+        """
+        (body_name, GR, MAF, MP, unsure, notes, 
+         angle, log, dprong1, lprong2, body_id) = edited_info
         edit_query = '''UPDATE bodies
-                        SET BODY_NAME = ?,
-                        GR = ?,
-                        MAF = ?,
-                        MP = ?, 
-                        UNSURE = ?, 
+                        SET TYPE_ID = (SELECT TYPE_ID FROM body_types WHERE BODY_NAME = ?),
+                        FLAGS = ?,
                         NOTES = ?,
                         ANGLE = ?,
                         LOG = ?,
                         DPRONG1 = ?,
                         LPRONG2 = ?
-                        WHERE TIME = ?'''
+                        WHERE BODY_ID = ?'''
                         
-        
-        self.c.execute(edit_query, edited_info)
+        self.c.execute(edit_query, (body_name, self.pack_flags(GR, MAF, MP, unsure), notes,
+                                    angle, log, dprong1, lprong2, body_id))
         self.close()
-
-
+        table = self.body_table()
+        if table is not None:
+            table.edit(body_id, body_name, self.pack_flags(GR, MAF, MP, unsure))
+        DatabaseManager.notify(self.folder_path)
                         
     def renumber_img(self, body_name, body_number):
         """Fixes body number if any discrepancies occur.
         
-        Pulls a tuple of all the times sorted from oldest to newest
-        of a select body type. Reiterates through the entire database
-        of a select body and renumber the body numbers chronologically from
-        a certain body number.
+        Numbers every body of a select body type chronologically in one
+        statement using a window function, so the cost does not grow with a
+        round trip per row. Only bodies from a certain body number whose number
+        is actually wrong are written. SQLite older than 3.33 has no UPDATE FROM,
+        so there the numbers are computed by the window function and written
+        with a single executemany.
         
         Args:
             body_name (str): name of the wanted body
@@ -435,37 +623,59 @@ class FileManagement():
                 bodies would be renumbered Starts from 1. 
             
         Returns:
-            bool: False if there are no bodies in the selected body type
+            changed (int): the number of bodies whose number was changed.
         """
         
-        renumber_query = '''UPDATE bodies 
-                            SET BODY_NUMBER = ?
-                            WHERE BODY_NAME = ? AND TIME = ?'''
-        
-        get_time_query = '''SELECT TIME 
-                            from bodies where 
-                            BODY_NAME = ?
-                            ORDER BY TIME'''
-                                        
-        
-        self.c.execute(get_time_query, (body_name,)) 
-        time = self.c.fetchall()
-        
-        num_bodies = len(time)
-        if num_bodies == 0:
-            return False
-        
-        for i in range(body_number, num_bodies + 1):
-            self.c.execute(renumber_query, (i, body_name, time[i-1][0]))
+        table = self.body_table()
+        if table is not None:
+            table.renumber(body_name, body_number)
+        
+        numbered_query = '''SELECT BODY_ID, ROW_NUMBER() OVER (ORDER BY TIME, BODY_ID) AS NEW_NUMBER
+                            FROM bodies 
+                            WHERE TYPE_ID = (SELECT TYPE_ID FROM body_types WHERE BODY_NAME = ?)'''
+        
+        if sqlite3.sqlite_version_info >= (3, 33, 0):
+            renumber_query = '''UPDATE bodies 
+                                SET BODY_NUMBER = numbered.NEW_NUMBER
+                                FROM ({0}) AS numbered
+                                WHERE bodies.BODY_ID = numbered.BODY_ID
+                                AND numbered.NEW_NUMBER >= ?
+                                AND bodies.BODY_NUMBER != numbered.NEW_NUMBER'''.format(numbered_query)
+            self.c.execute(renumber_query, (body_name, body_number))
+            return self.c.rowcount
+        
+        changed_query = '''SELECT numbered.NEW_NUMBER, numbered.BODY_ID
+                            FROM ({0}) AS numbered
+                            JOIN bodies ON bodies.BODY_ID = numbered.BODY_ID
+                            WHERE numbered.NEW_NUMBER >= ?
+                            AND bodies.BODY_NUMBER != numbered.NEW_NUMBER'''.format(numbered_query)
+        changed = self.c.execute(changed_query, (body_name, body_number)).fetchall()
+        self.c.executemany('''UPDATE bodies SET BODY_NUMBER = ? WHERE BODY_ID = ?''', changed)
+        return len(changed)
 
     def delete_img(self, body_name, body_number):
+        file_name_query = '''SELECT BODY_FILE_NAME
+                            FROM bodies 
+                            WHERE TYPE_ID = (SELECT TYPE_ID FROM body_types WHERE BODY_NAME = ?) 
+                            AND BODY_NUMBER = ?'''
         delete_query = '''DELETE 
                         FROM bodies 
-                        WHERE BODY_NAME = ? and BODY_NUMBER = ?''' 
+                        WHERE TYPE_ID = (SELECT TYPE_ID FROM body_types WHERE BODY_NAME = ?) 
+                        AND BODY_NUMBER = ?''' 
                         
+        file_names = self.c.execute(file_name_query, (body_name, body_number)).fetchall()
         self.c.execute(delete_query, (body_name, body_number))
+        # the render is only ever made from the images of the body, which are kept
+        images = open_image_store(self.folder_path)
+        for body_file_name, in file_names:
+            if body_file_name is not None:
+                images.remove(render_name(body_file_name))
+        table = self.body_table()
+        if table is not None:
+            table.delete(body_name, body_number)
         self.renumber_img(body_name, body_number)
         self.close()
+        DatabaseManager.notify(self.folder_path)
 
     def merge_img(self, img, annotation, new_name):
         """Concentate annotation and body image to one png
@@ -479,89 +689,240 @@ class FileManagement():
             new_name (str): the new name to be given to the new concentated
                 image
         """
+        images = open_image_store(self.folder_path)
+        render = render_name(img)
+        merge_images(images.source(img), images.source(annotation), new_name, 
+                     images.source(render) if images.exists(render) else None)
+
+    def open_image(self, file_name):
+        """Opens a body or annotation image of the case.
         
-        body_img = Image.open(self.folder_path + img)
-        annotation_img = Image.open(self.folder_path + annotation)
-        body_img.paste(annotation_img, (0,0), annotation_img)
-        body_img.save(new_name)
+        Args:
+            file_name (str): BODY_FILE_NAME or ANNOTATION_FILE_NAME of a body.
+            
+        Returns:
+            img (PIL Image): The image, read from whichever store the case uses.
+        """
+        img = open_image_store(self.folder_path).open(file_name)
+        self.close()
+        return img
 
-    def export_case(self, new_folder_path, case_name):
-        """Turns all images into concentated images
+    def open_render(self, body_file_name, annotation_file_name):
+        """Opens the body image of a body with its annotation pasted on top.
         
-        Iterates through all rows in the database to turn each row into
-        a singular png. ALso creates a new file name in the format of
-        BODY NAME_ANNOTATOR INITIALS_BODY NUMBER_GR_MAF_MP. GR, MAF, and 
-        MP are optional if the body does not possess those characteristics.
-        Converts .db file into a csv file for review
+        The render is saved along with the images of a body and again whenever
+        its annotation is replaced. A body saved before renders were kept has its
+        render made the first time it is opened.
+        
+        Args:
+            body_file_name (str): BODY_FILE_NAME of the body.
+            annotation_file_name (str): ANNOTATION_FILE_NAME of the body.
+            
+        Returns:
+            img (PIL Image): The render.
+        """
+        images = open_image_store(self.folder_path)
+        name = render_name(body_file_name)
+        try:
+            img = images.open(name)
+        except FileNotFoundError:
+            # the thumbnail and body cache threads can both ask for a missing render
+            with _render_lock:
+                if images.exists(name):
+                    img = images.open(name)
+                else:
+                    img = render_images(images.open(body_file_name), images.open(annotation_file_name))
+                    images.save(name, img)
+        self.close()
+        return img
+
+    def save_annotation(self, body_info, annotation_img, body_img = None):
+        """Replaces the annotation image of a body and renders it again.
+        
+        Args:
+            body_info (dict): The body, see convert_tuple.
+            annotation_img (PIL Image): The new annotation.
+            body_img (PIL Image): The body image if it is already open, read from 
+                the case otherwise.
+        """
+        images = open_image_store(self.folder_path)
+        if body_img is None:
+            body_img = images.open(body_info["body_file_name"])
+        images.save(body_info["annotation_file_name"], annotation_img)
+        with _render_lock:
+            images.save(render_name(body_info["body_file_name"]), render_images(body_img, annotation_img))
+        self.close()
+
+    def export_jobs(self, new_folder_path, case_name):
+        """Lists the merged images an export of the case is made of.
+        
+        The file names are in the format of CASE NAME_BODY NAME_ANNOTATOR INITIALS_BODY NUMBER_GR_MAF_MP. 
+        GR, MAF, and MP are optional if the body does not possess those characteristics.
         
         Args:
             new_folder_path (str): File directory where the exported case will
                 be saved
+            case_name (str): Name the exported files start with.
+            
+        Returns:
+            jobs (list): Tuples of the body id, body image source, annotation image source, 
+                exported image path and render source, oldest body first. These can be passed 
+                to merge_images, see image_store.open_source. The render source is None for a 
+                body that has no render yet.
         """
-
-        all_files_query = '''SELECT ANNOTATOR_NAME, 
-                            BODY_NAME, 
-                            BODY_NUMBER, 
-                            GR, 
-                            MAF, 
-                            MP, 
-                            BODY_FILE_NAME, 
-                            ANNOTATION_FILE_NAME
-                            FROM bodies'''
+        all_files_query = '''SELECT b.ANNOTATOR_NAME, 
+                            t.BODY_NAME, 
+                            b.BODY_NUMBER, 
+                            b.FLAGS, 
+                            b.BODY_FILE_NAME, 
+                            b.ANNOTATION_FILE_NAME,
+                            b.BODY_ID
+                            FROM bodies AS b
+                            JOIN body_types AS t ON t.TYPE_ID = b.TYPE_ID
+                            ORDER BY b.TIME, b.BODY_ID'''
                             
         self.c.execute(all_files_query)
         
-        while True:
-            body_info = self.c.fetchone()
-            if body_info is None:
-                break
+        images = open_image_store(self.folder_path)
+        jobs = []
+        for body_info in self.c.fetchall():
             img_name = "{0}{1}_{2}_{3}_{4}".format(new_folder_path, case_name, body_info[1], body_info[0], body_info[2])
-            if body_info[3] == 1:
-                img_name += "_GR"
-            if body_info[4] == 1:
-                img_name += "_MAF"
-            if body_info[5] == 1:
-                img_name += "_MP"
+            for choice in ("GR", "MAF", "MP"):
+                if body_info[3] & config.flag_bits[choice]:
+                    img_name += "_" + choice
             img_name += ".png"
-            
-            self.merge_img(body_info[6], body_info[7], img_name)
-            
-        all_info_query = '''SELECT TIME,
-                            ANNOTATOR_NAME,
-                            BODY_NAME,
-                            BODY_NUMBER,
-                            X_POSITION,
-                            Y_POSITION,
-                            GRID_ID,
-                            GR,
-                            MAF,
-                            MP,
-                            UNSURE,
-                            NOTES,
-                            ANGLE,
-                            LOG,
-                            DPRONG1,
-                            LPRONG2
-                            FROM bodies'''
-                            
-        self.c.execute(all_info_query)
+            render = render_name(body_info[4])
+            jobs.append((body_info[6], images.source(body_info[4]), images.source(body_info[5]), img_name,
+                         images.source(render) if images.exists(render) else None))
+        return jobs
+    
+    # the bodies columns are the ones of the original csv, FLAGS is unpacked
+    export_queries = {"bodies": '''SELECT b.TIME,
+                                b.ANNOTATOR_NAME,
+                                t.BODY_NAME,
+                                b.BODY_NUMBER,
+                                b.X_POSITION,
+                                b.Y_POSITION,
+                                b.GRID_ID,
+                                (b.FLAGS & ?) != 0 AS GR,
+                                (b.FLAGS & ?) != 0 AS MAF,
+                                (b.FLAGS & ?) != 0 AS MP,
+                                (b.FLAGS & ?) != 0 AS UNSURE,
+                                b.NOTES,
+                                b.ANGLE,
+                                b.LOG,
+                                b.DPRONG1,
+                                b.LPRONG2
+                                FROM bodies AS b
+                                JOIN body_types AS t ON t.TYPE_ID = b.TYPE_ID
+                                ORDER BY b.TIME, b.BODY_ID''',
+                      "grid": '''SELECT * from grid'''}
+    
+    def stream_table(self, table, batch_size = config.export_batch_size):
+        """Reads one of the exported tables a batch of rows at a time.
         
-        data = self.c.fetchall()
-        with open(f"{new_folder_path}{case_name}-bodies.csv", "w", newline = "") as csv_file:
-            csv_writer = csv.writer(csv_file)
-            csv_writer.writerow([i[0] for i in self.c.description])
-            csv_writer.writerows(data)
+        Only one batch is held in memory at once, so the tables of a case of any
+        size can be exported. The rows are read from their own cursor.
         
-        grid_query = '''SELECT * from grid'''
+        Args:
+            table (str): A key of export_queries.
+            batch_size (int): The most rows in a batch.
+            
+        Returns:
+            header (list): The names of the columns.
+            batches (generator): Lists of row tuples.
+        """
+        c = self.conn.cursor()
+        params = []
+        if table == "bodies":
+            params = [config.flag_bits[choice] for choice in ("GR", "MAF", "MP", "unsure")]
+        c.execute(self.export_queries[table], params)
+        header = [i[0] for i in c.description]
+        
+        def batches():
+            try:
+                while True:
+                    rows = c.fetchmany(batch_size)
+                    if not rows:
+                        return
+                    yield rows
+            finally:
+                c.close()
+        return header, batches()
+
+    def export_case(self, new_folder_path, case_name, formats = ("csv",)):
+        """Turns all images into concentated images
         
-        self.c.execute(grid_query)
-        grid = self.c.fetchall()
-        with open(f"{new_folder_path}{case_name}-grid.csv", "w", newline = "") as csv_file:
-            csv_writer = csv.writer(csv_file)
-            csv_writer.writerow([i[0] for i in self.c.description])
-            csv_writer.writerows(grid)
+        Iterates through all rows in the database to turn each row into
+        a singular png named by export_jobs, then exports the tables of the case.
+        Only bodies that are new or changed since the last export into the 
+        folder are merged again, see exporter.CaseExport. This waits for the export 
+        and makes the images one at a time, the program exports through CaseExport 
+        directly which spreads the images over several processes.
         
+        Args:
+            new_folder_path (str): File directory where the exported case will
+                be saved
+            case_name (str): Name the exported files start with.
+            formats (tuple): Keys of exporter.table_exporters the tables are exported in.
+            
+        Returns:
+            errors (list): Tuple of (exported image path, exception) for every image that failed.
+        """
+        # exporter imports this module so it can only be imported once both are loaded
+        from exporter import CaseExport
+        case_export = CaseExport(self.folder_path, new_folder_path, case_name, workers = 0, formats = formats)
+        case_export.start()
         self.close()
+        return case_export.wait()
+
+_render_lock = threading.Lock()
+
+def render_images(body_img, annotation_img):
+    """Returns a copy of a body image with its annotation pasted on top.
+    
+    The render keeps the mode of the body image, so a body with an alpha 
+    channel exports with it as the merged images always did.
+    
+    Args:
+        body_img (PIL Image): The body image.
+        annotation_img (PIL Image): The annotation image, drawn over the body 
+            where it is not transparent.
+            
+    Returns:
+        render (PIL Image): An image the size and mode of the body image.
+    """
+    render = body_img.copy()
+    annotation = annotation_img.convert("RGBA")
+    render.paste(annotation, (0, 0), annotation)
+    return render
+
+def merge_images(img_source, annotation_source, new_name, render_source = None):
+    """Pastes an annotation on top of its body image and saves it as a png.
+    
+    A body that has a render is exported by copying the render as it is, 
+    without decoding anything. The png is written under a temporary name and moved into place once it is 
+    complete, so a file at new_name is always a finished image even if the 
+    export was interrupted. This is a module function so it can be run by a 
+    process pool.
+    
+    Args:
+        img_source: Location of the body image, see image_store.open_source.
+        annotation_source: Location of the annotation image.
+        new_name (str): Path of the merged image.
+        render_source: Location of the render of the body, None if it has none.
+        
+    Returns:
+        new_name (str): Path of the merged image.
+    """
+    part_name = new_name + ".part"
+    if render_source is not None:
+        with open(part_name, "wb") as part_file:
+            part_file.write(read_source(render_source))
+    else:
+        render_images(open_source(img_source), open_source(annotation_source)).save(part_name, format = "PNG")
+    os.replace(part_name, new_name)
+    return new_name
         
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -0,0 +1,400 @@
+"""Where the body and annotation images of a case are kept.
+
+A case keeps its images either as loose png files next to body_database.db or
+packed into a single append-only pack file. The image_pack table of the case
+database holds the offset and length of every image in the pack. Which store a
+case uses is saved in its settings table under "image_store" and the name of
+its pack under "image_pack".
+
+Images are found by the file names saved in the bodies table in both stores, so
+switching a case between them does not touch the bodies. Next to its body and
+annotation images every body has a render, see render_name.
+
+This module can also be run as a script to convert a case:
+    python image_store.py <case folder> packed|loose
+
+Typical usage example:
+    store = open_image_store(folder_path)
+    img = store.open(body_info["body_file_name"])
+"""
+
+import os
+import io
+import sys
+import mmap
+import threading
+from PIL import Image
+from database_manager import DatabaseManager
+
+def open_source(source):
+    """Opens an image from a location returned by the source method of a store.
+
+    A module function so worker processes can read images without a store of
+    their own.
+
+    Args:
+        source: A file path or a tuple of (pack path, offset, length).
+
+    Returns:
+        img (PIL Image): The decoded image.
+    """
+    if isinstance(source, str):
+        return Image.open(source)
+    pack_path, offset, length = source
+    with open(pack_path, "rb") as pack_file:
+        pack_file.seek(offset)
+        return Image.open(io.BytesIO(pack_file.read(length)))
+
+def read_source(source):
+    """Returns the encoded bytes of an image from a location returned by the source method of a store."""
+    if isinstance(source, str):
+        with open(source, "rb") as image_file:
+            return image_file.read()
+    pack_path, offset, length = source
+    with open(pack_path, "rb") as pack_file:
+        pack_file.seek(offset)
+        return pack_file.read(length)
+
+def render_name(body_file_name):
+    """Returns the name the render of a body is saved under.
+
+    The render is the body image with its annotation pasted on top, which is
+    what the image viewer, exports and thumbnails show. It is named after the
+    body image so it needs no column of its own.
+    """
+    return os.path.splitext(body_file_name)[0] + "_RENDER.png"
+
+def pack_name(generation):
+    """Returns the file name of a pack, every compaction writes the next generation."""
+    if generation == 0:
+        return "images.pack"
+    return "images.{0}.pack".format(generation)
+
+def pack_generation(name):
+    """Returns the generation of a pack file name, None for a file that is not a pack."""
+    if name == "images.pack":
+        return 0
+    parts = name.split(".")
+    if len(parts) == 3 and parts[0] == "images" and parts[1].isdigit() and parts[2] == "pack":
+        return int(parts[1])
+    return None
+
+def source_file(source):
+    """Returns the path of the file that holds the image at a location returned by the source method of a store."""
+    if isinstance(source, str):
+        return source
+    return source[0]
+
+class LooseImageStore():
+    """Keeps every image as its own png file in the case folder.
+
+    Attributes:
+        folder_path (str): The directory of the case folder.
+    """
+    backend = "loose"
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+
+    def open(self, name):
+        """Returns the image saved under a file name."""
+        return Image.open(self.folder_path + name)
+
+    def read(self, name):
+        """Returns the encoded bytes of the image saved under a file name."""
+        with open(self.folder_path + name, "rb") as image_file:
+            return image_file.read()
+
+    def save(self, name, img):
+        """Saves an image as a png under a file name, replacing an older image of the same name."""
+        # written under a temporary name so a reader on another thread never sees half an image
+        part_path = self.folder_path + name + ".part"
+        img.save(part_path, format = "PNG")
+        os.replace(part_path, self.folder_path + name)
+
+    def write(self, name, data):
+        """Saves already encoded png bytes under a file name."""
+        part_path = self.folder_path + name + ".part"
+        with open(part_path, "wb") as image_file:
+            image_file.write(data)
+        os.replace(part_path, self.folder_path + name)
+
+    def exists(self, name):
+        return os.path.exists(self.folder_path + name)
+
+    def source(self, name):
+        """Returns a location of the image open_source can read in another process."""
+        return self.folder_path + name
+
+    def stamp(self, name):
+        """Returns a value that changes whenever the image saved under a name is replaced."""
+        try:
+            stat = os.stat(self.folder_path + name)
+        except OSError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def remove(self, name):
+        if self.exists(name):
+            os.remove(self.folder_path + name)
+
+    def close(self):
+        pass
+
+class PackedImageStore():
+    """Appends every image to the single pack file of the case.
+
+    The encoded png is appended to the pack and its offset and length are saved
+    in the image_pack table once the bytes are on disk, so the index never
+    points at data that was not written. Saving an image again appends a new
+    copy and moves the index, the old copy stays in the pack until the case is
+    converted, which compacts it. Reads slice a memory map of the pack.
+
+    Attributes:
+        folder_path (str): The directory of the case folder.
+        pack_path (str): The path of the pack file, the one named in the
+            "image_pack" setting unless another name is given.
+    """
+    backend = "packed"
+
+    def __init__(self, folder_path, name = None):
+        self.folder_path = folder_path
+        if name is None:
+            conn = DatabaseManager.get_connection(folder_path)
+            name = DatabaseManager.get_setting(conn, "image_pack", pack_name(0))
+        self.pack_path = folder_path + name
+        self._map = None
+        self._lock = threading.Lock()
+
+    def _locate(self, name):
+        conn = DatabaseManager.get_connection(self.folder_path)
+        row = conn.execute('''SELECT OFFSET, LENGTH FROM image_pack WHERE NAME = ?''', (name,)).fetchone()
+        if row is None:
+            raise FileNotFoundError("{0} is not in {1}".format(name, self.pack_path))
+        return row
+
+    def read(self, name):
+        """Returns the encoded bytes of the image saved under a file name."""
+        offset, length = self._locate(name)
+        with self._lock:
+            # the map is made again once the pack has grown past it
+            if self._map is None or offset + length > len(self._map):
+                if self._map is not None:
+                    self._map.close()
+                with open(self.pack_path, "rb") as pack_file:
+                    self._map = mmap.mmap(pack_file.fileno(), 0, access = mmap.ACCESS_READ)
+            return self._map[offset:offset + length]
+
+    def open(self, name):
+        """Returns the image saved under a file name."""
+        return Image.open(io.BytesIO(self.read(name)))
+
+    def save(self, name, img):
+        """Saves an image as a png under a file name, replacing an older image of the same name."""
+        data = io.BytesIO()
+        img.save(data, format = "PNG")
+        self.write(name, data.getvalue())
+
+    def write(self, name, data):
+        """Appends already encoded png bytes to the pack under a file name."""
+        with self._lock:
+            with open(self.pack_path, "ab") as pack_file:
+                offset = pack_file.tell()
+                pack_file.write(data)
+                pack_file.flush()
+                os.fsync(pack_file.fileno())
+        conn = DatabaseManager.get_connection(self.folder_path)
+        # the index row joins the transaction of the caller if one is open
+        in_transaction = conn.in_transaction
+        conn.execute('''INSERT OR REPLACE INTO image_pack (NAME, OFFSET, LENGTH) VALUES (?, ?, ?)''',
+                     (name, offset, len(data)))
+        if not in_transaction:
+            conn.commit()
+
+    def exists(self, name):
+        conn = DatabaseManager.get_connection(self.folder_path)
+        return conn.execute('''SELECT 1 FROM image_pack WHERE NAME = ?''', (name,)).fetchone() is not None
+
+    def source(self, name):
+        """Returns a location of the image open_source can read in another process."""
+        offset, length = self._locate(name)
+        return (self.pack_path, offset, length)
+
+    def stamp(self, name):
+        """Returns a value that changes whenever the image saved under a name is replaced."""
+        try:
+            return list(self._locate(name))
+        except FileNotFoundError:
+            return None
+
+    def remove(self, name):
+        conn = DatabaseManager.get_connection(self.folder_path)
+        in_transaction = conn.in_transaction
+        conn.execute('''DELETE FROM image_pack WHERE NAME = ?''', (name,))
+        if not in_transaction:
+            conn.commit()
+
+    def close(self):
+        """Releases the memory map so the pack can be moved or deleted."""
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+
+image_stores = {LooseImageStore.backend: LooseImageStore,
+                PackedImageStore.backend: PackedImageStore}
+
+_open_stores = {}
+# the cases _on_case_event is subscribed to, a store made again after a conversion reuses it
+_subscribed = set()
+_stores_lock = threading.Lock()
+
+def open_image_store(folder_path):
+    """Returns the image store of a case.
+
+    The store is kept until the case is closed, so a packed store keeps its
+    memory map between reads. Opening it first removes the pack files of the
+    case no committed index refers to, left behind by an interrupted conversion.
+
+    Args:
+        folder_path (str): The directory of the case folder ending with a slash.
+    """
+    key = DatabaseManager.case_key(folder_path)
+    with _stores_lock:
+        store = _open_stores.get(key)
+        if store is None:
+            conn = DatabaseManager.get_connection(folder_path)
+            backend = DatabaseManager.get_setting(conn, "image_store", LooseImageStore.backend)
+            store = image_stores[backend](folder_path)
+            _remove_stale_packs(folder_path, store)
+            _open_stores[key] = store
+            if key not in _subscribed:
+                _subscribed.add(key)
+                DatabaseManager.subscribe(folder_path, lambda event: _on_case_event(key, event))
+    return store
+
+def _on_case_event(key, event):
+    if event == "closed":
+        # the listeners of a closed case are dropped
+        with _stores_lock:
+            store = _open_stores.pop(key, None)
+            _subscribed.discard(key)
+        if store is not None:
+            store.close()
+
+def _remove_stale_packs(folder_path, store):
+    """Removes every pack file of a case other than the one its store reads."""
+    active = getattr(store, "pack_path", None)
+    for name in os.listdir(folder_path):
+        stale = pack_generation(name) is not None or name.endswith(".pack.part")
+        if stale and folder_path + name != active:
+            # a pack another program still has open is removed the next time the case is opened
+            try:
+                os.remove(folder_path + name)
+            except OSError:
+                pass
+
+def convert_image_store(folder_path, backend):
+    """Moves every image of a case into another store.
+
+    The images named in the bodies table and their renders are copied into the new store before
+    the case is switched over, and only then removed from the old one, so an
+    interrupted conversion leaves the case on the old store with every image.
+    Converting a packed case to packed again compacts the pack by dropping the
+    copies that were replaced.
+
+    A new pack is written under the name of the next generation. Its index, the
+    "image_pack" and "image_store" settings are switched in one transaction and
+    the old pack is only removed after that commits, so the committed index
+    always points into a complete pack. A pack left over by an interruption is
+    removed the next time the store is opened.
+
+    The old store is closed and the listeners of the case are sent "images",
+    so anything holding it or sources into the old pack opens the store again.
+
+    Args:
+        folder_path (str): The directory of the case folder ending with a slash.
+        backend (str): A key of image_stores.
+
+    Returns:
+        converted (int): The number of images moved.
+    """
+    old_store = open_image_store(folder_path)
+    if old_store.backend == backend == LooseImageStore.backend:
+        return 0
+    conn = DatabaseManager.get_connection(folder_path)
+    names = [name for body_file_name, annotation_file_name in conn.execute(
+                 '''SELECT BODY_FILE_NAME, ANNOTATION_FILE_NAME FROM bodies''')
+             if body_file_name is not None
+             for name in (body_file_name, annotation_file_name, render_name(body_file_name))
+             if name is not None and old_store.exists(name)]
+
+    if backend == PackedImageStore.backend:
+        # the new pack is built under the next generation name and its index in a temporary table
+        generation = 1
+        if old_store.backend == PackedImageStore.backend:
+            generation = pack_generation(os.path.basename(old_store.pack_path)) + 1
+        new_store = PackedImageStore(folder_path, pack_name(generation))
+        if os.path.exists(new_store.pack_path):
+            os.remove(new_store.pack_path)
+        conn.execute('''DROP TABLE IF EXISTS image_pack_part''')
+        conn.execute('''CREATE TABLE image_pack_part AS SELECT * FROM image_pack WHERE 0''')
+        offset = 0
+        index = []
+        with open(new_store.pack_path, "wb") as pack_file:
+            for name in names:
+                data = old_store.read(name)
+                pack_file.write(data)
+                index.append((name, offset, len(data)))
+                offset += len(data)
+            pack_file.flush()
+            os.fsync(pack_file.fileno())
+        conn.executemany('''INSERT INTO image_pack_part (NAME, OFFSET, LENGTH) VALUES (?, ?, ?)''', index)
+        conn.commit()
+
+        with conn:
+            conn.execute('''DELETE FROM image_pack''')
+            conn.execute('''INSERT INTO image_pack SELECT * FROM image_pack_part''')
+            conn.execute('''DROP TABLE image_pack_part''')
+            conn.execute('''INSERT OR REPLACE INTO settings (KEY, VALUE) VALUES ('image_pack', ?)''',
+                         (os.path.basename(new_store.pack_path),))
+            conn.execute('''INSERT OR REPLACE INTO settings (KEY, VALUE) VALUES ('image_store', ?)''', (backend,))
+        old_store.close()
+        if old_store.backend == PackedImageStore.backend and os.path.exists(old_store.pack_path):
+            os.remove(old_store.pack_path)
+    else:
+        new_store = LooseImageStore(folder_path)
+        for name in names:
+            new_store.write(name, old_store.read(name))
+        old_store.close()
+        with conn:
+            conn.execute('''DELETE FROM image_pack''')
+            conn.execute('''DELETE FROM settings WHERE KEY = ?''', ("image_pack",))
+            conn.execute('''INSERT OR REPLACE INTO settings (KEY, VALUE) VALUES ('image_store', ?)''', (backend,))
+        if old_store.backend == PackedImageStore.backend and os.path.exists(old_store.pack_path):
+            os.remove(old_store.pack_path)
+
+    if old_store.backend == LooseImageStore.backend and backend != LooseImageStore.backend:
+        for name in names:
+            old_store.remove(name)
+    with _stores_lock:
+        store = _open_stores.pop(DatabaseManager.case_key(folder_path), None)
+    if store is not None:
+        store.close()
+    DatabaseManager.notify(folder_path, "images")
+    return len(names)
+
+def main(args):
+    if len(args) != 2 or args[1] not in image_stores:
+        print("usage: python image_store.py <case folder> [{0}]".format("|".join(image_stores)))
+        return 2
+    folder_path = os.path.join(args[0], "")
+    try:
+        converted = convert_image_store(folder_path, args[1])
+    finally:
+        DatabaseManager.close_case(folder_path)
+    print("moved {0} images to the {1} store".format(converted, args[1]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
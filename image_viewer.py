@@ -1,6 +1,10 @@
 import tkinter as tk
-from PIL import Image, ImageTk
+from PIL import ImageTk
 from file_management import FileManagement
+from database_manager import DatabaseManager
+from thumbnail_cache import open_thumbnail_cache
+from body_cache import open_body_cache
+from body_table import open_body_table
 from datetime import datetime
 from screenshot import ScreenshotEditor, Angler, Ringer
 import config
@@ -16,22 +20,36 @@ class ImageViewer(tk.Toplevel):
             on the grid file image.
         folder_path (str): Directory leading to the save path of images.
         all_bodies (list): A list of all the possible bodies for creating buttons.
-        button_list_canvas (tk.Canvas): A canvas holding a window of all buttons that allow
-            the user to open an image.
+        button_list_canvas (tk.Canvas): A canvas the list of bodies is drawn on, clicking one
+            opens its image.
         biondi_image_canvas (tk.Canvas): A canvas storing the image being viewed at the time.
         filter_options_frame (tk.Frame): A frame holding a series of buttons for filtering the buttons
             for selecting what image to view.
         information_frame (tk.Frame): A frame storing the information about the selected image.
+            Its widgets are made once and updated in place for every body shown.
         edit_buttons_frame (tk.Frame): A frame within information frame with buttons for editing the 
             selected image.
+        info_vars (list): The tk.StringVar of every column of the information frame.
+        notes_var (tk.StringVar): The notes of the selected body.
+        shown_info (dict): The body shown in the information frame, None if there is none.
         var_GR (tk.BooleanVar): Boolean value where True is when user wants to sort by GR.
         var_MAF (tk.BooleanVar): Boolean value where True is when user wants to sort by MAF.
         var_MP (tk.BooleanVar): Boolean value where True is when user wants to sort by MP.
         var_unsure (tk.BooleanVar): Boolean value where True is when user wants to sort by unsure.
-        previous_body_time (int): The unix time of the previous body selected.
+        var_group (tk.BooleanVar): Boolean value where True lists the bodies under their body type.
+        previous_body_id (int): The id of the previous body selected.
+        button_after (str): The after id of the next page of bodies to be listed, None
+            once the body list is complete.
+        shown_filter (tuple): The arguments of create_buttons for the bodies listed.
+        refresh_after (str): The after_idle id of a pending redraw of the list after a
+            change to the case, None if there is none.
+        thumbnails (ThumbnailCache): The previews of the bodies shown in the list.
+        bodies (BodyCache): The decoded images of the bodies opened and of their neighbors in the list.
+        body_list (BodyList): The rows of the body list in view.
         
     Typical usage example:
-        img_v = ImageViewer(folder_path, marker_canvas)
+        img_v = open_image_viewer(folder_path, marker_canvas)
+        img_v.open_file(body_id)
     """
     def __init__(self, folder_path, marker_canvas):
         tk.Toplevel.__init__(self)
@@ -44,14 +62,13 @@ class ImageViewer(tk.Toplevel):
         self.rowconfigure(1, weight=1)
         # create a canvas object and a vertical scrollbar for scrolling it
         scrollbar = tk.Scrollbar(self, orient = "vertical")
+        # the rows in view are updated whenever the list scrolls
         self.button_list_canvas = tk.Canvas(self, bd=0, highlightthickness=0,
-                        yscrollcommand=scrollbar.set)
+                        yscrollcommand = lambda first, last: self.on_scroll(scrollbar, first, last))
         
         scrollbar.config(command=self.button_list_canvas.yview)
         self.button_list_canvas.xview_moveto(0)
         self.button_list_canvas.yview_moveto(0)
-        
-        self.make_button_frame()
 
         self.biondi_image_canvas = tk.Canvas(self, bd = 0)
         self.filter_options_frame = tk.Frame(self)
@@ -61,17 +78,29 @@ class ImageViewer(tk.Toplevel):
         scrollbar.pack(side = tk.LEFT, fill = tk.BOTH)
         self.filter_options_frame.pack(side = tk.TOP, fill = tk.X)
         self.biondi_image_canvas.pack(side = tk.TOP, expand = True, fill = tk.BOTH)
-        self.information_frame.pack(side = tk.BOTTOM, expand = True, fill = tk.X)
+        self.information_frame.pack(side = tk.BOTTOM, fill = tk.X)
         
         self.edit_buttons_frame = tk.Frame(self.information_frame)
-        self.edit_buttons_frame.grid(row = 4, column = 0, columnspan = 3, sticky = "w")
         
         self.var_GR = tk.BooleanVar()
         self.var_MAF = tk.BooleanVar()
         self.var_MP = tk.BooleanVar()
         self.var_unsure = tk.BooleanVar()
-        
-        self.previous_body_time = 0
+        self.var_group = tk.BooleanVar()
+        
+        self.previous_body_id = 0
+        self.button_after = None
+        self.shown_filter = (config.all_bodies, False, False, False, False)
+        self.refresh_after = None
+        self.thumbnails = open_thumbnail_cache(self.folder_path)
+        self.bodies = open_body_cache(self.folder_path)
+        self.body_list = BodyList(self.button_list_canvas, self.thumbnails, self.open_file)
+        DatabaseManager.subscribe(self.folder_path, self.on_case_event)
+        
+        self.shown_info = None
+        self.make_information_labels()
+        self.make_edit_buttons()
+        self.make_edit_entries()
         
         self.make_filter_buttons()
         self.create_buttons(config.all_bodies, False, False, False, False)
@@ -103,6 +132,9 @@ class ImageViewer(tk.Toplevel):
         unsure = tk.Checkbutton(self.filter_options_frame, text = "UNSURE", variable = self.var_unsure, onvalue = True, offvalue = False)
         apply  = tk.Button(self.filter_options_frame, text = "Apply", command = lambda : self.filter())
         reset = tk.Button(self.filter_options_frame, text = "Reset", command = lambda : self.reset())
+        group = tk.Checkbutton(self.filter_options_frame, text = "Group by type", variable = self.var_group, 
+                               onvalue = True, offvalue = False, 
+                               command = lambda : self.body_list.set_grouped(self.var_group.get()))
         
         grC.pack(padx=10, pady = 10, side = tk.LEFT)
         mafC.pack(padx=10, pady = 10, side = tk.LEFT)
@@ -110,37 +142,12 @@ class ImageViewer(tk.Toplevel):
         unsure.pack(padx=10, pady = 10, side = tk.LEFT)
         apply.pack(padx=10, pady = 10, side = tk.LEFT)
         reset.pack(padx=10, pady = 10, side = tk.LEFT)
+        group.pack(padx=10, pady = 10, side = tk.LEFT)
         
-    def make_button_frame(self):
-        """Creates a frame within the button list canvas.
-        
-        Builds a new frame inside the button list canvas to allow from scrolling
-        down the list of buttons. This scrolling is adaptive and will change with the 
-        number of buttons to reflect the list's length.
-        """
-        # create a frame inside the canvas which will be scrolled with it
-        self.interior = interior = tk.Frame(self.button_list_canvas)
-        self.interior.grid(row = 0, column = 0, sticky = "ns")
-        interior_id = self.button_list_canvas.create_window(0, 0, window=interior,
-                                            anchor=tk.NW)
-        
-        # track changes to the canvas and frame width and sync them,
-        # also updating the scrollbar
-        def _configure_interior(event):
-            # update the scrollbars to match the size of the inner frame
-            size = (interior.winfo_reqwidth(), interior.winfo_reqheight())
-            self.button_list_canvas.config(scrollregion = "0 0 %s %s" % size)
-            if interior.winfo_reqwidth() != self.button_list_canvas.winfo_width():
-                # update the canvas's width to fit the inner frame
-                self.button_list_canvas.config(width=interior.winfo_reqwidth())
-
-        def _configure_canvas(event):
-            if interior.winfo_reqwidth() != self.button_list_canvas.winfo_width():
-                # update the inner frame's width to fill the canvas
-                self.button_list_canvas.itemconfigure(interior_id, width=self.button_list_canvas.winfo_width())
-        
-        self.button_list_canvas.bind('<Configure>', _configure_canvas)
-        interior.bind('<Configure>', _configure_interior)
+    def on_scroll(self, scrollbar, first, last):
+        """Moves the scrollbar along with the body list and shows the rows scrolled into view."""
+        scrollbar.set(first, last)
+        self.body_list.schedule()
     
     def set_window_size(self, img):
         """Changes window size accordingly.
@@ -168,10 +175,10 @@ class ImageViewer(tk.Toplevel):
         self.geometry("{0}x{1}".format(str(w), str(h)))
 
     def create_buttons(self, body_param, GR_param, MAF_param, MP_param, unsure_param):
-        """Creates the buttons in the button list.
+        """Lists the bodies matching the filter options.
         
-        Create a series of buttons reflecting the filter options which the user can click
-        to bring up the relevant information and images for the body selected.
+        Fills the body list with the bodies reflecting the filter options, which the user
+        can click to bring up the relevant information and images for the body selected.
         
         Args:
             body_param (list): A list of all the selected bodies for filtering. Enter self.all_bodies
@@ -181,27 +188,44 @@ class ImageViewer(tk.Toplevel):
             MP_param (bool): True if sorting by MP.
             unsure_param (bool): True if sorting by unsure.
         """
-        # queries a list of all the selected bodies
-        fm = FileManagement(self.folder_path)
-        data = fm.query_images(body_param, GR_param, MAF_param, MP_param, unsure_param)
-        
-        # loops through generating bodies
-        for i in data:
-            time = i[0]
-            name = i[1]
-            number = i[2]
-            body_name = "{} {}".format(name, number)
-            # each button takes a different command depending on its selected data
-            btn = tk.Button(self.interior, height = 1, width = 20, relief=tk.FLAT, 
-                            bg="gray99", fg="purple3", font="Dosis", text = body_name,
-                            command = lambda i = time: self.open_file(i))
-            btn.pack(padx = 10, pady = 5, side = tk.TOP)
+        # the first page is shown right away and the rest are added while Tk is idle
+        self.cancel_buttons()
+        self.body_list.clear()
+        self.shown_filter = (body_param, GR_param, MAF_param, MP_param, unsure_param)
+        pages = open_body_table(self.folder_path).iter_image_pages(body_param, GR_param, MAF_param, 
+                                                                   MP_param, unsure_param)
+        self.add_button_page(pages)
+        
+    def add_button_page(self, pages):
+        """Adds the next page of bodies to the body list.
+        
+        Args:
+            pages (generator): BodyTable.iter_image_pages of the current filter.
+        """
+        self.button_after = None
+        page, token = next(pages)
+        self.body_list.add(page)
+        
+        if token is not None:
+            self.button_after = self.after(1, self.add_button_page, pages)
+            
+    def cancel_buttons(self):
+        """Stops adding pages of bodies and thumbnails for a filter that is no longer shown."""
+        if self.button_after is not None:
+            self.after_cancel(self.button_after)
+            self.button_after = None
+        # a list drawn again already shows the change that asked for it
+        if self.refresh_after is not None:
+            self.after_cancel(self.refresh_after)
+            self.refresh_after = None
+        self.body_list.cancel()
             
     def make_information_labels(self):
         """Creates the labels for the information data
         
         Generates a series of tk.Labels with the titles of the columns of data
-        in the information frame.
+        in the information frame, and under them the labels add_information 
+        fills through info_vars.
         """
         # generates a series of white columns every other column to distinguish the columns
         x = 0
@@ -216,6 +240,8 @@ class ImageViewer(tk.Toplevel):
             x += 1
         # makes background of text alternate between white and gray
         x = 0
+        self.info_vars = []
+        self.info_labels = []
         for i in ("Time:", "Annotator:", "Body Type:", "Number:", "Location:", "GR:", "MAF:", "MP:", "UNSURE:", "ANGLE:", "LOG(L/D):"):
             if x % 2 == 0:
                 bg_color = "gray99"
@@ -223,135 +249,200 @@ class ImageViewer(tk.Toplevel):
                 bg_color = "SystemButtonFace"
             col = tk.Label(self.information_frame, text = i, font = ("Dosis", 10, "bold"), bg = bg_color, anchor = "w")
             col.grid(row = 0, column = x, sticky = "w")
+            var = tk.StringVar()
+            lbl = tk.Label(self.information_frame, textvariable = var, font = ("Dosis", 10), bg = bg_color, anchor = "w")
+            lbl.grid(row = 1, column = x, sticky = "w")
+            self.info_vars.append(var)
+            self.info_labels.append(lbl)
             x += 1
             
-            notes = tk.Label(self.information_frame, text = "Notes:", font = ("Dosis", 10, "bold"), anchor = "w")
-            notes.grid(row = 2, column = 0, sticky = "w")
+        notes = tk.Label(self.information_frame, text = "Notes:", font = ("Dosis", 10, "bold"), anchor = "w")
+        notes.grid(row = 2, column = 0, sticky = "w")
+        self.notes_var = tk.StringVar()
+        self.notes_label = tk.Label(self.information_frame, textvariable = self.notes_var, font = ("Dosis", 10), 
+                                    anchor = "w", wraplength = 200, justify = "left")
+        self.notes_label.grid(row = 3, columnspan = 9, sticky = "w")
     
-    def open_file(self, time):
+    def open_file(self, body_id):
         """Brings up the relevant file information.
         
         When clicking a button, open_file brings up the annotation and body image
         to show in the biondi_image_canvas as well as shows the information about that
         specific body.
         
+        The body comes from the body cache, and the bodies next to it in the
+        list are decoded in the background so stepping to them is immediate.
+        
         Args:
-            Time (int): Time added of selected body in unix time.
+            body_id (int): The id of the selected body.
         """
-        body_info = FileManagement(self.folder_path).get_image_time(time)
-        self.clear_information_canvas()
+        body_info, render_img = self.bodies.get(body_id)
+        # the body was deleted since the list was drawn, the list is redrawn by the change notification
+        if body_info is None:
+            return
         self.show_information(body_info)
-        self.open_annotation_image(body_info)
+        self.open_annotation_image(render_img)
+        self.bodies.prefetch(self.body_list.neighbors(body_id))
         
-        self.marker_canvas.itemconfig("m" + str(time), fill = "red")
-        if self.previous_body_time != 0:
-            self.marker_canvas.itemconfig("m"+str(self.previous_body_time), fill = "white")
-        self.previous_body_time = time
+        layer = self.marker_canvas.marker_layer
+        if self.previous_body_id != 0:
+            layer.highlight(self.previous_body_id)
+        layer.highlight(body_id, "red")
+        self.body_list.select(body_id)
+        self.previous_body_id = body_id
         
     def on_closing(self):
         """Resets marker color on window closing"""
-        self.marker_canvas.itemconfig("m"+str(self.previous_body_time), fill = "white")
+        DatabaseManager.unsubscribe(self.folder_path, self.on_case_event)
+        key = DatabaseManager.case_key(self.folder_path)
+        if _open_viewers.get(key) is self:
+            del _open_viewers[key]
+        self.marker_canvas.marker_layer.highlight(self.previous_body_id)
+        self.cancel_buttons()
         self.destroy()
         
+    def on_case_event(self, event):
+        """Lists the bodies again after a change and closes the window along with its case."""
+        if event == "changed":
+            # several changes in a row are drawn once
+            if self.refresh_after is None:
+                self.refresh_after = self.after_idle(self.refresh_buttons)
+        elif event == "closed":
+            self.on_closing()
+            
+    def refresh_buttons(self):
+        """Lists the bodies of the filter shown again, the filter options not applied yet are left alone."""
+        self.refresh_after = None
+        self.create_buttons(*self.shown_filter)
+        
     def show_information(self, body_info):
-        """Makes the information frame widgets.
+        """Shows a body in the information frame.
         
         Fills the information frame widgets with the relevant labels, buttons
-        and information.
+        and information, leaving edit mode if it was on.
         
         Args:
             body_info (tuple): Tuple of selected body's info for display in the frame.
         """
-        self.make_information_labels()
-        self.make_edit_buttons(body_info)
+        self.shown_info = body_info
+        self.hide_edit_entries()
         self.add_information(body_info)
+        self.show_edit_buttons(body_info)
         
     def clear_information_canvas(self):
         """Resets the information frame.
         
-        Destroys the information frame and its relevant buttons and then remakes 
-        a new empty frame so that when selecting different images, the frames do not
-        just stack on top of each other.
+        Empties the labels and hides the edit entries and buttons, the widgets 
+        themselves are kept for the next body shown.
         """
-        self.information_frame.destroy()
-        self.edit_buttons_frame.destroy()
-        self.information_frame = tk.Frame(self)
-        self.information_frame.pack(side = tk.BOTTOM, fill = tk.X)
-        self.edit_buttons_frame = tk.Frame(self.information_frame)
-        self.edit_buttons_frame.grid(row = 4, column = 0, columnspan = 3, sticky = "w")
-        
-    def make_edit_buttons(self, body_info):
+        self.shown_info = None
+        self.hide_edit_entries()
+        for var in self.info_vars:
+            var.set("")
+        self.notes_var.set("")
+        self.edit_buttons_frame.grid_remove()
+        
+    def make_edit_buttons(self):
         """Creates the edit buttons for each image.
         
-        Builds 3 new buttons for editing info, image, and deleting the image. Packed
-        in the edit_buttons_frame which is packed in the information_frame.
+        Builds 3 buttons for editing info, image, and deleting the image, and one 
+        for the log or angle which show_edit_buttons only shows for the bodies that 
+        have one. Packed in the edit_buttons_frame which is packed in the information_frame.
+        The buttons act on the body being shown.
         """
         edit_info = tk.Button(self.edit_buttons_frame, text = "Edit Info", 
-                            command = lambda : self.create_edit_entries(body_info))
+                            command = lambda : self.create_edit_entries(self.shown_info))
         edit_info.grid(row = 4, column = 0, sticky = "e", padx = 3, pady = 3)
         
         edit_img = tk.Button(self.edit_buttons_frame, text = "Edit Image", 
-                            command = lambda: self.edit_image(body_info))
+                            command = lambda: self.edit_image(self.shown_info))
         edit_img.grid(row = 4, column = 1, sticky = "e", padx = 3, pady = 3)
         
         delete = tk.Button(self.edit_buttons_frame, text = "Delete", 
-                            command = lambda: self.delete_image(body_info))
+                            command = lambda: self.delete_image(self.shown_info))
         delete.grid(row = 4, column = 2, sticky = "e", padx = 3, pady = 3)
         
+        self.edit_measure_button = tk.Button(self.edit_buttons_frame)
+        
+    def show_edit_buttons(self, body_info):
+        """Shows the edit buttons, with Edit Log or Edit Angle if the body has one."""
         if body_info["body_name"] == "ring_kettlebell":
-            edit_log = tk.Button(self.edit_buttons_frame, text = "Edit Log",
-                                 command = lambda: self.edit_log(body_info))
-            edit_log.grid(row = 4, column = 3, sticky = "e", padx = 3, pady = 3)
+            self.edit_measure_button.configure(text = "Edit Log", command = lambda: self.edit_log(self.shown_info))
+            self.edit_measure_button.grid(row = 4, column = 3, sticky = "e", padx = 3, pady = 3)
         elif body_info["body_name"] in config.angler_types:
-            edit_angle = tk.Button(self.edit_buttons_frame, text = "Edit Angle",
-                                 command = lambda: self.edit_angle(body_info))
-            edit_angle.grid(row =4 , column = 3, sticky = "e", padx =3 , pady = 3)
+            self.edit_measure_button.configure(text = "Edit Angle", command = lambda: self.edit_angle(self.shown_info))
+            self.edit_measure_button.grid(row = 4, column = 3, sticky = "e", padx = 3, pady = 3)
+        else:
+            self.edit_measure_button.grid_remove()
+        self.edit_buttons_frame.grid(row = 4, column = 0, columnspan = 3, sticky = "w")
         
-    def create_edit_entries(self, body_info):
-        """Creates entry fields when editing info.
+    def make_edit_entries(self):
+        """Creates the entry fields for editing info.
         
         Builds a series of checkbuttons, dropdowns, and entry areas so the user
-        can change the data as needed.
+        can change the data as needed. They stay hidden until create_edit_entries 
+        puts them in place of the labels they edit.
+        """
+        self.edit_body_name = tk.StringVar()
+        self.edit_var_GR = tk.BooleanVar()
+        self.edit_var_MAF = tk.BooleanVar()
+        self.edit_var_MP = tk.BooleanVar()
+        self.edit_var_unsure = tk.BooleanVar()
+        self.edit_notes = tk.StringVar()
+        
+        dropdown = tk.OptionMenu(self.information_frame, self.edit_body_name, *config.all_bodies)
+        edit_gr = tk.Checkbutton(self.information_frame, anchor ="w", variable = self.edit_var_GR, onvalue = True, offvalue = False)
+        edit_maf = tk.Checkbutton(self.information_frame, anchor ="w", variable = self.edit_var_MAF, onvalue = True, offvalue = False)
+        edit_mp = tk.Checkbutton(self.information_frame, anchor ="w", variable = self.edit_var_MP, onvalue = True, offvalue = False)
+        edit_unsure = tk.Checkbutton(self.information_frame, variable = self.edit_var_unsure, onvalue = True, offvalue = False)
+        edit_note_entry = tk.Entry(self.information_frame, textvariable = self.edit_notes)
+        
+        edit_button_ok = tk.Button(self.information_frame, text = "OK", 
+                                   command = lambda: self.edit_info(self.shown_info["body_id"], self.edit_body_name.get(), 
+                                                                    self.edit_var_GR.get(), self.edit_var_MAF.get(), 
+                                                                    self.edit_var_MP.get(), self.edit_var_unsure.get(), 
+                                                                    self.edit_notes.get(), self.shown_info))
+        
+        # every entry with where it is placed, the labels in the same columns are hidden meanwhile
+        self.edit_entries = ((dropdown, {"row": 1, "column": 2}),
+                             (edit_gr, {"row": 1, "column": 5}),
+                             (edit_maf, {"row": 1, "column": 6}),
+                             (edit_mp, {"row": 1, "column": 7}),
+                             (edit_unsure, {"row": 1, "column": 8}),
+                             (edit_note_entry, {"row": 3, "columnspan": 9, "sticky": "w"}),
+                             (edit_button_ok, {"row": 4, "column": 8, "sticky": "w"}))
+        self.edited_labels = [self.info_labels[2]] + self.info_labels[5:9] + [self.notes_label]
+        
+    def create_edit_entries(self, body_info):
+        """Shows the entry fields when editing info.
+        
+        Fills the entries with the current information of the body and swaps them
+        in for the labels they edit.
         
         Args:
             body_info (tuple): Tuple of current body information.
-            
-        Todo: 
-            Make the checkbuttons reflect the old image's information on edit entries startup
         """
-        self.clear_information_canvas()
-        self.make_information_labels()
-        
-        edit_body_name = tk.StringVar()
-        edit_body_name.set(body_info["body_name"])
-        edit_var_GR = tk.BooleanVar()
-        edit_var_MAF = tk.BooleanVar()
-        edit_var_MP = tk.BooleanVar()
-        edit_var_unsure = tk.BooleanVar()
-        edit_notes = tk.StringVar()
-        edit_notes.set(body_info["notes"])
-        
-        dropdown = tk.OptionMenu(self.information_frame, edit_body_name, *config.all_bodies)
-        edit_gr = tk.Checkbutton(self.information_frame, anchor ="w", variable = edit_var_GR, onvalue = True, offvalue = False)
-        edit_maf = tk.Checkbutton(self.information_frame, anchor ="w", variable = edit_var_MAF, onvalue = True, offvalue = False)
-        edit_mp = tk.Checkbutton(self.information_frame, anchor ="w", variable = edit_var_MP, onvalue = True, offvalue = False)
-        edit_unsure = tk.Checkbutton(self.information_frame, variable = edit_var_unsure, onvalue = True, offvalue = False)
-        edit_note_entry = tk.Entry(self.information_frame, textvariable = edit_notes)
-        
-        edit_button_ok = tk.Button(self.information_frame, text = "OK", 
-                                   command = lambda: self.edit_info(body_info["time"], edit_body_name.get(), 
-                                                                    edit_var_GR.get(), edit_var_MAF.get(), 
-                                                                    edit_var_MP.get(), edit_var_unsure.get(), edit_notes.get(), body_info))
-        
-        dropdown.grid(row = 1, column = 2)
-        edit_gr.grid(row = 1, column = 5)
-        edit_maf.grid(row = 1, column = 6)
-        edit_mp.grid(row = 1, column = 7)
-        edit_unsure.grid(row = 1, column = 8)
-        edit_note_entry.grid(row = 3, columnspan = 9, sticky = "w")
-        edit_button_ok.grid(row = 4, column = 8, sticky = "w")
-        
-    def edit_info(self, time, edited_body_name, edited_GR, edited_MAF, edited_MP, edited_unsure, edited_notes, body_info):
+        self.edit_body_name.set(body_info["body_name"])
+        self.edit_var_GR.set(body_info["GR"])
+        self.edit_var_MAF.set(body_info["MAF"])
+        self.edit_var_MP.set(body_info["MP"])
+        self.edit_var_unsure.set(body_info["unsure"])
+        self.edit_notes.set(body_info["notes"] or "")
+        
+        self.edit_buttons_frame.grid_remove()
+        for label in self.edited_labels:
+            label.grid_remove()
+        for widget, options in self.edit_entries:
+            widget.grid(**options)
+            
+    def hide_edit_entries(self):
+        """Puts the labels back in place of the entry fields."""
+        for widget, options in self.edit_entries:
+            widget.grid_remove()
+        for label in self.edited_labels:
+            label.grid()
+        
+    def edit_info(self, body_id, edited_body_name, edited_GR, edited_MAF, edited_MP, edited_unsure, edited_notes, body_info):
         """Changes the information of the body in the database.
         
         Using the user inputted fields in the edit entries, inputs them
@@ -359,6 +450,7 @@ class ImageViewer(tk.Toplevel):
         frame to reflect the changes.
         
         Args:
+            body_id (int): The id of the body being edited.
             edited_body_name (str): The new selected body name.
             edited_GR (bool): New edited GR field.
             edited_MAF (bool): New edited MAF field.
@@ -372,37 +464,38 @@ class ImageViewer(tk.Toplevel):
                   edited_MAF, edited_MP, 
                   edited_unsure, edited_notes]
         if edited_body_name in config.angler_types:
-            edited.extend((body_info["angle"], None, body_info["dprong1"], body_info["lprong2"], time))
+            edited.extend((body_info["angle"], None, body_info["dprong1"], body_info["lprong2"], body_id))
         elif edited_body_name in config.kbell_types:
-            edited.extend((None, body_info["log"], body_info["dprong1"], body_info["lprong2"], time))
+            edited.extend((None, body_info["log"], body_info["dprong1"], body_info["lprong2"], body_id))
         else:
-            edited.extend((None, None, None, None, time))
+            edited.extend((None, None, None, None, body_id))
         FileManagement(self.folder_path).edit_info(edited)
+        # the gridfile marker shows the new letter and follows the filter with the new annotations
+        self.marker_canvas.marker_layer.edit_body(body_id, edited_body_name, 
+                                                  FileManagement.pack_flags(edited_GR, edited_MAF, edited_MP, edited_unsure))
         
         fm = FileManagement(self.folder_path)
-        new_info = fm.get_image_time(body_info["time"])
+        new_info = fm.get_body(body_id)
         
         # if the body name is changed, renumbers both the old and new type
-        # changes the gridfile marker to reflect the new letter
         if body_info["body_name"] != edited_body_name:
             if edited_body_name in config.angler_types:
-                body_image = Image.open(self.folder_path + body_info["body_file_name"])
+                body_image = FileManagement(self.folder_path).open_image(body_info["body_file_name"])
         
                 Angler(body_info, self.folder_path, self.marker_canvas, body_image, False)
             elif edited_body_name == "ring_kettlebell":
-                body_image = Image.open(self.folder_path + body_info["body_file_name"])
+                body_image = FileManagement(self.folder_path).open_image(body_info["body_file_name"])
         
                 Ringer(body_info, self.folder_path, self.marker_canvas, body_image, False)
             fm = FileManagement(self.folder_path)
             fm.renumber_img(body_info["body_name"], 1)
             fm.renumber_img(edited_body_name, 1)
             fm.close()
+            # a body read ahead between the edit and the renumbering has an old number
+            self.bodies.invalidate()
             self.filter()
-            tag = "m" + str(time)
-            self.marker_canvas.itemconfig(tag, text = config.body_index[edited_body_name])
             
 
-        self.clear_information_canvas()
         self.show_information(new_info)
         
         
@@ -415,18 +508,18 @@ class ImageViewer(tk.Toplevel):
         Args:
             body_info
         """
-        body_image = Image.open(self.folder_path + body_info["body_file_name"])
+        body_image = FileManagement(self.folder_path).open_image(body_info["body_file_name"])
         
         # new = False as the image is already saved in the DB so no need to resave
         ScreenshotEditor(body_info, self.folder_path, self.marker_canvas, body_image, False)
 
     def edit_angle(self, body_info):
-        body_image = Image.open(self.folder_path + body_info["body_file_name"])
+        body_image = FileManagement(self.folder_path).open_image(body_info["body_file_name"])
         
         Angler(body_info, self.folder_path, self.marker_canvas, body_image, False)
         
     def edit_log(self, body_info):
-        body_image = Image.open(self.folder_path + body_info["body_file_name"])
+        body_image = FileManagement(self.folder_path).open_image(body_info["body_file_name"])
         
         Ringer(body_info, self.folder_path, self.marker_canvas, body_image, False)
         
@@ -441,26 +534,25 @@ class ImageViewer(tk.Toplevel):
         """
         name = body_info["body_name"]
         number = body_info["body_number"]
-        time = body_info["time"]
+        body_id = body_info["body_id"]
         fm  = FileManagement(self.folder_path)
         fm.delete_img(name, number)
+        self.thumbnails.invalidate(body_id)
         # refreshes the button list to reflect the new changes
         self._remake_button_list()
         self.filter()
-        self.information_frame.destroy()
+        self.clear_information_canvas()
         
         # clear the body canvas
         self.biondi_image_canvas.delete("all")
         
         # deletes the associated marker on the gridfile
-        tag = "m" + str(time)
-        self.marker_canvas.delete(tag)
-        self.marker_canvas.update()
+        self.marker_canvas.marker_layer.remove_body(body_id)
         
     def add_information(self, body_info):
         """Fills the information frame with the current information.
         
-        Places a series of labels under the existing information labels with the 
+        Sets the labels under the existing information labels to the 
         information of the currently selected body.
         
         Args:
@@ -478,56 +570,33 @@ class ImageViewer(tk.Toplevel):
                 str(body_info["angle"]),
                 str(body_info["log"]))
         
-        x = 0
-        for i in info:
-            if x % 2 == 0:
-                bg_color = "gray99"
-            else:
-                bg_color = "SystemButtonFace"
-            lbl = tk.Label(self.information_frame, text = str(i), font = ("Dosis", 10), bg = bg_color, anchor = "w")
-            lbl.grid(row = 1, column = x, sticky = "w")
-            x += 1
-            
-            notes = tk.Label(self.information_frame, text = body_info["notes"], font = ("Dosis", 10), anchor = "w",
-                            wraplength = 200, justify = "left")
-            notes.grid(row = 3, columnspan = 9, sticky = "w")
+        for var, value in zip(self.info_vars, info):
+            var.set(str(value))
+        self.notes_var.set(body_info["notes"] or "")
             
-    def open_annotation_image(self, body_info):
+    def open_annotation_image(self, render_img):
         """Displays the currently selected biondi image.
         
-        Pulls the annotation and body image from the save folder to display in the image_canvas
-        when then user selects that body.
+        Shows the render of the selected body, its body image with the annotation 
+        already pasted on top, see BodyCache.get, in the image_canvas.
         
         Args:
-            body_info (tuple): Tuple of the currently selected body's information
+            render_img (PIL Image): The render, None if it could not be read.
             """
-        body_file_name = body_info['body_file_name']
-        annotation_file_name = body_info['annotation_file_name']
         # exits if there is missing an image
-        # should only raise if body images are manually edited/moved
-        try:
-            body_img = Image.open(self.folder_path + body_file_name)  # open image
-        except:
+        # should only happen if body images are manually edited/moved
+        if render_img is None:
             print("missing biondi image")
             return
-        b_img = ImageTk.PhotoImage(body_img)
+        b_img = ImageTk.PhotoImage(render_img)
         self.biondi_image_canvas.create_image(0, 0, image = b_img, anchor = "nw")
         self.biondi_image_canvas.b_img = b_img # a copy of the image is saved for garbage collection
         
-        try:
-            annotation_img = Image.open(self.folder_path + annotation_file_name)  # open image
-        except:
-            print("missing annotation image")
-            return
-        a_img = ImageTk.PhotoImage(annotation_img)
-        self.biondi_image_canvas.create_image(0, 0, image = a_img, anchor = "nw")
-        self.biondi_image_canvas.a_img = a_img
-        
-        self.set_window_size(body_img)
+        self.set_window_size(render_img)
 
     def _remake_button_list(self):
-        self.interior.destroy()
-        self.make_button_frame()
+        self.cancel_buttons()
+        self.body_list.clear()
     
     def _get_body_selection(self):
         body_selection = []
@@ -567,4 +636,278 @@ class ImageViewer(tk.Toplevel):
         self.var_GR.set(False)
         self.var_MAF.set(False)
         self.var_MP.set(False)
-        self.var_unsure.set(False)
\ No newline at end of file
+        self.var_unsure.set(False)
+
+_open_viewers = {}
+
+def open_image_viewer(folder_path, marker_canvas):
+    """Returns the ImageViewer of a case and brings it to the front.
+    
+    The window is made on first use and kept until it or the case is closed,
+    so opening a body from a marker only loads that body instead of a new window
+    with its whole body list.
+    
+    Args:
+        folder_path (str): The directory of the case folder ending with a slash.
+        marker_canvas (tk.Canvas): The canvas where markers are stored.
+    """
+    key = DatabaseManager.case_key(folder_path)
+    viewer = _open_viewers.get(key)
+    if viewer is None or not viewer.winfo_exists():
+        viewer = ImageViewer(folder_path, marker_canvas)
+        _open_viewers[key] = viewer
+    else:
+        viewer.deiconify()
+        viewer.lift()
+    viewer.focus_set()
+    return viewer
+
+def body_list_rows(bodies, grouped):
+    """Returns the rows of a BodyList.
+
+    Args:
+        bodies (list): (body id, body name, body number) of every body in the order they were read.
+        grouped (bool): True to list the bodies under a header per body type, in
+            the order of config.all_bodies and by number within a type.
+
+    Returns:
+        rows (list): ("body", body id, label) and ("group", body name, label) tuples.
+    """
+    if not grouped:
+        return [("body", body_id, "{} {}".format(name, number)) for body_id, name, number in bodies]
+    groups = {}
+    for body_id, name, number in bodies:
+        groups.setdefault(name, []).append((number, body_id))
+    order = [name for name in config.all_bodies if name in groups] + sorted(set(groups) - set(config.all_bodies))
+    rows = []
+    for name in order:
+        members = sorted(groups[name])
+        rows.append(("group", name, "{0} ({1})".format(name, len(members))))
+        rows.extend(("body", body_id, "{} {}".format(name, number)) for number, body_id in members)
+    return rows
+
+class BodyList():
+    """The list of bodies on the left of the ImageViewer, drawn on a canvas.
+    
+    Only the rows in view exist as canvas items. Every row has a slot of three
+    items, a background, a thumbnail and a label, and the slots of rows that
+    scroll out of view are moved to the rows scrolling in instead of being
+    deleted, so the list costs the same whether it holds ten or ten thousand
+    bodies. A single binding on the canvas opens the body of the row clicked.
+    
+    Attributes:
+        canvas (tk.Canvas): The canvas the list is drawn on.
+        thumbnails (ThumbnailCache): The previews of the bodies.
+        on_open (function): Called with the body id of the row clicked.
+        bodies (list): (body id, body name, body number) of every body listed.
+        grouped (bool): True if the bodies are listed under a header per body type.
+        rows (list): See body_list_rows, None when it has to be made again.
+        positions (dict): Body id to its row index, None when it has to be made again.
+        slots (list): The canvas items and Tk image of every slot made.
+        shown (dict): Row index to the slot showing it.
+        requested (set): The body ids whose thumbnails were requested for this list.
+        waiting (set): The requested body ids whose thumbnails are not finished.
+        selected (int): The body id drawn as selected.
+        render_after (str): The after_idle id of a pending render, None if there is none.
+        thumbnail_after (str): The after id of the next check for finished thumbnails.
+        
+    Typical usage example:
+        body_list = BodyList(canvas, thumbnails, open_file)
+        body_list.add(page)
+    """
+    row_height = config.thumbnail_size[1] + 10
+    width = config.thumbnail_size[0] + 180
+    
+    def __init__(self, canvas, thumbnails, on_open):
+        self.canvas = canvas
+        self.thumbnails = thumbnails
+        self.on_open = on_open
+        self.bodies = []
+        self.grouped = False
+        self.rows = []
+        self.positions = None
+        self.slots = []
+        self.shown = {}
+        self.requested = set()
+        self.waiting = set()
+        self.selected = None
+        self.render_after = None
+        self.thumbnail_after = None
+        
+        self.canvas.config(width = self.width, bg = "gray99")
+        self.canvas.bind("<ButtonPress-1>", self._on_click)
+        self.canvas.bind("<Configure>", lambda event: self.schedule(), add = "+")
+        
+    def clear(self):
+        """Empties the list for a new filter."""
+        self.cancel()
+        self.bodies = []
+        self.rows = None
+        self.positions = None
+        self.requested = set()
+        self.canvas.yview_moveto(0)
+        self.schedule()
+    
+    def add(self, page):
+        """Adds a page of bodies, see FileManagement.query_images_page."""
+        bodies = [(row[0], row[2], row[3]) for row in page]
+        self.bodies.extend(bodies)
+        if self.grouped or self.rows is None:
+            self.rows = None
+            self.positions = None
+        else:
+            # rows in order only grow at the end, the rows in view stay where they are
+            self.rows.extend(body_list_rows(bodies, False))
+            self.positions = None
+        self.schedule()
+        
+    def set_grouped(self, grouped):
+        """Lists the bodies under a header per body type or in the order they were read."""
+        self.grouped = grouped
+        self.rows = None
+        self.positions = None
+        self.canvas.yview_moveto(0)
+        self.schedule()
+        
+    def select(self, body_id):
+        """Draws the row of a body as the one opened."""
+        self.selected = body_id
+        if self.rows is None:
+            return
+        for index, slot in self.shown.items():
+            self._fill(slot, self.rows[index])
+        
+    def neighbors(self, body_id, count = 1):
+        """Returns the ids of up to count bodies after and before a body in the list, nearest first."""
+        if self.rows is None:
+            self.rows = body_list_rows(self.bodies, self.grouped)
+            self.shown = {}
+            self.schedule()
+        if self.positions is None:
+            self.positions = {row[1]: index for index, row in enumerate(self.rows) if row[0] == "body"}
+        index = self.positions.get(body_id)
+        if index is None:
+            return []
+        found = []
+        for step in (1, -1):
+            i = index + step
+            taken = 0
+            while 0 <= i < len(self.rows) and taken < count:
+                if self.rows[i][0] == "body":
+                    found.append(self.rows[i][1])
+                    taken += 1
+                i += step
+        return found
+        
+    def schedule(self):
+        """Renders once Tk is idle. Several scrolls in a row are rendered once."""
+        if self.render_after is None:
+            self.render_after = self.canvas.after_idle(self.render)
+            
+    def render(self):
+        """Moves the slots of the rows that left the view to the rows that came into it."""
+        self.render_after = None
+        if self.rows is None:
+            self.rows = body_list_rows(self.bodies, self.grouped)
+            # every slot is moved again when the rows changed
+            self.shown = {}
+        self.canvas.config(scrollregion = (0, 0, self.width, len(self.rows) * self.row_height))
+        
+        first = max(0, int(self.canvas.canvasy(0) // self.row_height))
+        last = min(len(self.rows), int(self.canvas.canvasy(self.canvas.winfo_height()) // self.row_height) + 1)
+        visible = range(first, last)
+        
+        used = set(id(slot) for index, slot in self.shown.items() if index in visible)
+        free = [slot for slot in self.slots if id(slot) not in used]
+        self.shown = {index: slot for index, slot in self.shown.items() if index in visible}
+        missing = []
+        for index in visible:
+            if index in self.shown:
+                continue
+            slot = free.pop() if free else self._make_slot()
+            self.shown[index] = slot
+            self._place(slot, index)
+            kind, key, label = self.rows[index]
+            if kind == "body" and self._fill(slot, self.rows[index]) and key not in self.requested:
+                missing.append(key)
+            elif kind == "group":
+                self._fill(slot, self.rows[index])
+        for slot in free:
+            for item in slot["items"]:
+                self.canvas.itemconfig(item, state = "hidden")
+            slot["photo"] = None
+        
+        # the missing thumbnails are made in the background and added as they finish
+        if missing:
+            self.requested.update(missing)
+            self.waiting.update(missing)
+            self.thumbnails.request(missing)
+        if self.waiting and self.thumbnail_after is None:
+            self.thumbnail_after = self.canvas.after(100, self.show_thumbnails)
+    
+    def _make_slot(self):
+        slot = {"items": (self.canvas.create_rectangle(0, 0, 0, 0, width = 0),
+                          self.canvas.create_image(0, 0, anchor = "w"),
+                          self.canvas.create_text(0, 0, anchor = "w")),
+                "photo": None}
+        self.slots.append(slot)
+        return slot
+        
+    def _place(self, slot, index):
+        top = index * self.row_height
+        middle = top + self.row_height // 2
+        bg, image, text = slot["items"]
+        self.canvas.coords(bg, 0, top, self.width, top + self.row_height)
+        self.canvas.coords(image, 10, middle)
+        self.canvas.coords(text, config.thumbnail_size[0] + 20, middle)
+        for item in slot["items"]:
+            self.canvas.itemconfig(item, state = "normal")
+            
+    def _fill(self, slot, row):
+        """Draws a row in a slot. Returns True if its thumbnail is not made yet."""
+        kind, key, label = row
+        bg, image, text = slot["items"]
+        if kind == "group":
+            slot["photo"] = None
+            self.canvas.itemconfig(bg, fill = "gray85")
+            self.canvas.itemconfig(image, image = "")
+            self.canvas.itemconfig(text, text = label, fill = "black", font = ("Dosis", 12, "bold"))
+            return False
+        self.canvas.itemconfig(bg, fill = "lavender" if key == self.selected else "gray99")
+        self.canvas.itemconfig(text, text = label, fill = "purple3", font = "Dosis")
+        thumbnail = self.thumbnails.get(key)
+        if thumbnail is None:
+            slot["photo"] = None
+            self.canvas.itemconfig(image, image = "")
+            return True
+        slot["photo"] = ImageTk.PhotoImage(thumbnail) # a copy of the image is saved for garbage collection
+        self.canvas.itemconfig(image, image = slot["photo"])
+        return False
+    
+    def show_thumbnails(self):
+        """Adds the thumbnails finished since the last check to the rows in view."""
+        self.thumbnail_after = None
+        ready = set(self.thumbnails.ready())
+        self.waiting -= ready
+        for index, slot in self.shown.items():
+            if self.rows[index][0] == "body" and self.rows[index][1] in ready:
+                self._fill(slot, self.rows[index])
+        if self.waiting:
+            self.thumbnail_after = self.canvas.after(100, self.show_thumbnails)
+        
+    def _on_click(self, event):
+        index = int(self.canvas.canvasy(event.y) // self.row_height)
+        if self.rows and 0 <= index < len(self.rows) and self.rows[index][0] == "body":
+            self.on_open(self.rows[index][1])
+            
+    def cancel(self):
+        """Stops a pending render and the thumbnails of a list that is no longer shown."""
+        if self.render_after is not None:
+            self.canvas.after_cancel(self.render_after)
+            self.render_after = None
+        if self.thumbnail_after is not None:
+            self.canvas.after_cancel(self.thumbnail_after)
+            self.thumbnail_after = None
+        self.thumbnails.cancel()
+        self.thumbnails.ready()
+        self.waiting = set()
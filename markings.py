@@ -1,10 +1,11 @@
 import tkinter as tk
 from tkinter import ttk
-from image_viewer import ImageViewer
-from screenshot import LilSnippy
 from file_management import FileManagement
+from database_manager import DatabaseManager
 from time import time
 from math import floor
+from PIL import Image, ImageTk
+from spatial_index import SpatialIndex
 import config
 class Marker(tk.Frame):
     """The popup prompt to create a marker.
@@ -81,7 +82,15 @@ class Marker(tk.Frame):
         note_entry.grid(row = 3, column = 1)
         button_ok.grid(row = 4, column = 2)
         annotator_entry.grid(row = 4, column = 0)
-        
+
+        # warns about a body that may already be annotated
+        nearby = self.marker_canvas.marker_layer.nearby_bodies(self.canvas_x, self.canvas_y, config.marker_warning_distance)
+        if nearby:
+            distance, body_name = nearby[0]
+            warning = tk.Label(marker, fg = "red",
+                               text = "A {0} is already marked {1} pixels away".format(body_name, round(distance)))
+            warning.grid(row = 5, column = 0, columnspan = 3)
+
 
     def get_data(self):
         """Retrieves user inputs.
@@ -89,15 +98,14 @@ class Marker(tk.Frame):
         Takes the user inputs from the popup and enters them into a data dictionary.
         This dictionary is later entered into the database.
         """
+        # numpy is only loaded once a case is open
+        from body_table import open_body_table
         time_added = int(time())
-        body_file_name = str(self.body_type.get()) + "_" + str(time_added)
-        annotation_file_name = body_file_name + "_ANNOTATION"
-        fm = FileManagement(self.folder_path)
         
         data = {"time": time_added,
                 "annotator_name": self.annotator.get(),
                 "body_name": self.body_type.get(),
-                "body_number": fm.count_bodies([self.body_type.get()], False, False, False, False) + 1,
+                "body_number": open_body_table(self.folder_path).count([self.body_type.get()], False, False, False, False) + 1,
                 "x": self.canvas_x,
                 "y": self.canvas_y,
                 "grid_id": self.grid_id,
@@ -106,8 +114,8 @@ class Marker(tk.Frame):
                 "MP": self.var_MP.get(),
                 "unsure": self.var_unsure.get(),
                 "notes": self.notes.get(),
-                "body_file_name": body_file_name + ".png",
-                "annotation_file_name": annotation_file_name + ".png",
+                "body_file_name": None, # named by FileManagement.save_image
+                "annotation_file_name": None,
                 "angle": None,
                 "log": None,
                 "dprong1": None,
@@ -134,6 +142,8 @@ class Marker(tk.Frame):
         Args:
             data (dict): The collection of data collected from the user entries.
         """
+        # the screenshot tools are loaded on first use to keep the program quick to start
+        from screenshot import LilSnippy
         app = LilSnippy(self.master, data, self.folder_path, self.marker_canvas)
         app.create_screen_canvas()
         
@@ -148,66 +158,364 @@ class Marker(tk.Frame):
         self.call_screenshot(data)
 
 
-class GridMark():
-    """Creates a clickable marking on the gridfile.
+_stamps = {}
+
+def marker_stamp(text, size, fill):
+    """Returns a marker as a transparent PIL image cropped to its letter, made once per marker."""
+    stamp = _stamps.get((text, size, fill))
+    if stamp is None:
+        # fonts are only needed once a view is dense enough for an overlay
+        from PIL import ImageDraw, ImageFont
+        try:
+            font = ImageFont.truetype("calibrib.ttf", size)
+        except OSError:
+            font = ImageFont.load_default()
+        stamp = Image.new("RGBA", (size * 2, size * 2))
+        ImageDraw.Draw(stamp).text((0, 0), text, fill = fill, font = font)
+        stamp = stamp.crop(stamp.getbbox())
+        _stamps[(text, size, fill)] = stamp
+    return stamp
+
+def marker_overlay(markers, region):
+    """Draws markers into one transparent image.
+
+    Args:
+        markers (list): (x, y, text, font size, fill) of every marker, in canvas coordinates.
+        region (tuple): The canvas coordinates x0, y0, x1, y1 the image covers.
+
+    Returns:
+        img (PIL Image): The RGBA image whose top left corner goes at x0, y0.
+    """
+    x0, y0 = int(region[0]), int(region[1])
+    img = Image.new("RGBA", (int(region[2]) - x0 + 1, int(region[3]) - y0 + 1))
+    for x, y, text, size, fill in markers:
+        stamp = marker_stamp(text, size, fill)
+        # centered on the marker like a canvas text item, cut off at the top and left edges
+        left, top = int(x) - x0 - stamp.width // 2, int(y) - y0 - stamp.height // 2
+        img.alpha_composite(stamp, (max(left, 0), max(top, 0)), (max(-left, 0), max(-top, 0)))
+    return img
+
+def make_body_filter(body_param, GR_param, MAF_param, MP_param, unsure_param):
+    """Returns the filter passes_body_filter checks bodies against, see FileManagement.filter_clause.
+
+    Returns:
+        body_filter (tuple): The body names and the flags every body kept has, None to keep every body.
+    """
+    if set(body_param) == set(config.all_bodies) and not any((GR_param, MAF_param, MP_param, unsure_param)):
+        return None
+    return (set(body_param), FileManagement.pack_flags(GR_param, MAF_param, MP_param, unsure_param))
+
+def passes_body_filter(body_filter, body_name, flags):
+    """Returns True if a body is kept by a filter from make_body_filter, the same bodies the query keeps."""
+    if body_filter is None:
+        return True
+    names, required = body_filter
+    return body_name in names and flags & required == required
+
+class MarkerLayer():
+    """The body and ignored markers of a case on the gridfile.
+    
+    Every marker of the case is kept in a SpatialIndex, but canvas items are only
+    made for the markers in view, together with a margin of config.marker_cell_size,
+    and deleted once they scroll out of it. Clicks are resolved through the index
+    by a single binding on the canvas instead of a binding per marker. The layer
+    is kept on the canvas as marker_canvas.marker_layer.
+    
+    When more than config.marker_raster_threshold markers are in view they are
+    drawn into one transparent image instead, a single canvas item tagged
+    "marker_overlay" covering the view and its margin. It is drawn again when the
+    view leaves it or a marker changes. Markers in it do not turn red under the
+    mouse, clicks are resolved through the index the same way.
     
-    When called, this creates a marker on the mouse position which can be clicked
-    to open the imageviewer and show the correlating image.
+    The filters of the OptionBar are applied in memory. Markers already drawn
+    are not deleted when they are filtered out, only the ones whose visibility
+    changed are set to the hidden or normal state.
+    
+    Body keys in the index are ("m", body_id) and ignored keys ("i", x, y). The
+    canvas items keep the tags "m{body_id}" and "marker" for bodies and
+    "i{x}{y}" for ignored markers.
     
     Attributes:
         marker_canvas (tk.Canvas): Canvas where markers are stored.
         folder_path (str): Path to the folder where images are saved.
-        time (int): Unix time of the selected body.
-        
+        index (SpatialIndex): The position of every marker of the case.
+        bodies (dict): body_id to the body name and flags of every body of the case.
+        body_filter (tuple): The body names and the flags every shown body has, None to show every body.
+        show_ignored (bool): True if ignored markers are shown.
+        colors (dict): body_id to the fill of bodies not drawn in white.
+        items (dict): key to the canvas item of every marker drawn.
+        hidden (set): The keys of the items drawn in the hidden state.
+        overlay (tuple): The canvas item, Tk image and region of the overlay, None if there is none.
+        overlay_stale (bool): True if a marker changed since the overlay was drawn.
+        loader (MarkerStream): Reads the bodies of the case into the index.
+        place_ignored (bool): True if the next click adds an ignored marker instead of selecting one.
+        render_after (str): The after_idle id of a pending render, None if there is none.
+    
     Typical Usage Example:
-        GridMark(marker_canvas, folder_path, body_info)
+        layer = MarkerLayer(marker_canvas, folder_path)
+        layer.add_body(body_info)
     """
-    def __init__(self, marker_canvas, folder_path, body_info):
+    def __init__(self, marker_canvas, folder_path):
         self.marker_canvas = marker_canvas
         self.folder_path = folder_path
-        body_name = body_info["body_name"]
-        x = body_info["x"]
-        y = body_info["y"]
-        self.time = body_info["time"]
-        tag = "m{0}".format(self.time)
-        self.marker_canvas.create_text(x, y, font = ("Calibri", 18, "bold"), fill = 'WHITE', activefill = "red",
-                                       text = config.body_index[body_name], tag = tag)
+        self.index = SpatialIndex(config.marker_cell_size)
+        self.bodies = {}
+        self.body_filter = None
+        self.show_ignored = True
+        self.colors = {}
+        self.items = {}
+        self.hidden = set()
+        self.overlay = None
+        self.overlay_stale = False
+        self.place_ignored = False
+        self.render_after = None
         
-        self.marker_canvas.tag_bind(tag, '<ButtonPress-1>', self._on_click)
-        self.marker_canvas.update 
+        self.marker_canvas.marker_layer = self
+        self.marker_canvas.bind("<ButtonPress-1>", self._on_click, add = "+")
+        self.marker_canvas.bind("<Configure>", lambda event: self.schedule(), add = "+")
+        DatabaseManager.subscribe(self.folder_path, self._on_case_event)
+        
+        # numpy is only loaded once a case is open
+        from body_table import open_body_table
+        for x, y in FileManagement(self.folder_path).query_all_ignored():
+            self.index.insert(("i", x, y), x, y)
+        self.loader = MarkerStream(self.marker_canvas, self.folder_path, 
+                                   open_body_table(self.folder_path).iter_markers_pages(), self._add_page)
+    
+    def _add_page(self, page):
+        for body_id, time_added, body_name, flags, x, y in page:
+            self.bodies[body_id] = (body_name, flags)
+            self.index.insert(("m", body_id), x, y)
+        self.overlay_stale = True
+        self.schedule()
+    
+    def _is_shown(self, key):
+        if key[0] == "i":
+            return self.show_ignored
+        return passes_body_filter(self.body_filter, *self.bodies[key[1]])
+        
+    def schedule(self):
+        """Renders once Tk is idle. Several scrolls in a row are rendered once."""
+        if self.render_after is None:
+            self.render_after = self.marker_canvas.after_idle(self.render)
+    
+    def render(self):
+        """Draws the markers that scrolled into view and deletes the ones that left it."""
+        self.render_after = None
+        margin = config.marker_cell_size
+        view = (self.marker_canvas.canvasx(0), self.marker_canvas.canvasy(0),
+                self.marker_canvas.canvasx(self.marker_canvas.winfo_width()),
+                self.marker_canvas.canvasy(self.marker_canvas.winfo_height()))
+        region = (view[0] - margin, view[1] - margin, view[2] + margin, view[3] + margin)
+        in_view = set(self.index.query(*region))
         
+        if len(in_view) > config.marker_raster_threshold:
+            for key in list(self.items):
+                self.marker_canvas.delete(self.items.pop(key))
+            self.hidden.clear()
+            if self.overlay is None or self.overlay_stale or not self._covers(self.overlay[2], view):
+                self._draw_overlay(region, [key for key in in_view if self._is_shown(key)])
+            return
+        
+        self._delete_overlay()
+        for key in set(self.items) - in_view:
+            self.marker_canvas.delete(self.items.pop(key))
+            self.hidden.discard(key)
+        for key in in_view - set(self.items):
+            self.items[key] = self._draw(key)
+    
+    @staticmethod
+    def _covers(region, view):
+        return region[0] <= view[0] and region[1] <= view[1] and view[2] <= region[2] and view[3] <= region[3]
+    
+    def _draw(self, key):
+        x, y = self.index.position(key)
+        state = "normal"
+        if not self._is_shown(key):
+            state = "hidden"
+            self.hidden.add(key)
+        if key[0] == "i":
+            return self.marker_canvas.create_text(x, y, font = ("Calibri", 24, "bold"), fill = 'magenta', activefill = "red",
+                                                  text = "X", tag = "i{0}{1}".format(x, y), state = state)
+        body_id = key[1]
+        return self.marker_canvas.create_text(x, y, font = ("Calibri", 18, "bold"), fill = self.colors.get(body_id, 'WHITE'),
+                                              activefill = "red", text = config.body_index[self.bodies[body_id][0]],
+                                              tag = ("m{0}".format(body_id), "marker"), state = state)
+    
+    def _draw_overlay(self, region, visible):
+        """Draws every visible marker into one image covering region and shows it."""
+        self._delete_overlay()
+        markers = []
+        for key in visible:
+            x, y = self.index.position(key)
+            if key[0] == "i":
+                markers.append((x, y, "X", 24, "magenta"))
+            else:
+                markers.append((x, y, config.body_index[self.bodies[key[1]][0]], 18, self.colors.get(key[1], "white")))
+        img = marker_overlay(markers, region)
+        photo = ImageTk.PhotoImage(img)
+        x0, y0 = int(region[0]), int(region[1])
+        item = self.marker_canvas.create_image(x0, y0, anchor = "nw", image = photo, tags = ("marker_overlay",))
+        self.overlay = (item, photo, (x0, y0, x0 + img.width - 1, y0 + img.height - 1))
+        self.overlay_stale = False
+        
+    def _delete_overlay(self):
+        if self.overlay is not None:
+            self.marker_canvas.delete(self.overlay[0])
+            self.overlay = None
+    
+    def _redraw(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.marker_canvas.delete(item)
+        self.hidden.discard(key)
+        self.overlay_stale = True
+        self.schedule()
+    
+    def _update_states(self):
+        """Hides and shows the items drawn whose visibility changed with the filters."""
+        hidden = set(key for key in self.items if not self._is_shown(key))
+        for key in hidden - self.hidden:
+            self.marker_canvas.itemconfig(self.items[key], state = "hidden")
+        for key in self.hidden - hidden:
+            self.marker_canvas.itemconfig(self.items[key], state = "normal")
+        self.hidden = hidden
+        if self.overlay is not None:
+            self.overlay_stale = True
+            self.schedule()
+    
+    def add_body(self, body_info):
+        """Adds the marker of a body that was just saved."""
+        self.bodies[body_info["body_id"]] = (body_info["body_name"], FileManagement.pack_flags(
+            body_info["GR"], body_info["MAF"], body_info["MP"], body_info["unsure"]))
+        self.index.insert(("m", body_info["body_id"]), body_info["x"], body_info["y"])
+        self.overlay_stale = True
+        self.schedule()
+        
+    def remove_body(self, body_id):
+        """Removes the marker of a body that was deleted."""
+        self.bodies.pop(body_id, None)
+        self.colors.pop(body_id, None)
+        self.index.remove(("m", body_id))
+        self._redraw(("m", body_id))
+        
+    def edit_body(self, body_id, body_name, flags):
+        """Changes the letter and annotations of a body that was edited."""
+        if body_id in self.bodies:
+            self.bodies[body_id] = (body_name, flags)
+            self._redraw(("m", body_id))
+    
+    def highlight(self, body_id, color = None):
+        """Draws a body in color, or in white again if color is None."""
+        if color is None:
+            self.colors.pop(body_id, None)
+        else:
+            self.colors[body_id] = color
+        item = self.items.get(("m", body_id))
+        if item is not None:
+            self.marker_canvas.itemconfig(item, fill = self.colors.get(body_id, 'WHITE'))
+        elif self.overlay is not None:
+            self.overlay_stale = True
+            self.schedule()
+    
+    def add_ignored(self, x, y):
+        """Adds an ignored marker and saves it."""
+        self.index.insert(("i", x, y), x, y)
+        FileManagement(self.folder_path).add_ignored((x, y))
+        self.overlay_stale = True
+        self.schedule()
+        
+    def remove_ignored(self, x, y):
+        """Removes an ignored marker and deletes it from the database."""
+        self.index.remove(("i", x, y))
+        self._redraw(("i", x, y))
+        FileManagement(self.folder_path).delete_ignored((x, y))
+        
+    def set_show_ignored(self, show):
+        """Shows or hides every ignored marker."""
+        self.show_ignored = show
+        self._update_states()
+        
+    def show_only(self, body_param, GR_param, MAF_param, MP_param, unsure_param):
+        """Shows only the bodies matching a filter, see FileManagement.filter_clause."""
+        self.body_filter = make_body_filter(body_param, GR_param, MAF_param, MP_param, unsure_param)
+        self._update_states()
+        
+    def nearby_bodies(self, x, y, distance):
+        """Returns (distance, body name) of the bodies within distance of a point, closest first."""
+        return [(d, self.bodies[key[1]][0]) for d, key in self.index.nearest(x, y, distance) if key[0] == "m"]
+    
     def _on_click(self, event):
-        ImageViewer(self.folder_path, self.marker_canvas).open_file(self.time)
+        x = self.marker_canvas.canvasx(event.x)
+        y = self.marker_canvas.canvasy(event.y)
+        if self.place_ignored:
+            self.add_ignored(x, y)
+            return
+        for distance, key in self.index.nearest(x, y, config.marker_hit_radius):
+            if not self._is_shown(key):
+                continue
+            if key[0] == "i":
+                self.remove_ignored(key[1], key[2])
+            else:
+                from image_viewer import open_image_viewer
+                open_image_viewer(self.folder_path, self.marker_canvas).open_file(key[1])
+            return
+    
+    def _on_case_event(self, event):
+        if event == "closed":
+            self.cancel()
+    
+    def cancel(self):
+        """Stops reading and drawing markers, used when the case is closed."""
+        self.loader.cancel()
+        if self.render_after is not None:
+            self.marker_canvas.after_cancel(self.render_after)
+            self.render_after = None
+        DatabaseManager.unsubscribe(self.folder_path, self._on_case_event)
         
-class GridIgnored():
-    """Creates a clickable ignored marker.
+class MarkerStream():
+    """Reads the pages of a query one at a time.
     
-    Generates a marker_canvas marker that shows if something is being 
-    ignored for the time being.
+    The first page is read right away and the rest while Tk is idle, so the
+    gridfile can be used before every marker of a large case is read. Closing
+    the case cancels it.
     
     Attributes:
         marker_canvas (tk.Canvas): Canvas where markers are stored.
         folder_path (str): Path to the folder where images are saved.
-        canvas_x (int) Canvas x coordinate where the user clicked
-        canvas_y (int): Canvas y coordinate where the user clicked
+        pages (generator): Yields a page and the token of the next one, such as FileManagement.iter_markers_pages.
+        on_page (function): Called with every page.
+        after_id (str): The after id of the next page, None when nothing is scheduled.
     
     Typical Usage Example:
-    GridIgnored(marker_canvas, folder_path, canvas_x, canvas_y)
+        MarkerStream(marker_canvas, folder_path, FileManagement(folder_path).iter_markers_pages(), on_page)
     """
-    def __init__(self, marker_canvas, folder_path, canvas_x, canvas_y):
+    def __init__(self, marker_canvas, folder_path, pages, on_page):
         self.marker_canvas = marker_canvas
         self.folder_path = folder_path
-        self.canvas_x = canvas_x
-        self.canvas_y = canvas_y
+        self.pages = pages
+        self.on_page = on_page
+        self.after_id = None
+        DatabaseManager.subscribe(self.folder_path, self._on_case_event)
+        self._read_page()
         
-        self.tag = "i{0}{1}".format(canvas_x, canvas_y)
-        self.marker_canvas.create_text(canvas_x, canvas_y, font = ("Calibri", 24, "bold"), fill = 'magenta', activefill = "red",
-                                       text = "X", tag = self.tag)
+    def _read_page(self):
+        self.after_id = None
+        page, token = next(self.pages)
+        self.on_page(page)
         
-        self.marker_canvas.tag_bind(self.tag, '<ButtonPress-1>', self._on_click)
-        self.marker_canvas.update 
+        if token is None:
+            self.cancel()
+        else:
+            self.after_id = self.marker_canvas.after(1, self._read_page)
+            
+    def _on_case_event(self, event):
+        if event == "closed":
+            self.cancel()
         
-    def _on_click(self, event):
-        self.marker_canvas.delete(self.tag)
-        coords = (self.canvas_x, self.canvas_y)
-        FileManagement(self.folder_path).delete_ignored(coords)
+    def cancel(self):
+        """Stops reading. Pages already read are kept."""
+        if self.after_id is not None:
+            self.marker_canvas.after_cancel(self.after_id)
+            self.after_id = None
+        DatabaseManager.unsubscribe(self.folder_path, self._on_case_event)
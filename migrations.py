@@ -0,0 +1,237 @@
+"""Versioned schema of the case database.
+
+Every function in schema_versions upgrades a case database by one version.
+The version a database is on is kept in PRAGMA user_version, where 0 is a case
+made before versioning was added. migrate runs every missing step in a single
+transaction so a case is never left half converted.
+
+Typical usage example:
+    migrations.migrate(conn)
+"""
+
+import config
+
+def schema_v1(c):
+    """The original tables. Old cases already have them, new cases are created here."""
+    c.execute('''CREATE TABLE IF NOT EXISTS bodies (TIME INTEGER NOT NULL,
+                                                    ANNOTATOR_NAME TEXT,
+                                                    BODY_NAME TEXT NOT NULL,
+                                                    BODY_NUMBER INTEGER NOT NULL,
+                                                    X_POSITION INTEGER NOT NULL,
+                                                    Y_POSITION INTEGER NOT NULL,
+                                                    GRID_ID TEXT NOT NULL,
+                                                    GR INTEGER,
+                                                    MAF INTEGER,
+                                                    MP INTEGER,
+                                                    UNSURE INTEGER,
+                                                    NOTES TEXT,
+                                                    BODY_FILE_NAME TEXT,
+                                                    ANNOTATION_FILE_NAME TEXT,
+                                                    ANGLE REAL,
+                                                    LOG REAL,
+                                                    DPRONG1 REAL,
+                                                    LPRONG2 REAL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS grid (GRID_ID TEXT NOT NULL,
+                                                  FINISHED INTEGER)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS ignored (X INTEGER NOT NULL,
+                                                     Y INTEGER NOT NULL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS name (NAME TEXT NOT NULL)''')
+
+    c.execute('''CREATE INDEX IF NOT EXISTS bodies_time_index ON bodies (TIME)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS bodies_name_number_index ON bodies (BODY_NAME, BODY_NUMBER)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS bodies_name_time_index ON bodies (BODY_NAME, TIME)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS bodies_filter_index ON bodies (BODY_NAME, GR, MAF, MP, UNSURE)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS grid_id_index ON grid (GRID_ID)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS ignored_coords_index ON ignored (X, Y)''')
+
+def schema_v2(c):
+    """Moves bodies to an integer key, a body type lookup table and packed flags.
+
+    The GR, MAF, MP and UNSURE columns are packed into FLAGS using the bits in
+    config.flag_bits. Body names are moved to body_types which is seeded with
+    config.all_bodies and any other names already in the case.
+    """
+    c.execute('''CREATE TABLE body_types (TYPE_ID INTEGER PRIMARY KEY,
+                                          BODY_NAME TEXT NOT NULL UNIQUE)''')
+    c.executemany('''INSERT OR IGNORE INTO body_types (BODY_NAME) VALUES (?)''',
+                  [(name,) for name in config.all_bodies])
+    c.execute('''INSERT OR IGNORE INTO body_types (BODY_NAME)
+                SELECT DISTINCT BODY_NAME FROM bodies''')
+
+    c.execute('''ALTER TABLE bodies RENAME TO bodies_v1''')
+    c.execute('''CREATE TABLE bodies (BODY_ID INTEGER PRIMARY KEY,
+                                      TIME INTEGER NOT NULL,
+                                      ANNOTATOR_NAME TEXT,
+                                      TYPE_ID INTEGER NOT NULL REFERENCES body_types (TYPE_ID),
+                                      BODY_NUMBER INTEGER NOT NULL,
+                                      X_POSITION INTEGER NOT NULL,
+                                      Y_POSITION INTEGER NOT NULL,
+                                      GRID_ID TEXT NOT NULL,
+                                      FLAGS INTEGER NOT NULL DEFAULT 0,
+                                      NOTES TEXT,
+                                      BODY_FILE_NAME TEXT,
+                                      ANNOTATION_FILE_NAME TEXT,
+                                      ANGLE REAL,
+                                      LOG REAL,
+                                      DPRONG1 REAL,
+                                      LPRONG2 REAL)''')
+    c.execute('''INSERT INTO bodies (TIME, ANNOTATOR_NAME, TYPE_ID, BODY_NUMBER, X_POSITION, Y_POSITION,
+                                     GRID_ID, FLAGS, NOTES, BODY_FILE_NAME, ANNOTATION_FILE_NAME,
+                                     ANGLE, LOG, DPRONG1, LPRONG2)
+                SELECT old.TIME, old.ANNOTATOR_NAME, t.TYPE_ID, old.BODY_NUMBER, old.X_POSITION, old.Y_POSITION,
+                       old.GRID_ID,
+                       (COALESCE(old.GR, 0) != 0) * ?
+                       | (COALESCE(old.MAF, 0) != 0) * ?
+                       | (COALESCE(old.MP, 0) != 0) * ?
+                       | (COALESCE(old.UNSURE, 0) != 0) * ?,
+                       old.NOTES, old.BODY_FILE_NAME, old.ANNOTATION_FILE_NAME,
+                       old.ANGLE, old.LOG, old.DPRONG1, old.LPRONG2
+                FROM bodies_v1 AS old
+                JOIN body_types AS t ON t.BODY_NAME = old.BODY_NAME
+                ORDER BY old.TIME, old.rowid''',
+              [config.flag_bits[flag] for flag in ("GR", "MAF", "MP", "unsure")])
+    c.execute('''DROP TABLE bodies_v1''')
+
+    # each index matches the WHERE or ORDER BY clause of a FileManagement query
+    c.execute('''CREATE INDEX bodies_time_index ON bodies (TIME)''')
+    c.execute('''CREATE INDEX bodies_type_number_index ON bodies (TYPE_ID, BODY_NUMBER)''')
+    c.execute('''CREATE INDEX bodies_type_time_index ON bodies (TYPE_ID, TIME)''')
+    c.execute('''CREATE INDEX bodies_filter_index ON bodies (TYPE_ID, FLAGS)''')
+
+def schema_v3(c):
+    """Adds counters of the bodies table that are kept up to date by triggers.
+
+    body_counts holds the number of bodies for every body type and flags
+    combination and grid_counts the number of bodies in every grid square, so
+    counting never has to read the bodies table. Rows are never removed from
+    the counters, a count just drops to 0.
+    """
+    c.execute('''CREATE TABLE body_counts (TYPE_ID INTEGER NOT NULL,
+                                          FLAGS INTEGER NOT NULL,
+                                          COUNT INTEGER NOT NULL,
+                                          PRIMARY KEY (TYPE_ID, FLAGS)) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE grid_counts (GRID_ID TEXT PRIMARY KEY,
+                                          COUNT INTEGER NOT NULL) WITHOUT ROWID''')
+    rebuild_counters(c)
+
+    c.execute('''CREATE TRIGGER bodies_count_insert AFTER INSERT ON bodies
+                BEGIN
+                    INSERT INTO body_counts (TYPE_ID, FLAGS, COUNT) VALUES (NEW.TYPE_ID, NEW.FLAGS, 1)
+                        ON CONFLICT (TYPE_ID, FLAGS) DO UPDATE SET COUNT = COUNT + 1;
+                    INSERT INTO grid_counts (GRID_ID, COUNT) VALUES (NEW.GRID_ID, 1)
+                        ON CONFLICT (GRID_ID) DO UPDATE SET COUNT = COUNT + 1;
+                END''')
+    c.execute('''CREATE TRIGGER bodies_count_delete AFTER DELETE ON bodies
+                BEGIN
+                    UPDATE body_counts SET COUNT = COUNT - 1 WHERE TYPE_ID = OLD.TYPE_ID AND FLAGS = OLD.FLAGS;
+                    UPDATE grid_counts SET COUNT = COUNT - 1 WHERE GRID_ID = OLD.GRID_ID;
+                END''')
+    c.execute('''CREATE TRIGGER bodies_count_update_type AFTER UPDATE OF TYPE_ID, FLAGS ON bodies
+                WHEN OLD.TYPE_ID != NEW.TYPE_ID OR OLD.FLAGS != NEW.FLAGS
+                BEGIN
+                    UPDATE body_counts SET COUNT = COUNT - 1 WHERE TYPE_ID = OLD.TYPE_ID AND FLAGS = OLD.FLAGS;
+                    INSERT INTO body_counts (TYPE_ID, FLAGS, COUNT) VALUES (NEW.TYPE_ID, NEW.FLAGS, 1)
+                        ON CONFLICT (TYPE_ID, FLAGS) DO UPDATE SET COUNT = COUNT + 1;
+                END''')
+    c.execute('''CREATE TRIGGER bodies_count_update_grid AFTER UPDATE OF GRID_ID ON bodies
+                WHEN OLD.GRID_ID != NEW.GRID_ID
+                BEGIN
+                    UPDATE grid_counts SET COUNT = COUNT - 1 WHERE GRID_ID = OLD.GRID_ID;
+                    INSERT INTO grid_counts (GRID_ID, COUNT) VALUES (NEW.GRID_ID, 1)
+                        ON CONFLICT (GRID_ID) DO UPDATE SET COUNT = COUNT + 1;
+                END''')
+
+def schema_v4(c):
+    """Adds the index of the packed image store.
+
+    image_pack holds where every image of a case on the packed store is kept in
+    its images.pack file. The table stays empty for cases on loose files.
+    """
+    c.execute('''CREATE TABLE image_pack (NAME TEXT PRIMARY KEY,
+                                         OFFSET INTEGER NOT NULL,
+                                         LENGTH INTEGER NOT NULL) WITHOUT ROWID''')
+
+def rebuild_counters(c):
+    """Recomputes body_counts and grid_counts from the bodies table.
+
+    Args:
+        c (sqlite3.Cursor): Cursor on the case database. The caller commits.
+
+    Returns:
+        mismatches (list): (table, key, stored count, actual count) for every
+            counter that was wrong before the rebuild.
+    """
+    actual_body_counts = {(type_id, flags): count for type_id, flags, count in c.execute(
+        '''SELECT TYPE_ID, FLAGS, COUNT(*) FROM bodies GROUP BY TYPE_ID, FLAGS''')}
+    actual_grid_counts = {(grid_id,): count for grid_id, count in c.execute(
+        '''SELECT GRID_ID, COUNT(*) FROM bodies GROUP BY GRID_ID''')}
+    stored_body_counts = {(type_id, flags): count for type_id, flags, count in c.execute(
+        '''SELECT TYPE_ID, FLAGS, COUNT FROM body_counts''')}
+    stored_grid_counts = {(grid_id,): count for grid_id, count in c.execute(
+        '''SELECT GRID_ID, COUNT FROM grid_counts''')}
+
+    mismatches = []
+    for table, stored, actual in (("body_counts", stored_body_counts, actual_body_counts),
+                                  ("grid_counts", stored_grid_counts, actual_grid_counts)):
+        for key in sorted(set(stored) | set(actual), key = str):
+            if stored.get(key, 0) != actual.get(key, 0):
+                mismatches.append((table, key, stored.get(key, 0), actual.get(key, 0)))
+
+    c.execute('''DELETE FROM body_counts''')
+    c.executemany('''INSERT INTO body_counts (TYPE_ID, FLAGS, COUNT) VALUES (?, ?, ?)''',
+                  [key + (count,) for key, count in actual_body_counts.items()])
+    c.execute('''DELETE FROM grid_counts''')
+    c.executemany('''INSERT INTO grid_counts (GRID_ID, COUNT) VALUES (?, ?)''',
+                  [key + (count,) for key, count in actual_grid_counts.items()])
+    return mismatches
+
+schema_versions = [schema_v1, schema_v2, schema_v3, schema_v4]
+latest_version = len(schema_versions)
+
+def get_version(conn):
+    """Returns the schema version of a case database."""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def is_initiated(conn):
+    """Returns True if the database belongs to an initiated case."""
+    tables = conn.execute('''SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'bodies' ''').fetchall()
+    return get_version(conn) > 0 or len(tables) > 0
+
+def migrate(conn, target = latest_version):
+    """Upgrades a case database to the target schema version.
+
+    All the missing steps are run in one transaction which is rolled back if any
+    step fails. Cases that had rows converted are vacuumed afterwards so the file
+    actually shrinks.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the case database.
+        target (int): The version to upgrade to. Defaults to the latest version.
+
+    Returns:
+        migrated (bool): True if any step was run.
+    """
+    version = get_version(conn)
+    if version >= target:
+        return False
+
+    conn.commit()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN")
+        had_rows = version > 0 or is_initiated(conn)
+        if had_rows:
+            had_rows = c.execute('''SELECT EXISTS (SELECT 1 FROM bodies)''').fetchone()[0] == 1
+        for step in range(version, target):
+            schema_versions[step](c)
+        c.execute("PRAGMA user_version = {0}".format(int(target)))
+        c.execute("COMMIT")
+    except Exception:
+        c.execute("ROLLBACK")
+        raise
+    finally:
+        c.close()
+
+    if had_rows:
+        conn.execute("VACUUM")
+    return True
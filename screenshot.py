@@ -1,8 +1,9 @@
 import tkinter as tk
-import pyautogui
-from PIL import ImageTk, Image, ImageDraw, ImageFont
-from tkinter.colorchooser import askcolor
+from PIL import ImageTk, Image, ImageDraw
 from file_management import FileManagement
+from thumbnail_cache import open_thumbnail_cache
+from body_cache import open_body_cache
+from body_table import open_body_table
 import config
 import math
 import time
@@ -155,6 +156,8 @@ class ScreenshotEditor(tk.Toplevel):
         
         Initaites a color chooser for users to select a color for the annotations.
         """
+        # loaded on first use, the color chooser is not needed to start the program
+        from tkinter.colorchooser import askcolor
         self.color = askcolor(color = self.color, parent = self.toolbar_frame)[1]
 
     def paint(self, event):
@@ -224,6 +227,7 @@ class ScreenshotEditor(tk.Toplevel):
         later. If the image is new, it also adds it to the database.
         """
         # parameters for the PIL annotations done in tandem with the seen tkinter annotations
+        from PIL import ImageFont
         self.font = ImageFont.truetype("calibrib.ttf", 20) 
         bounds = self.screenshot_canvas.bbox("text")
         self.draw.text((bounds[0], bounds[1]), fill = 'white', 
@@ -232,14 +236,15 @@ class ScreenshotEditor(tk.Toplevel):
         
         if self.new == True: # if the image is being saved from LilSnippy
             FileManagement(self.folder_path).save_image(self.body_info, self.im, self.annotation)
-            from markings import GridMark
-            GridMark(self.marker_canvas, self.folder_path, self.body_info)
+            self.marker_canvas.marker_layer.add_body(self.body_info)
         else: # if the annotations are being edited from Image Viewer
-            self.annotation.save(self.folder_path + self.body_info["annotation_file_name"])
+            FileManagement(self.folder_path).save_annotation(self.body_info, self.annotation, self.im)
+            open_thumbnail_cache(self.folder_path).invalidate(self.body_info["body_id"])
+            open_body_cache(self.folder_path).invalidate(self.body_info["body_id"])
         
         self.destroy()
         
-        number = FileManagement(self.folder_path).count_bodies(config.all_bodies, False, False, False, False)
+        number = open_body_table(self.folder_path).count(config.all_bodies, False, False, False, False)
         if number == 300: # opens a popup at 300 biondi bodies done
             done_screen = tk.Toplevel()
             done_screen.grab_set()
@@ -329,7 +334,7 @@ class Ringer(tk.Toplevel):
                     self.body_info["unsure"], self.body_info["notes"], 
                     self.body_info["angle"], self.body_info["log"], 
                     self.body_info["dprong1"], self.body_info["lprong2"],
-                    self.body_info["time"])
+                    self.body_info["body_id"])
             FileManagement(self.folder_path).edit_info(info)
             
         self.destroy()
@@ -555,7 +560,7 @@ class Angler(tk.Toplevel):
                     self.body_info["MAF"], self.body_info["MP"], 
                     self.body_info["unsure"], self.body_info["notes"], 
                     self.body_info["angle"], self.body_info["log"], 
-                    self.body_info["dprong1"], self.body_info["lprong2"], self.body_info["time"])
+                    self.body_info["dprong1"], self.body_info["lprong2"], self.body_info["body_id"])
             FileManagement(self.folder_path).edit_info(info)
             
         self.destroy()
@@ -927,6 +932,8 @@ class LilSnippy(tk.Frame):
             x2 (int): X coordinate when the mouse is released.
             y2 (int): Y coordinate when the mouse is released.
         """
+        # pyautogui loads its platform backends when imported, so it waits until the first screenshot
+        import pyautogui
         im = pyautogui.screenshot(region=(x1, y1, x2, y2))
         if self.body_info["body_name"] in config.angler_types:
             Angler(self.body_info, self.folder_path, self.marker_canvas, im, True)
@@ -0,0 +1,86 @@
+"""A uniform grid of buckets over points on the gridfile.
+
+Markers are looked up by position for three things: which ones are in view,
+which one was clicked and whether a new body is close to one already saved.
+Each point is kept in the bucket of the cell_size square it falls in, so a
+lookup only reads the buckets that overlap the region asked about.
+
+Typical usage example:
+    index = SpatialIndex(config.marker_cell_size)
+    index.insert(("m", body_id), x, y)
+    visible = index.query(x0, y0, x1, y1)
+"""
+
+from math import floor, hypot
+
+class SpatialIndex():
+    """Points with a key each, bucketed by position.
+
+    Attributes:
+        cell_size (float): The width and height of a bucket.
+        cells (dict): (column, row) of a bucket to the set of keys in it.
+        points (dict): key to its (x, y).
+    """
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.points = {}
+
+    def _cell(self, x, y):
+        return (floor(x / self.cell_size), floor(y / self.cell_size))
+
+    def __len__(self):
+        return len(self.points)
+
+    def __contains__(self, key):
+        return key in self.points
+
+    def insert(self, key, x, y):
+        """Adds a point, moving it if the key is already in the index."""
+        self.remove(key)
+        self.points[key] = (x, y)
+        self.cells.setdefault(self._cell(x, y), set()).add(key)
+
+    def remove(self, key):
+        """Removes a point. Returns False if the key was not in the index."""
+        point = self.points.pop(key, None)
+        if point is None:
+            return False
+        cell = self._cell(*point)
+        self.cells[cell].discard(key)
+        if not self.cells[cell]:
+            del self.cells[cell]
+        return True
+
+    def position(self, key):
+        """Returns the (x, y) of a key, None if it is not in the index."""
+        return self.points.get(key)
+
+    def query(self, x0, y0, x1, y1):
+        """Returns the keys of every point inside a rectangle, edges included."""
+        col0, row0 = self._cell(x0, y0)
+        col1, row1 = self._cell(x1, y1)
+        # a region larger than the occupied buckets reads those buckets instead
+        if (col1 - col0 + 1) * (row1 - row0 + 1) > len(self.cells):
+            cells = [keys for (col, row), keys in self.cells.items() if col0 <= col <= col1 and row0 <= row <= row1]
+        else:
+            cells = [self.cells[(col, row)] for col in range(col0, col1 + 1) for row in range(row0, row1 + 1)
+                     if (col, row) in self.cells]
+        found = []
+        for keys in cells:
+            for key in keys:
+                x, y = self.points[key]
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    found.append(key)
+        return found
+
+    def nearest(self, x, y, radius):
+        """Returns (distance, key) of every point within radius of (x, y), closest first."""
+        found = []
+        for key in self.query(x - radius, y - radius, x + radius, y + radius):
+            px, py = self.points[key]
+            distance = hypot(px - x, py - y)
+            if distance <= radius:
+                found.append((distance, key))
+        found.sort(key = lambda item: item[0])
+        return found
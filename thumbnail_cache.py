@@ -0,0 +1,262 @@
+"""Small previews of bodies for the image viewer.
+
+A thumbnail is the render of a body, its body image with the annotation pasted
+on top, shrunk to config.thumbnail_size. Thumbnails are made on a background thread and kept in
+thumbnails.db in the case folder, a cache of its own so the case database and
+its exports do not grow with it. The least recently used thumbnails are
+dropped once the cache holds more than config.thumbnail_cache_bytes.
+
+Every thumbnail is saved with the name and store stamp of the render it was
+made from. SQLite gives the id of a deleted body to the next body saved when
+it was the highest, so a thumbnail is only used while its body still has that
+render.
+
+Typical usage example:
+    thumbnails = open_thumbnail_cache(folder_path)
+    thumbnails.request(body_ids)
+    for body_id in thumbnails.ready():
+        img = thumbnails.get(body_id)
+"""
+
+import io
+import json
+import queue
+import sqlite3
+import threading
+from PIL import Image
+from database_manager import DatabaseManager
+from file_management import FileManagement
+from image_store import open_image_store, render_name
+import config
+
+def make_thumbnail(render_img, size):
+    """Shrinks the render of a body to thumbnail size.
+
+    The render is shrunk by a whole factor with reduce first, which is much
+    cheaper than resampling the full image, and the result is brought down to
+    size with thumbnail. draft lets jpeg images skip decoding at full size,
+    pngs are decoded in full either way.
+
+    Args:
+        render_img (PIL Image): The render, see FileManagement.open_render.
+        size (tuple): The largest width and height of the thumbnail.
+
+    Returns:
+        thumbnail (PIL Image): An RGB image no larger than size.
+    """
+    render_img.draft("RGB", size)
+    factor = max(1, min(render_img.width // size[0], render_img.height // size[1]))
+    thumbnail = render_img.convert("RGB").reduce(factor)
+    thumbnail.thumbnail(size)
+    return thumbnail
+
+class ThumbnailCache():
+    """The thumbnails of one case.
+
+    get is called from the Tk thread and only reads the cache. Missing
+    thumbnails and thumbnails of a render that was replaced are passed to request, made by the worker thread and announced
+    through ready. invalidate drops the thumbnail of a body whose images were
+    saved again, including one the worker is making at that moment.
+
+    A body whose thumbnail can not be made is recorded in errors and still
+    announced through ready, the worker goes on with the next body.
+
+    Attributes:
+        folder_path (str): The directory of the case folder.
+        budget (int): The most bytes of thumbnails kept.
+        size (tuple): The largest width and height of a thumbnail.
+        conn (sqlite3.Connection): Connection to thumbnails.db, shared by both
+            threads under a lock.
+        errors (list): Tuple of (body id, exception) for every thumbnail that failed.
+    """
+    def __init__(self, folder_path, budget = config.thumbnail_cache_bytes, size = config.thumbnail_size):
+        self.folder_path = folder_path
+        self.budget = budget
+        self.size = tuple(size)
+        self.errors = []
+        self.conn = sqlite3.connect(folder_path + "thumbnails.db", check_same_thread = False)
+        # a lost thumbnail is made again, so writes are not waited on
+        self.conn.execute("PRAGMA synchronous = OFF")
+        # thumbnails saved before they were stamped can not be checked and are made again
+        columns = [row[1] for row in self.conn.execute('''PRAGMA table_info(thumbnails)''')]
+        if columns and "STAMP" not in columns:
+            self.conn.execute('''DROP TABLE thumbnails''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS thumbnails (BODY_ID INTEGER PRIMARY KEY,
+                                                                  IMAGE BLOB NOT NULL,
+                                                                  SIZE INTEGER NOT NULL,
+                                                                  USED INTEGER NOT NULL,
+                                                                  STAMP TEXT NOT NULL)''')
+        self.conn.execute('''CREATE INDEX IF NOT EXISTS thumbnails_used_index ON thumbnails (USED)''')
+        self.conn.commit()
+        self._total, self._clock = self.conn.execute(
+            '''SELECT IFNULL(SUM(SIZE), 0), IFNULL(MAX(USED), 0) FROM thumbnails''').fetchone()
+        self._lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._ready = queue.Queue()
+        self._generations = {}
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def _touch(self):
+        self._clock += 1
+        return self._clock
+
+    def _stamp(self, body_file_name):
+        """Returns the name and store stamp of the render a thumbnail of the body is made from."""
+        name = render_name(body_file_name)
+        return json.dumps([name, open_image_store(self.folder_path).stamp(name)])
+
+    def get(self, body_id):
+        """Returns the thumbnail of a body, or None if it has not been made from its current render yet."""
+        file_names = DatabaseManager.get_connection(self.folder_path).execute(
+            '''SELECT BODY_FILE_NAME FROM bodies WHERE BODY_ID = ?''', (body_id,)).fetchone()
+        if file_names is None:
+            return None
+        stamp = self._stamp(file_names[0])
+        with self._lock:
+            row = self.conn.execute('''SELECT IMAGE, STAMP FROM thumbnails WHERE BODY_ID = ?''', (body_id,)).fetchone()
+            if row is None or row[1] != stamp:
+                return None
+            self.conn.execute('''UPDATE thumbnails SET USED = ? WHERE BODY_ID = ?''', (self._touch(), body_id))
+            self.conn.commit()
+        return Image.open(io.BytesIO(row[0]))
+
+    def request(self, body_ids):
+        """Queues bodies to have their thumbnail made. Bodies that have one are only announced."""
+        for body_id in body_ids:
+            self._requests.put(body_id)
+
+    def ready(self):
+        """Returns the ids of the requested bodies finished since the last call.
+
+        A body whose images could not be read is returned too, get gives None
+        for it.
+        """
+        body_ids = []
+        while True:
+            try:
+                body_ids.append(self._ready.get_nowait())
+            except queue.Empty:
+                return body_ids
+
+    def cancel(self):
+        """Drops every request that has not been started."""
+        while True:
+            try:
+                self._requests.get_nowait()
+            except queue.Empty:
+                return
+            self._requests.task_done()
+
+    def wait(self):
+        """Blocks until every request has been handled."""
+        self._requests.join()
+
+    def invalidate(self, body_id):
+        """Drops the thumbnail of a body, call when its images are saved again or it is deleted."""
+        with self._lock:
+            self._generations[body_id] = self._generations.get(body_id, 0) + 1
+            row = self.conn.execute('''SELECT SIZE FROM thumbnails WHERE BODY_ID = ?''', (body_id,)).fetchone()
+            if row is not None:
+                self.conn.execute('''DELETE FROM thumbnails WHERE BODY_ID = ?''', (body_id,))
+                self.conn.commit()
+                self._total -= row[0]
+
+    def _run(self):
+        while True:
+            body_id = self._requests.get()
+            try:
+                if body_id is None:
+                    DatabaseManager.close_thread(self.folder_path)
+                    return
+                self._make(body_id)
+            except Exception as error:
+                # one body that can not be read must not leave the buttons after it blank
+                with self._lock:
+                    self.errors.append((body_id, error))
+            finally:
+                self._requests.task_done()
+            self._ready.put(body_id)
+
+    def _make(self, body_id):
+        with self._lock:
+            generation = self._generations.get(body_id, 0)
+        file_names = DatabaseManager.get_connection(self.folder_path).execute(
+            '''SELECT BODY_FILE_NAME, ANNOTATION_FILE_NAME FROM bodies WHERE BODY_ID = ?''', (body_id,)).fetchone()
+        if file_names is None:
+            return
+        with self._lock:
+            row = self.conn.execute('''SELECT STAMP FROM thumbnails WHERE BODY_ID = ?''', (body_id,)).fetchone()
+            if row is not None and row[0] == self._stamp(file_names[0]):
+                return
+
+        render_img = FileManagement(self.folder_path).open_render(*file_names)
+        # taken once the render is open, a missing render is saved by open_render
+        stamp = self._stamp(file_names[0])
+        thumbnail = make_thumbnail(render_img, self.size)
+        data = io.BytesIO()
+        thumbnail.save(data, format = "JPEG", quality = 85)
+        data = data.getvalue()
+
+        with self._lock:
+            # the images were saved again while the thumbnail was being made
+            if self._generations.get(body_id, 0) != generation:
+                return
+            row = self.conn.execute('''SELECT SIZE FROM thumbnails WHERE BODY_ID = ?''', (body_id,)).fetchone()
+            if row is not None:
+                self._total -= row[0]
+            self.conn.execute('''INSERT OR REPLACE INTO thumbnails (BODY_ID, IMAGE, SIZE, USED, STAMP)
+                                 VALUES (?, ?, ?, ?, ?)''', (body_id, data, len(data), self._touch(), stamp))
+            self._total += len(data)
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        """Drops the least recently used thumbnails until the cache fits its budget. The caller commits."""
+        if self._total <= self.budget:
+            return
+        evicted = []
+        for body_id, size in self.conn.execute('''SELECT BODY_ID, SIZE FROM thumbnails ORDER BY USED'''):
+            if self._total <= self.budget:
+                break
+            evicted.append((body_id,))
+            self._total -= size
+        self.conn.executemany('''DELETE FROM thumbnails WHERE BODY_ID = ?''', evicted)
+
+    def total_bytes(self):
+        """Returns the number of bytes of thumbnails held."""
+        with self._lock:
+            return self._total
+
+    def close(self):
+        """Stops the worker once it finishes its current thumbnail and closes the cache."""
+        self.cancel()
+        self._requests.put(None)
+        self._thread.join()
+        with self._lock:
+            self.conn.close()
+
+_open_caches = {}
+_caches_lock = threading.Lock()
+
+def open_thumbnail_cache(folder_path):
+    """Returns the thumbnail cache of a case, which is kept until the case is closed.
+
+    Args:
+        folder_path (str): The directory of the case folder ending with a slash.
+    """
+    key = DatabaseManager.case_key(folder_path)
+    with _caches_lock:
+        cache = _open_caches.get(key)
+        if cache is None:
+            cache = ThumbnailCache(folder_path)
+            _open_caches[key] = cache
+            DatabaseManager.subscribe(folder_path, lambda event: _on_case_event(key, event))
+    return cache
+
+def _on_case_event(key, event):
+    if event == "closed":
+        with _caches_lock:
+            cache = _open_caches.pop(key, None)
+        if cache is not None:
+            cache.close()
@@ -0,0 +1,396 @@
+"""The gridfile cut into tiles at several resolutions.
+
+A stitched slide can be tens of thousands of pixels on a side, far too large
+to decode or hand to Tk as one image. The pyramid is built once per case into
+gridtiles.db in the case folder. Level 0 holds the gridfile at full size cut
+into config.tile_size squares and every further level halves the one below it,
+up to a level that fits in a single tile. TileRenderer then keeps only the
+tiles of the visible part of the canvas as Tk images.
+
+The gridfile is read a band of rows at a time, so building the pyramid never
+holds the whole image. Uncompressed images, for example a ppm, bmp or tiff, are
+read straight from the file. A jpeg, which is what cases keep, is decoded once
+into a temporary file next to it and the bands are read from there. Other
+compressed formats are decoded whole.
+
+Typical usage example:
+    pyramid = open_tile_pyramid(folder_path)
+    renderer = TileRenderer(canvas, pyramid)
+"""
+
+import io
+import os
+import mmap
+import sqlite3
+import tempfile
+import threading
+from PIL import Image, ImageTk
+from database_manager import DatabaseManager
+import config
+
+def open_gridfile(path):
+    """Opens a gridfile without the decompression bomb check of PIL.
+
+    Gridfiles are stitched slides of the user's own, not untrusted downloads,
+    and are far larger than the limit. The limit is only lifted while the
+    header is read, every other image keeps the check.
+
+    Args:
+        path (str): Path of the gridfile.
+
+    Returns:
+        img (PIL Image): The opened, not yet decoded, image.
+    """
+    max_pixels = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        return Image.open(path)
+    finally:
+        Image.MAX_IMAGE_PIXELS = max_pixels
+
+def _drop_pages(pixels):
+    """Drops the pages of a shared memory map from the process, they stay in the file.
+
+    Windows has no madvise, it trims the pages of a file mapping by itself.
+    """
+    if hasattr(pixels, "madvise"):
+        pixels.madvise(mmap.MADV_DONTNEED)
+
+def _read_jpeg_bands(img, path, band_height):
+    """Decodes a jpeg into a temporary file and reads it back a band of rows at a time.
+
+    The decoder writes into a memory map of the file and is fed the jpeg a
+    piece at a time. The pages it wrote are dropped after every piece, so the
+    memory used does not grow with the image, only the temporary file does.
+
+    Args:
+        img (PIL Image): The opened jpeg in RGB or L, one tile.
+        path (str): Path of the jpeg.
+        band_height (int): The number of rows in a band.
+
+    Yields:
+        band (PIL Image): The next band of rows in RGB.
+    """
+    width, height = img.size
+    # the shared buffer of frombuffer needs the 4 byte pixels PIL keeps RGB in
+    mode = "RGBX" if img.mode == "RGB" else "L"
+    row_bytes = width * len(mode)
+    codec, extents, offset, args = img.tile[0]
+    decoderconfig = img.decoderconfig
+    img.close()
+    with tempfile.TemporaryFile(dir = os.path.dirname(path) or None) as map_file:
+        map_file.truncate(row_bytes * height)
+        pixels = mmap.mmap(map_file.fileno(), row_bytes * height)
+        try:
+            target = Image.frombuffer(mode, (width, height), pixels, "raw", mode, 0, 1)
+            decoder = Image._getdecoder(mode, codec, args, decoderconfig)
+            decoder.setimage(target.im, extents)
+            try:
+                with open(path, "rb") as image_file:
+                    image_file.seek(offset)
+                    data = b""
+                    while True:
+                        piece = image_file.read(1 << 14)
+                        data += piece
+                        consumed, error = decoder.decode(data)
+                        _drop_pages(pixels)
+                        if consumed < 0:
+                            if error < 0:
+                                raise OSError("decoder error {0} while reading {1}".format(error, path))
+                            break
+                        if not piece:
+                            raise OSError("{0} is truncated".format(path))
+                        data = data[consumed:]
+            finally:
+                decoder.cleanup()
+                # the image holds the map until it is gone
+                del target, decoder
+
+            for y in range(0, height, band_height):
+                rows = min(band_height, height - y)
+                view = memoryview(pixels)[y * row_bytes:(y + rows) * row_bytes]
+                try:
+                    band = Image.frombuffer(mode, (width, rows), view, "raw", mode, 0, 1).convert("RGB")
+                finally:
+                    view.release()
+                _drop_pages(pixels)
+                yield band
+        finally:
+            pixels.close()
+
+def read_bands(path, band_height):
+    """Reads an image from top to bottom a band of rows at a time.
+
+    Args:
+        path (str): Path of the image.
+        band_height (int): The number of rows in a band, the last band can be shorter.
+
+    Yields:
+        band (PIL Image): The next band of rows in RGB.
+    """
+    img = open_gridfile(path)
+    width, height = img.size
+    if img.format == "JPEG" and img.mode in ("RGB", "L") and len(img.tile) == 1:
+        yield from _read_jpeg_bands(img, path, band_height)
+        return
+    if len(img.tile) == 1 and img.tile[0][0] == "raw" and img.mode in ("RGB", "RGBA", "L"):
+        decoder, extents, offset, args = img.tile[0]
+        if isinstance(args, str):
+            args = (args, 0, 1)
+        rawmode, stride, orientation = args[:3]
+        if stride == 0:
+            stride = len(Image.new(img.mode, (width, 1)).tobytes("raw", rawmode))
+        img.close()
+        # bottom up images keep their last row first in the file
+        with open(path, "rb") as image_file:
+            for y in range(0, height, band_height):
+                rows = min(band_height, height - y)
+                first_row = y if orientation > 0 else height - y - rows
+                image_file.seek(offset + first_row * stride)
+                band = Image.frombuffer(img.mode, (width, rows), image_file.read(rows * stride),
+                                        "raw", rawmode, stride, orientation)
+                yield band.convert("RGB")
+        return
+
+    img = img.convert("RGB")
+    for y in range(0, height, band_height):
+        yield img.crop((0, y, width, min(y + band_height, height)))
+
+class TilePyramid():
+    """The tiles of the gridfile of one case.
+
+    Attributes:
+        folder_path (str): The directory of the case folder.
+        width (int): The width of the gridfile.
+        height (int): The height of the gridfile.
+        tile_size (int): The width and height of a full tile.
+        levels (int): The number of levels, the last one is a single tile.
+        conn (sqlite3.Connection): Connection to gridtiles.db.
+    """
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.conn = sqlite3.connect(folder_path + "gridtiles.db", check_same_thread = False)
+        meta = dict(self.conn.execute('''SELECT KEY, VALUE FROM meta'''))
+        self.width = int(meta["width"])
+        self.height = int(meta["height"])
+        self.tile_size = int(meta["tile_size"])
+        self.levels = int(meta["levels"])
+        self.source = meta["source"]
+
+    @staticmethod
+    def source_stamp(folder_path):
+        """Returns the modification time and size of the gridfile, which the pyramid was built from."""
+        stat = os.stat(folder_path + "gridfile.jpg")
+        return "{0} {1}".format(stat.st_mtime_ns, stat.st_size)
+
+    @staticmethod
+    def build(folder_path, tile_size = config.tile_size):
+        """Cuts the gridfile of a case into a new gridtiles.db.
+
+        The tiles are written to a temporary database that replaces the old one
+        once it is complete. Every level keeps at most one band of tile_size
+        rows while the gridfile is read, which is passed on halved to the next
+        level once it is full.
+
+        Args:
+            folder_path (str): The directory of the case folder ending with a slash.
+            tile_size (int): The width and height of a full tile.
+        """
+        part_path = folder_path + "gridtiles.db.part"
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        conn = sqlite3.connect(part_path)
+        conn.execute('''CREATE TABLE meta (KEY TEXT PRIMARY KEY, VALUE TEXT)''')
+        conn.execute('''CREATE TABLE tiles (LEVEL INTEGER NOT NULL,
+                                            COL INTEGER NOT NULL,
+                                            ROW INTEGER NOT NULL,
+                                            IMAGE BLOB NOT NULL,
+                                            PRIMARY KEY (LEVEL, COL, ROW)) WITHOUT ROWID''')
+
+        with open_gridfile(folder_path + "gridfile.jpg") as img:
+            width, height = img.size
+        levels = 1
+        while max(width, height) > tile_size * 2 ** (levels - 1):
+            levels += 1
+
+        # pending[level] is the top half of the next band of that level
+        pending = [None] * levels
+        rows = [0] * levels
+
+        def add_band(level, band):
+            tiles = []
+            for col, x in enumerate(range(0, band.width, tile_size)):
+                data = io.BytesIO()
+                band.crop((x, 0, min(x + tile_size, band.width), band.height)).save(data, format = "JPEG", quality = 90)
+                tiles.append((level, col, rows[level], data.getvalue()))
+            conn.executemany('''INSERT INTO tiles (LEVEL, COL, ROW, IMAGE) VALUES (?, ?, ?, ?)''', tiles)
+            rows[level] += 1
+            if level + 1 < levels:
+                add_half(level + 1, band.reduce(2))
+
+        def add_half(level, half):
+            if pending[level] is None:
+                pending[level] = half
+                return
+            band = Image.new("RGB", (half.width, pending[level].height + half.height))
+            band.paste(pending[level], (0, 0))
+            band.paste(half, (0, pending[level].height))
+            pending[level] = None
+            add_band(level, band)
+
+        for band in read_bands(folder_path + "gridfile.jpg", tile_size):
+            add_band(0, band)
+        # the bottom of a level that did not fill a whole band
+        for level in range(1, levels):
+            if pending[level] is not None:
+                band = pending[level]
+                pending[level] = None
+                add_band(level, band)
+
+        conn.executemany('''INSERT INTO meta (KEY, VALUE) VALUES (?, ?)''',
+                         [("width", width), ("height", height), ("tile_size", tile_size), ("levels", levels),
+                          ("source", TilePyramid.source_stamp(folder_path))])
+        conn.commit()
+        conn.close()
+        os.replace(part_path, folder_path + "gridtiles.db")
+
+    def level_size(self, level):
+        """Returns the width and height of the gridfile at a level."""
+        width, height = self.width, self.height
+        for i in range(level):
+            width, height = (width + 1) // 2, (height + 1) // 2
+        return width, height
+
+    def tiles_in(self, level, x0, y0, x1, y1):
+        """Returns the column and row of every tile of a level touching a region.
+
+        Args:
+            level (int): The level of the tiles.
+            x0, y0, x1, y1 (float): The corners of the region in pixels of that level.
+        """
+        width, height = self.level_size(level)
+        cols = range(max(0, int(x0) // self.tile_size), min((width - 1) // self.tile_size, int(x1) // self.tile_size) + 1)
+        rows = range(max(0, int(y0) // self.tile_size), min((height - 1) // self.tile_size, int(y1) // self.tile_size) + 1)
+        return [(col, row) for row in rows for col in cols]
+
+    def tile(self, level, col, row):
+        """Returns a tile as a PIL image, or None if there is no such tile."""
+        found = self.conn.execute('''SELECT IMAGE FROM tiles WHERE LEVEL = ? AND COL = ? AND ROW = ?''',
+                                  (level, col, row)).fetchone()
+        if found is None:
+            return None
+        return Image.open(io.BytesIO(found[0]))
+
+    def level_image(self, level):
+        """Returns a whole level pasted together, meant for the small levels at the top."""
+        width, height = self.level_size(level)
+        img = Image.new("RGB", (width, height))
+        for col, row, data in self.conn.execute('''SELECT COL, ROW, IMAGE FROM tiles WHERE LEVEL = ?''', (level,)):
+            img.paste(Image.open(io.BytesIO(data)), (col * self.tile_size, row * self.tile_size))
+        return img
+
+    def overview(self, max_size):
+        """Returns the whole gridfile shrunk to fit in a square of max_size pixels.
+
+        It is made from the smallest level that is at least max_size, so it
+        takes the same few tiles whatever the size of the gridfile.
+        """
+        level = self.levels - 1
+        while level > 0 and max(self.level_size(level)) < max_size:
+            level -= 1
+        img = self.level_image(level)
+        img.thumbnail((max_size, max_size))
+        return img
+
+    def close(self):
+        self.conn.close()
+
+class TileRenderer():
+    """Shows the tiles of the visible part of a canvas.
+
+    The canvas shows the gridfile at full size, in the same coordinates markers
+    are saved in, so the tiles come from level 0. Tiles are made when they
+    scroll into view, together with a margin of one tile, and deleted once they
+    leave it. Every tile is kept below the markers and the grid overlay.
+
+    Attributes:
+        canvas (tk.Canvas): The canvas the gridfile is shown on.
+        pyramid (TilePyramid): The tiles of the gridfile.
+        shown (dict): (column, row) to the canvas item and Tk image of every tile shown.
+        render_after (str): The after_idle id of a pending render, None if there is none.
+    """
+    def __init__(self, canvas, pyramid):
+        self.canvas = canvas
+        self.pyramid = pyramid
+        self.shown = {}
+        self.render_after = None
+        self.canvas.bind("<Configure>", lambda event: self.schedule(), add = "+")
+
+    def schedule(self):
+        """Renders once Tk is idle. Several scrolls in a row are rendered once."""
+        if self.render_after is None:
+            self.render_after = self.canvas.after_idle(self.render)
+
+    def render(self):
+        """Makes the tiles that scrolled into view and deletes the ones that left it."""
+        self.render_after = None
+        tile_size = self.pyramid.tile_size
+        visible = set(self.pyramid.tiles_in(0, self.canvas.canvasx(0) - tile_size, self.canvas.canvasy(0) - tile_size,
+                                            self.canvas.canvasx(self.canvas.winfo_width()) + tile_size,
+                                            self.canvas.canvasy(self.canvas.winfo_height()) + tile_size))
+
+        for key in set(self.shown) - visible:
+            item, img = self.shown.pop(key)
+            self.canvas.delete(item)
+        for col, row in visible - set(self.shown):
+            img = ImageTk.PhotoImage(self.pyramid.tile(0, col, row))
+            item = self.canvas.create_image(col * tile_size, row * tile_size, anchor = "nw", image = img, tags = ("tile",))
+            self.shown[(col, row)] = (item, img)
+        self.canvas.tag_lower("tile")
+
+    def cancel(self):
+        """Stops a pending render, used when the case is closed."""
+        if self.render_after is not None:
+            self.canvas.after_cancel(self.render_after)
+            self.render_after = None
+
+_open_pyramids = {}
+_pyramids_lock = threading.Lock()
+
+def open_tile_pyramid(folder_path):
+    """Returns the tile pyramid of a case, which is kept until the case is closed.
+
+    The pyramid is built first if the case has none yet or if the gridfile
+    changed since it was built.
+
+    Args:
+        folder_path (str): The directory of the case folder ending with a slash.
+    """
+    key = DatabaseManager.case_key(folder_path)
+    with _pyramids_lock:
+        pyramid = _open_pyramids.get(key)
+        if pyramid is None:
+            pyramid = _load_or_build(folder_path)
+            _open_pyramids[key] = pyramid
+            DatabaseManager.subscribe(folder_path, lambda event: _on_case_event(key, event))
+    return pyramid
+
+def _load_or_build(folder_path):
+    if os.path.exists(folder_path + "gridtiles.db"):
+        try:
+            pyramid = TilePyramid(folder_path)
+        except (sqlite3.Error, KeyError):
+            pyramid = None
+        if pyramid is not None and pyramid.source == TilePyramid.source_stamp(folder_path):
+            return pyramid
+        if pyramid is not None:
+            pyramid.close()
+    TilePyramid.build(folder_path)
+    return TilePyramid(folder_path)
+
+def _on_case_event(key, event):
+    if event == "closed":
+        with _pyramids_lock:
+            pyramid = _open_pyramids.pop(key, None)
+        if pyramid is not None:
+            pyramid.close()